@@ -19,26 +19,101 @@ import memory_profiler
 import warnings
 
 from dicom2elk.info import __packagename__, __version__, __copyright__
-from dicom2elk.cli.parser import get_dicom2elk_parser
-from dicom2elk.core.process import process_batches
-from dicom2elk.utils.io import read_dcm_list_file
-from dicom2elk.utils.logging import create_logger
-from dicom2elk.utils.config import set_n_threads
+from dicom2elk.cli.parser import get_dicom2elk_parser, validate_args
+from dicom2elk.core.autotune import AutoTuner
+from dicom2elk.core.dicom.tags import get_tag_selection
+from dicom2elk.core.process import (
+    get_cache_db,
+    get_worker_options_from_args,
+    log_stage_throughput,
+    process_batches,
+)
+from dicom2elk.utils.io import count_lines, read_dcm_list_file
+from dicom2elk.utils.errors import get_error_file
+from dicom2elk.utils.journal import get_journal_file
+from dicom2elk.utils.logging import create_logger, remove_file_handler
+from dicom2elk.utils.manifest import get_manifest_file
+from dicom2elk.utils.config import get_config, set_n_threads
 from dicom2elk.utils.profiling import append_profiler_results
-from dicom2elk.utils.misc import prepare_file_list_batches
+from dicom2elk.utils.misc import get_n_batches, prepare_file_list_batches
 
 
 def main():
     parser = get_dicom2elk_parser()
     args = parser.parse_args()
-    if not args.profile and args.profile_tsv is not None:
-        parser.error(
-            "The following argument is required when --profile-tsv is specified: --profile"
-        )
+    validate_args(parser, args)
     return process(args)
 
 
-def process(args):
+def get_dcmread_kwargs(args, logger=create_logger("INFO")):
+    """Get the arguments of `dcmread` and the tags to exclude from the command line arguments.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments.
+        logger (logging.Logger): Logger instance.
+
+    Returns:
+        tuple: Tuple containing:
+                   * the keyword arguments to pass to the `dcmread` function.
+                   * the list of tags to exclude.
+    """
+    kwargs = {
+        "stop_before_pixels": True,
+    }
+
+    # Get the selection of tags to extract from the config file if provided
+    config = get_config(args.config) if args.config is not None else {}
+    include_tags, exclude_tags = get_tag_selection(config)
+    if include_tags is not None:
+        logger.info(f"Number of tags to extract: {len(include_tags)}")
+        kwargs["specific_tags"] = include_tags
+    if exclude_tags:
+        logger.info(f"Number of tags to exclude: {len(exclude_tags)}")
+    return kwargs, exclude_tags
+
+
+def create_auto_tuner(args, logger=create_logger("INFO")):
+    """Create the auto-tuner of a run from the command line arguments.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments. `args.n_threads`
+                                   and `args.batch_size` are the upper limits.
+        logger (logging.Logger): Logger instance.
+
+    Returns:
+        dicom2elk.core.autotune.AutoTuner: Auto-tuner of the run.
+    """
+    return AutoTuner(
+        args.n_threads,
+        args.batch_size,
+        max_memory=(
+            int(args.auto_tune_max_memory * 1024**2)
+            if args.auto_tune_max_memory is not None
+            else None
+        ),
+        logger=logger,
+    )
+
+
+def process(args, pool=None, tuner=None):
+    """Extract the metadata of the dicom files listed in `args.input_dcm_list`.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments.
+        pool (multiprocessing.pool.Pool): Pool of worker processes shared by several
+                                          calls (e.g. by `file2json`) that must have been
+                                          created with the options of this run. If None,
+                                          a pool is created for the run and closed at its end.
+        tuner (dicom2elk.core.autotune.AutoTuner): Auto-tuner shared by several calls
+                                                   (e.g. by `file2json`) so that each run
+                                                   starts from the configuration chosen by
+                                                   the previous one. If None and
+                                                   `args.auto_tune` is set, it is created
+                                                   for the run.
+
+    Returns:
+        int: Exit code.
+    """
     # Make sure path are absolute
     args.input_dcm_list = os.path.abspath(args.input_dcm_list)
     args.output_dir = os.path.abspath(args.output_dir)
@@ -46,6 +121,8 @@ def process(args):
         args.config = os.path.abspath(args.config)
     if args.profile_tsv is not None:
         args.profile_tsv = os.path.abspath(args.profile_tsv)
+    if args.cache_db is not None:
+        args.cache_db = os.path.abspath(args.cache_db)
 
     # Handle n_threads argument
     # If n_threads is invalid, it is set to default value
@@ -68,93 +145,232 @@ def process(args):
         [os.path.splitext(os.path.basename(args.input_dcm_list))[0], "log"]
     )
     logger = create_logger(args.log_level, args.output_dir, log_basename)
-    warnings.filterwarnings("ignore")
+    try:
+        warnings.filterwarnings("ignore")
 
-    # Display run summary
-    logger.info(
-        f"Running dicom2elk version {__version__} with the following arguments:"
-    )
-    for arg in vars(args):
-        logger.info(f"{arg}: {getattr(args, arg)}")
+        # Display run summary
+        logger.info(
+            f"Running dicom2elk version {__version__} with the following arguments:"
+        )
+        for arg in vars(args):
+            logger.info(f"{arg}: {getattr(args, arg)}")
 
-    # Load dicom list file
-    dcm_list = read_dcm_list_file(args.input_dcm_list)
+        # Journal of the completed batches used to resume an interrupted run
+        # (the batches of an auto-tuned run do not have a fixed size and the
+        # batches of a Parquet file are only saved once it is complete)
+        journal_file = None
+        if not args.auto_tune and args.mode != "parquet":
+            journal_file = get_journal_file(args.output_dir, args.input_dcm_list)
+        if args.resume:
+            logger.info(f"Resuming the run from {journal_file}")
 
-    # Define  arguments to pass to the `dcmread` function
-    # in `get_dcm_tags_list`
-    kwargs = {
-        "stop_before_pixels": True,
-    }
+        # NDJSON file of the files that cannot be read, which can be used as input list
+        # to retry them (the error directory of `file2json` is used if it is defined)
+        error_file = get_error_file(
+            getattr(args, "output_err", None) or args.output_dir, args.input_dcm_list
+        )
+
+        # Manifest of the JSON files so that they can be found without listing
+        # the output directory (see --json-layout)
+        manifest_file = None
+        if args.mode == "json":
+            manifest_file = get_manifest_file(args.output_dir, args.input_dcm_list)
+
+        # Fingerprint cache used to skip the files that have not changed
+        cache_file = None
+        if args.incremental:
+            cache_file = get_cache_db(args)
+            logger.info(f"Skipping the unchanged files recorded in {cache_file}")
+
+        # Stream the dicom list file so that only one batch of paths is held in memory
+        # (the number of files is counted beforehand to display the progress)
+        n_files = count_lines(args.input_dcm_list)
+        n_batches = get_n_batches(n_files, args.batch_size)
+        logger.info(f"Number of dicom files to process: {n_files}")
+        dcm_list = read_dcm_list_file(args.input_dcm_list, lazy=True, logger=logger)
+
+        # Options of the files of the run, built once and shared by the pool and all
+        # batches (those of the shared pool if it is given)
+        if pool is not None:
+            worker_options = pool.worker_options
+        else:
+            # Get the arguments to pass to the `dcmread` function
+            # and the tags to exclude
+            kwargs, exclude_tags = get_dcmread_kwargs(args, logger)
+            worker_options = get_worker_options_from_args(args, logger, kwargs, exclude_tags)
+
+        # Prepare batches of dicom files to process
+        if args.auto_tune:
+            # The size of each batch is chosen by the tuner when it is built
+            if tuner is None:
+                tuner = create_auto_tuner(args, logger)
+            dcm_list_batches = tuner.iter_batches(dcm_list)
+            n_batches = None
+        else:
+            dcm_list_batches = prepare_file_list_batches(
+                dcm_list, args.batch_size, lazy=True
+            )
 
-    # Prepare batches of dicom files to process
-    dcm_list_batches = prepare_file_list_batches(dcm_list, args.batch_size)
-
-    if args.profile:
-        # Process batches of dicom files with memory profiler
-        profiler_options = {
-            "interval": 0.5,
-            "multiprocess": True,
-            "retval": True,
-            "max_usage": True,
-            "backend": "psutil",
+        # Counters updated while processing the batches
+        stats = {"bulk_data_bytes_skipped": 0, "raw_engine_fallbacks": 0}
+
+        # Keyword arguments of `process_batches`
+        process_options = {
+            "logger": logger,
+            "worker_options": worker_options,
+            "stats": stats,
+            "pool": pool,
+            "n_batches": n_batches,
+            "journal_file": journal_file,
+            "cache_file": cache_file,
+            "error_file": error_file,
+            "tuner": tuner,
+            "manifest_file": manifest_file,
         }
-        logger.info(f"Profiler options: {profiler_options}")
 
-        tic = time.perf_counter()
-        # (memory_usage, retval) = memory_profiler.memory_usage(
-        #     (process_batches, (dcm_list_batches, args, kwargs)),
-        #     **profiler_options,
+        if args.profile:
+            # Process batches of dicom files with memory profiler
+            profiler_options = {
+                "interval": 0.5,
+                "multiprocess": True,
+                "retval": True,
+                "max_usage": True,
+                "backend": "psutil",
+                # Run the batches once even if the run is too short for 5 measurements
+                # (the batches are streamed and cannot be processed again)
+                "max_iterations": 1,
+            }
+            logger.info(f"Profiler options: {profiler_options}")
+
+            tic = time.perf_counter()
+            # (memory_usage, retval) = memory_profiler.memory_usage(
+            #     (process_batches, (dcm_list_batches, args, kwargs)),
+            #     **profiler_options,
+            # )
+            (memory_usage, retval) = memory_profiler.memory_usage(
+                (process_batches, (dcm_list_batches, args), process_options),
+                **profiler_options,
+            )
+            toc = time.perf_counter()
+
+            # Unpack total_dcm_processed and total_dcm_skipped from retval
+            (
+                total_dcm_processed,
+                total_dcm_skipped,
+                # total_time_extraction,
+                # total_time_save,
+            ) = retval
+
+            # Compute total elapsed time
+            total_time = toc - tic
+
+            rotated_file = append_profiler_results(
+                args.profile_tsv,
+                tuner.n_threads if tuner is not None else args.n_threads,
+                tuner.batch_size if tuner is not None else args.batch_size,
+                args.process_handler,
+                memory_usage,
+                total_dcm_processed,
+                total_dcm_skipped,
+                total_time,
+                # total_time_extraction,
+                # total_time_save,
+                total_bulk_data_bytes_skipped=stats["bulk_data_bytes_skipped"],
+                auto_tune=tuner is not None,
+            )
+            if rotated_file is not None:
+                logger.warning(
+                    f"{args.profile_tsv} had other columns and was renamed to {rotated_file}"
+                )
+        else:
+            # Process batches of dicom files
+            tic = time.perf_counter()
+            (
+                total_dcm_processed,
+                total_dcm_skipped,
+                # total_time_extraction,
+                # total_time_save,
+            ) = process_batches(dcm_list_batches, args, **process_options)
+            toc = time.perf_counter()
+            # Compute total elapsed time
+            total_time = toc - tic
+
+        logger.info(f"Run summary:")
+        logger.info(f"Number of dicom files processed: {total_dcm_processed}")
+        logger.info(f"Number of dicom files skipped: {total_dcm_skipped}")
+        if stats.get("errors", 0):
+            logger.info(
+                f"Number of dicom files that could not be read: {stats['errors']} "
+                f"(see {error_file})"
+            )
+        if args.resume:
+            logger.info(
+                f"Number of dicom files already processed by a previous run: "
+                f"{stats.get('resumed_files', 0)}"
+            )
+        if args.incremental:
+            logger.info(
+                f"Number of unchanged dicom files skipped (cache hits): "
+                f"{stats.get('cache_hits', 0)}"
+            )
+            logger.info(
+                f"Number of new or modified dicom files (cache misses): "
+                f"{stats.get('cache_misses', 0)}"
+            )
+        if args.skip_unchanged and args.mode == "elasticsearch":
+            logger.info(
+                f"Number of unchanged documents not uploaded: "
+                f"{stats.get('es_documents_unchanged', 0)}"
+            )
+        if args.mode == "elasticsearch":
+            logger.info(
+                f"Number of documents indexed: {stats.get('es_documents_indexed', 0)}"
+            )
+            logger.info(
+                f"Number of documents sent again after a rejection (429/503): "
+                f"{stats.get('es_documents_retried', 0)}"
+            )
+            logger.info(
+                f"Number of documents that could not be indexed: "
+                f"{stats.get('es_documents_failed', 0)}"
+            )
+            if args.es_op_type == "create":
+                logger.info(
+                    f"Number of documents that already exist (not indexed again): "
+                    f"{stats.get('es_documents_existing', 0)}"
+                )
+        if args.mode == "ndjson":
+            logger.info(
+                f"Number of NDJSON shards written: {stats.get('ndjson_shards', 0)}"
+            )
+        if args.mode == "parquet":
+            logger.info(
+                f"Number of Parquet row groups written: {stats.get('parquet_row_groups', 0)}"
+            )
+        if args.bulk_data_threshold is not None:
+            logger.info(
+                f"Number of bulk data bytes skipped: {stats['bulk_data_bytes_skipped']}"
+            )
+        if args.engine == "raw":
+            logger.info(
+                f"Number of dicom files read with pydicom (raw engine fallback): "
+                f"{stats['raw_engine_fallbacks']}"
+            )
+        if tuner is not None:
+            logger.info(
+                f"Auto-tuned configuration: n_threads={tuner.n_threads}, "
+                f"batch_size={tuner.batch_size} ({tuner.best_throughput:.1f} files/sec.)"
+            )
+        log_stage_throughput(stats, total_dcm_processed + total_dcm_skipped, logger)
+        # logger.info(
+        #     f"Total time: {total_time:.2f} sec. (Extraction: {total_time_extraction:.2f} sec., Save: {total_time_save:.2f} sec.)"
         # )
-        (memory_usage, retval) = memory_profiler.memory_usage(
-            (process_batches, (dcm_list_batches, args, logger, kwargs)),
-            **profiler_options,
-        )
-        toc = time.perf_counter()
-
-        # Unpack total_dcm_processed and total_dcm_skipped from retval
-        (
-            total_dcm_processed,
-            total_dcm_skipped,
-            # total_time_extraction,
-            # total_time_save,
-        ) = retval
-
-        # Compute total elapsed time
-        total_time = toc - tic
-
-        append_profiler_results(
-            args.profile_tsv,
-            args.n_threads,
-            args.batch_size,
-            args.process_handler,
-            memory_usage,
-            total_dcm_processed,
-            total_dcm_skipped,
-            total_time,
-            # total_time_extraction,
-            # total_time_save,
-        )
-    else:
-        # Process batches of dicom files
-        tic = time.perf_counter()
-        (
-            total_dcm_processed,
-            total_dcm_skipped,
-            # total_time_extraction,
-            # total_time_save,
-        ) = process_batches(dcm_list_batches, args, logger, kwargs)
-        toc = time.perf_counter()
-        # Compute total elapsed time
-        total_time = toc - tic
-
-    logger.info(f"Run summary:")
-    logger.info(f"Number of dicom files processed: {total_dcm_processed}")
-    logger.info(f"Number of dicom files skipped: {total_dcm_skipped}")
-    # logger.info(
-    #     f"Total time: {total_time:.2f} sec. (Extraction: {total_time_extraction:.2f} sec., Save: {total_time_save:.2f} sec.)"
-    # )
-    logger.info(f"Total time: {total_time:.2f} sec.")
-    logger.info("Finished!")
+        logger.info(f"Total time: {total_time:.2f} sec.")
+        logger.info("Finished!")
+    finally:
+        # Close the log file of the list even if the run fails
+        # (e.g. before `file2json` processes the next one)
+        remove_file_handler(logger, os.path.join(args.output_dir, log_basename))
 
     return 0
 
@@ -18,9 +18,15 @@ import sys
 import time
 import warnings
 
-from dicom2elk.cli.dicom2elk import process
+from dicom2elk.cli.dicom2elk import create_auto_tuner, get_dcmread_kwargs, process
+from dicom2elk.core.process import (
+    close_worker_pool,
+    create_worker_pool,
+    get_worker_options_from_args,
+)
 from dicom2elk.info import __packagename__, __version__, __copyright__
-from dicom2elk.cli.parser import get_file2json_parser
+from dicom2elk.cli.parser import get_file2json_parser, validate_args
+from dicom2elk.utils.config import set_n_threads
 from dicom2elk.utils.logging import create_logger
 
 
@@ -28,10 +34,7 @@ def main():
     parser = get_file2json_parser()
     args = parser.parse_args()
 
-    if not args.profile and args.profile_tsv is not None:
-        parser.error(
-            "The following argument is required when --profile-tsv is specified: --profile"
-        )
+    validate_args(parser, args)
 
     # Make sure path are absolute
     args.output_dir = os.path.abspath(args.output_dir)
@@ -52,6 +55,8 @@ def main():
         args.config = os.path.abspath(args.config)
     if args.profile_tsv is not None:
         args.profile_tsv = os.path.abspath(args.profile_tsv)
+    if args.cache_db is not None:
+        args.cache_db = os.path.abspath(args.cache_db)
 
     # Create logger
     log_basename = os.path.join(args.output_dir, "file2json.log")
@@ -65,24 +70,42 @@ def main():
     for arg in vars(args):
         logger.info(f"{arg}: {getattr(args, arg)}")
 
-    for root, _, files in os.walk(args.path):
-        for file in files:
-            # get absolute path of file
-            tic = time.perf_counter()
-            file_orig = os.path.join(root, file)
-            file_dest = os.path.join(args.temp_folder, file)
-            file_done = os.path.join(args.output_done, file)
-            shutil.move(file_orig, file_dest)
-
-            args.input_dcm_list = file_dest
-            process(args)
-            shutil.move(file_dest, file_done)
-            toc = time.perf_counter()
-            # Compute total elapsed time
-            total_time = toc - tic
-
-            logger.info(f"Run summary:")
-            logger.info(f"Total time: {total_time:.2f} sec.")
+    # Create the pool of worker processes once for all list files
+    args.n_threads = set_n_threads(args.n_threads)
+    kwargs, exclude_tags = get_dcmread_kwargs(args, logger)
+    # (with --auto-tune, a pool is created for each list with the number of workers
+    # chosen by the tuner, which is shared by all list files)
+    pool, tuner = None, None
+    if args.auto_tune:
+        tuner = create_auto_tuner(args, logger)
+    else:
+        pool = create_worker_pool(
+            args.n_threads,
+            args.max_tasks_per_child,
+            get_worker_options_from_args(args, logger, kwargs, exclude_tags),
+        )
+
+    try:
+        for root, _, files in os.walk(args.path):
+            for file in files:
+                # get absolute path of file
+                tic = time.perf_counter()
+                file_orig = os.path.join(root, file)
+                file_dest = os.path.join(args.temp_folder, file)
+                file_done = os.path.join(args.output_done, file)
+                shutil.move(file_orig, file_dest)
+
+                args.input_dcm_list = file_dest
+                process(args, pool, tuner)
+                shutil.move(file_dest, file_done)
+                toc = time.perf_counter()
+                # Compute total elapsed time
+                total_time = toc - tic
+
+                logger.info(f"Run summary:")
+                logger.info(f"Total time: {total_time:.2f} sec.")
+    finally:
+        close_worker_pool(pool)
 
     logger.info("Finished!")
 
@@ -17,74 +17,156 @@
 
 import argparse
 
+from dicom2elk.core.dicom.tags import parse_tag
 from dicom2elk.info import __copyright__, __packagename__, __version__
+from dicom2elk.utils.throttle import parse_throttle_schedule
 
 
-def get_file2json_parser():
-    parser = argparse.ArgumentParser(
-        "dicom2elk: A simple and fast package that extracts relevant tags from dicom files "
-        "and uploads them in JSON format to elasticsearch.",
-        formatter_class=argparse.RawTextHelpFormatter,
-    )
+def add_output_arguments(parser: argparse.ArgumentParser):
+    """Add the arguments of the output modes shared by file2json and dicom2elk.
+
+    Args:
+        parser (argparse.ArgumentParser): Parser to which the arguments are added.
+    """
     parser.add_argument(
-        "-p1",
-        "--path",
+        "-m",
+        "--mode",
         type=str,
-        required=True,
-        help="The path to start exploring.",
+        default="json",
+        choices=["json", "elasticsearch", "ndjson", "parquet"],
+        help="Specify the mode to use for saving the extracted metadata tags."
+        "Can be either 'json', 'elasticsearch', 'ndjson' or 'parquet'. With 'ndjson', the "
+        "documents are appended as compact lines to rolling shard files in the output "
+        "directory, which appear under their final name "
+        "('<list name>-<date>-<pid>-<index>.ndjson[.gz|.zst]') only once complete. With "
+        "'parquet', the included tags of the config file (or the tags of all presets) are "
+        "flattened into typed columns named after their DICOM keyword and written with a row "
+        "group per batch to '<list name>-<date>-<pid>.parquet' in the output directory "
+        "(requires the 'pyarrow' package, cannot be used with --resume and --incremental)",
     )
     parser.add_argument(
-        "-e",
-        "--output-err",
+        "--json-layout",
         type=str,
-        required=True,
-        help="Specify an output directory to save the error file. ",
+        default="flat",
+        choices=["flat", "hashed", "hierarchy"],
+        help="Layout of the JSON files in the output directory in 'json' mode. 'flat' writes "
+        "all files in the output directory, 'hashed' in two levels of directories named "
+        "after the hash of the SOPInstanceUID (e.g. 'ab/cd/<SOPInstanceUID>.json') and "
+        "'hierarchy' in a directory per study and series "
+        "('<StudyInstanceUID>/<SeriesInstanceUID>/<SOPInstanceUID>.json'). The path of each "
+        "file is recorded in a manifest named after the input dicom list file with the suffix "
+        "'.manifest.tsv' in the output directory.",
+    )
+    parser.add_argument(
+        "--ndjson-compression",
+        type=str,
+        default="none",
+        choices=["none", "gzip", "zstd"],
+        help="Compression of the NDJSON shards in 'ndjson' mode "
+        "('zstd' requires the 'zstandard' package).",
     )
     parser.add_argument(
-        "-d ",
-        "--output-done",
-        type=str,
-        required=True,
-        help="Specify an output directory to save the parsed file list. ",
+        "--shard-max-size",
+        type=float,
+        default=256,
+        help="Maximum size in MB (before compression) of an NDJSON shard in 'ndjson' mode. "
+        "The last shard is closed at the end of the run, and the batches are recorded "
+        "as completed (see --resume) once their documents are in closed shards.",
     )
     parser.add_argument(
-        "-t",
-        "--temp-folder",
-        type=str,
-        required=True,
-        help="Specify a temp directory to work. ",
+        "--shard-max-documents",
+        type=int,
+        default=None,
+        help="Maximum number of documents of an NDJSON shard in 'ndjson' mode. "
+        "By default, the shards are only limited by their size.",
     )
     parser.add_argument(
-        "-i",
-        "--input-dcm-list",
+        "--parquet-compression",
         type=str,
-        required=False,  # not mandatory
-        help="Text file providing a list of dicom files to process",
+        default="snappy",
+        choices=["none", "snappy", "gzip", "zstd"],
+        help="Compression of the Parquet file in 'parquet' mode.",
     )
     parser.add_argument(
-        "-c",
-        "--config",
+        "--es-document-format",
         type=str,
-        help="Config file in JSON format which defines all variables related to "
-        "Elasticsearch instance (url, port, index, user, pwd)",
+        default="dicom-json",
+        choices=["dicom-json", "flattened"],
+        help="Format of the documents indexed in 'elasticsearch' mode. 'dicom-json' indexes "
+        "the DICOM JSON Model as extracted. 'flattened' names the fields after the DICOM "
+        "keywords, unwraps single values, converts DA/DT/TM values to dates and IS/DS values "
+        "to numbers and reduces person names to strings, which keeps the mapping small "
+        "and allows range queries.",
     )
     parser.add_argument(
-        "-o",
-        "--output-dir",
+        "--no-index-template",
+        action="store_true",
+        help="When specified in 'elasticsearch' mode, the index template 'dicom2elk-<index>' "
+        "is not put. By default, it maps the extracted tags with types given by their VR "
+        "and does not map the fields of the private tags, and the index is created with it "
+        "if it does not exist.",
+    )
+    parser.add_argument(
+        "--keep-index-settings",
+        action="store_true",
+        help="When specified in 'elasticsearch' mode, the settings of the index are not "
+        "changed. By default, the refresh and the replicas of the index are disabled "
+        "during the run ('refresh_interval: -1', 'number_of_replicas: 0'), then the "
+        "original settings are restored and the index is refreshed when the run ends, "
+        "even if it fails.",
+    )
+    parser.add_argument(
+        "--bulk-chunk-size",
+        type=int,
+        default=500,
+        help="Maximum number of documents of each bulk request in 'elasticsearch' mode.",
+    )
+    parser.add_argument(
+        "--bulk-max-size",
+        type=float,
+        default=10,
+        help="Maximum size in MB of each bulk request in 'elasticsearch' mode. The requests "
+        "are built as the documents are sent, so that large documents do not exceed the "
+        "maximum request size of the cluster.",
+    )
+    parser.add_argument(
+        "--bulk-max-retries",
+        type=int,
+        default=5,
+        help="Maximum number of times a document rejected by Elasticsearch because it is "
+        "overloaded (status 429 or 503) is sent again, with an exponential backoff. "
+        "The documents that fail for other reasons are logged and counted in the summary.",
+    )
+    parser.add_argument(
+        "--es-id-scheme",
         type=str,
-        required=True,
-        help="Specify an output directory to save the log file. "
-        "If `--mode json` is specified, all JSON files are also saved in this directory",
+        default="sop-instance-uid",
+        choices=["sop-instance-uid", "sop-instance-uid-filepath"],
+        help="Scheme of the _id of the documents in 'elasticsearch' mode. "
+        "'sop-instance-uid' uses the SOPInstanceUID of the file (or a hash of its path "
+        "if it has none), so that each instance is indexed once. 'sop-instance-uid-filepath' "
+        "uses a hash of the SOPInstanceUID and the path of the file, so that the copies "
+        "of an instance are different documents. The _id does not depend on the run, so "
+        "that runs can be repeated, and run in parallel, without duplicating documents.",
     )
     parser.add_argument(
-        "-m",
-        "--mode",
+        "--es-op-type",
         type=str,
-        default="json",
-        choices=["json", "elasticsearch"],
-        help="Specify the mode to use for saving the extracted metadata tags."
-        "Can be either 'json' or 'elasticsearch'",
+        default="index",
+        choices=["index", "create", "update"],
+        help="Operation of the bulk actions in 'elasticsearch' mode. 'index' replaces the "
+        "existing documents. 'create' leaves them unchanged (they are counted in the "
+        "summary), so that a repeated run only indexes the new documents. 'update' "
+        "updates the fields of the existing documents and creates the missing ones.",
     )
+
+
+def add_processing_arguments(parser: argparse.ArgumentParser):
+    """Add the arguments of the workers and of the throttle shared by file2json and dicom2elk.
+
+    Args:
+        parser (argparse.ArgumentParser): Parser to which the arguments are added.
+    """
     parser.add_argument(
         "-l",
         "--log-level",
@@ -108,22 +190,175 @@ def get_file2json_parser():
         help="Batch size for extracting and saving/uploading "
         "metadata tags from dicom files",
     )
+    parser.add_argument(
+        "--max-tasks-per-child",
+        type=int,
+        default=None,
+        help="Number of tasks (chunks of files) after which a worker process is replaced "
+        "by a fresh one to contain memory leaks. By default, worker processes are kept "
+        "for the whole run.",
+    )
     parser.add_argument(
         "-p",
         "--process-handler",
         type=str,
         default="multiprocessing",
-        choices=["multiprocessing", "asyncio"],
+        choices=["multiprocessing", "asyncio", "threads"],
         help="Process handler to use for parallel/asynchronous processing. "
-        "Can be either 'multiprocessing' or 'asyncio'",
+        "Can be either 'multiprocessing', 'asyncio' or 'threads'. "
+        "With 'threads', each process (see --n-threads) reads and processes the files "
+        "with a pool of --io-threads threads, which suits network storage (NFS, SMB). "
+        "With 'asyncio', the files are read and parsed in the --n-threads worker "
+        "processes (or in --io-threads threads with a single process) while a single "
+        "event loop, in 'elasticsearch' mode, uploads the documents with concurrent "
+        "bulk requests.",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=16,
+        help="Number of threads per process used by the 'threads' process handler "
+        "(or by the 'asyncio' process handler with a single process). "
+        "It can be greater than the number of CPUs as the threads mostly wait for I/O.",
+    )
+    parser.add_argument(
+        "--sink-threads",
+        type=int,
+        default=1,
+        help="Number of threads that upload the extracted documents to Elasticsearch "
+        "while the next files are extracted (ignored by the 'asyncio' process handler).",
+    )
+    parser.add_argument(
+        "--sink-queue-size",
+        type=int,
+        default=4,
+        help="Maximum number of chunks of documents waiting to be uploaded. When the queue "
+        "is full, the extraction waits for the upload threads.",
     )
     parser.add_argument(
         "-s",
         "--sleep-time-ms",
         type=float,
         default=0,
-        help="Sleep time in milliseconds to wait between each file processing. "
-        "This might be useful to avoid overloading the system.",
+        help="Sleep time in milliseconds to wait between each file processing in each worker "
+        "(deprecated: use --max-files-per-sec and --max-bytes-per-sec to limit the load "
+        "of the whole run).",
+    )
+    parser.add_argument(
+        "--max-files-per-sec",
+        type=float,
+        default=None,
+        help="Maximum number of dicom files read per second by all workers of the run. "
+        "By default, the reads are not limited.",
+    )
+    parser.add_argument(
+        "--max-bytes-per-sec",
+        type=float,
+        default=None,
+        help="Maximum number of bytes read per second from the storage by all workers "
+        "of the run. By default, the reads are not limited.",
+    )
+    parser.add_argument(
+        "--max-documents-per-sec",
+        type=float,
+        default=None,
+        help="Maximum number of documents sent per second to Elasticsearch by the run. "
+        "By default, the uploads are not limited.",
+    )
+    parser.add_argument(
+        "--throttle-schedule",
+        type=str,
+        default=None,
+        help="Comma-separated windows in 'HH:MM-HH:MM=factor' format (local time) during "
+        "which the --max-*-per-sec limits are multiplied by factor, e.g. "
+        "'07:00-19:00=0.2' to run at 20%% of the limits during clinical hours.",
+    )
+
+
+def add_extraction_arguments(parser: argparse.ArgumentParser):
+    """Add the arguments of the reading of the dicom files shared by file2json and dicom2elk.
+
+    Args:
+        parser (argparse.ArgumentParser): Parser to which the arguments are added.
+    """
+    parser.add_argument(
+        "--bulk-data-threshold",
+        type=int,
+        default=None,
+        help="Size in bytes above which the value of a binary element (OB, OW, UN, ...) "
+        "is not read and is replaced by a stub with a 'BulkDataURI' pointing to the dicom file. "
+        "By default, all values are base64-encoded in the output.",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="pydicom",
+        choices=["pydicom", "raw"],
+        help="Engine used to read the dicom files. The 'raw' engine scans the element "
+        "headers of Explicit VR Little Endian files without building a full pydicom dataset "
+        "and falls back to 'pydicom' for other files (implicit VR, big endian, deflate, "
+        "malformed).",
+    )
+    parser.add_argument(
+        "--stop-tag",
+        type=parse_tag,
+        default=None,
+        help="DICOM keyword or tag (e.g. '(7FE0,0010)') at which the 'raw' engine stops "
+        "reading the files. By default, it stops before the pixel data.",
+    )
+
+
+def add_run_arguments(parser: argparse.ArgumentParser):
+    """Add the arguments of the resume, cache and profiling of the runs of file2json and dicom2elk.
+
+    Args:
+        parser (argparse.ArgumentParser): Parser to which the arguments are added.
+    """
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="When specified, the batches recorded as completed in the journal of a previous "
+        "run (a file named after the input dicom list file with the suffix '.journal' in the "
+        "specified `output_dir` directory) are skipped. The batch size must be the same.",
+    )
+    parser.add_argument(
+        "--auto-tune",
+        action="store_true",
+        help="When specified, the run starts with 1 worker and small batches and adjusts the "
+        "number of workers and the batch size after each batch to maximize the measured "
+        "throughput (files/sec.). --n-threads and --batch-size are then the upper limits. "
+        "The chosen values are logged and written to the profile TSV file. "
+        "It cannot be used with --resume.",
+    )
+    parser.add_argument(
+        "--auto-tune-max-memory",
+        type=float,
+        default=None,
+        help="Maximum memory in MB used by the run (main and worker processes) "
+        "when --auto-tune is specified. By default, the memory is not limited.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="When specified, the files whose size and modification time have not changed "
+        "since their last successful extraction with the same mode and output directory "
+        "(or index in 'elasticsearch' mode) are skipped. The fingerprints of the files are "
+        "stored in the SQLite database specified by --cache-db.",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="When specified in 'elasticsearch' mode, the documents whose content hash is "
+        "the same as at their last upload to the same index (stored by index and _id in "
+        "the database specified by --cache-db) are not sent again.",
+    )
+    parser.add_argument(
+        "--cache-db",
+        type=str,
+        default=None,
+        help="SQLite database of the fingerprints used by --incremental and of the "
+        "content hashes used by --skip-unchanged. "
+        "Defaults to 'dicom2elk.cache.db' in the specified `output_dir` directory.",
     )
     parser.add_argument(  # boolean option to perform or not memory profiling
         "--profile",
@@ -139,34 +374,60 @@ def get_file2json_parser():
         default=None,
         help="Specify a TSV file to save mem/perf profiling results.",
     )
-    parser.add_argument(
-        "-v",
-        "--version",
-        action="version",
-        version=f"{__packagename__} {__version__}\n\n{__copyright__}",
-    )
-    return parser
 
 
-def get_dicom2elk_parser():
+def get_file2json_parser():
     parser = argparse.ArgumentParser(
         "dicom2elk: A simple and fast package that extracts relevant tags from dicom files "
         "and uploads them in JSON format to elasticsearch.",
         formatter_class=argparse.RawTextHelpFormatter,
     )
+    parser.add_argument(
+        "-p1",
+        "--path",
+        type=str,
+        required=True,
+        help="The path to start exploring.",
+    )
+    parser.add_argument(
+        "-e",
+        "--output-err",
+        type=str,
+        required=True,
+        help="Specify an output directory to save the error files. "
+        "The files that could not be read are recorded in NDJSON format "
+        "(one JSON object per line with 'path', 'exception', 'message' and 'elapsed').",
+    )
+    parser.add_argument(
+        "-d ",
+        "--output-done",
+        type=str,
+        required=True,
+        help="Specify an output directory to save the parsed file list. ",
+    )
+    parser.add_argument(
+        "-t",
+        "--temp-folder",
+        type=str,
+        required=True,
+        help="Specify a temp directory to work. ",
+    )
     parser.add_argument(
         "-i",
         "--input-dcm-list",
         type=str,
-        required=True,
-        help="Text file providing a list of dicom files to process",
+        required=False,  # not mandatory
+        help="Text file providing a list of dicom files to process. The error file "
+        "of a previous run ('.errors.ndjson') can be given to retry the files that "
+        "could not be read.",
     )
     parser.add_argument(
         "-c",
         "--config",
         type=str,
         help="Config file in JSON format which defines all variables related to "
-        "Elasticsearch instance (url, port, index, user, pwd)",
+        "Elasticsearch instance (url, port, index, user, pwd) and optionally "
+        "the selection of tags to extract (\"tags\": {\"include\": [...], \"exclude\": [...]})",
     )
     parser.add_argument(
         "-o",
@@ -176,69 +437,55 @@ def get_dicom2elk_parser():
         help="Specify an output directory to save the log file. "
         "If `--mode json` is specified, all JSON files are also saved in this directory",
     )
+    add_output_arguments(parser)
+    add_processing_arguments(parser)
+    add_extraction_arguments(parser)
+    add_run_arguments(parser)
     parser.add_argument(
-        "-m",
-        "--mode",
-        type=str,
-        default="json",
-        choices=["json", "elasticsearch"],
-        help="Specify the mode to use for saving the extracted metadata tags."
-        "Can be either 'json' or 'elasticsearch'",
-    )
-    parser.add_argument(
-        "-l",
-        "--log-level",
-        type=str,
-        default="INFO",
-        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
-        help="Logging level",
-    )
-    parser.add_argument(
-        "-n",
-        "--n-threads",
-        type=int,
-        default=1,
-        help="Number of threads to use for parallel processing",
+        "-v",
+        "--version",
+        action="version",
+        version=f"{__packagename__} {__version__}\n\n{__copyright__}",
     )
-    parser.add_argument(
-        "-b",
-        "--batch-size",
-        type=int,
-        default=10000,
-        help="Batch size for extracting and saving/uploading "
-        "metadata tags from dicom files",
+    return parser
+
+
+def get_dicom2elk_parser():
+    parser = argparse.ArgumentParser(
+        "dicom2elk: A simple and fast package that extracts relevant tags from dicom files "
+        "and uploads them in JSON format to elasticsearch.",
+        formatter_class=argparse.RawTextHelpFormatter,
     )
     parser.add_argument(
-        "-p",
-        "--process-handler",
+        "-i",
+        "--input-dcm-list",
         type=str,
-        default="multiprocessing",
-        choices=["multiprocessing", "asyncio"],
-        help="Process handler to use for parallel/asynchronous processing. "
-        "Can be either 'multiprocessing' or 'asyncio'",
+        required=True,
+        help="Text file providing a list of dicom files to process. The error file "
+        "of a previous run ('.errors.ndjson') can be given to retry the files that "
+        "could not be read.",
     )
     parser.add_argument(
-        "-s",
-        "--sleep-time-ms",
-        type=float,
-        default=0,
-        help="Sleep time in milliseconds to wait between each file processing. "
-        "This might be useful to avoid overloading the system.",
-    )
-    parser.add_argument(  # boolean option to perform or not memory profiling
-        "--profile",
-        action="store_true",
-        help="When specified, performance / memory profiling is performed and results are saved. "
-        "If --profile-tsv is specified, results are saved in the specified TSV file. "
-        "Otherwise, results are saved in a TSV file named after the input dicom list file "
-        "with the suffix '.profile.tsv' in the specified `output_dir` directory.",
+        "-c",
+        "--config",
+        type=str,
+        help="Config file in JSON format which defines all variables related to "
+        "Elasticsearch instance (url, port, index, user, pwd) and optionally "
+        "the selection of tags to extract (\"tags\": {\"include\": [...], \"exclude\": [...]})",
     )
     parser.add_argument(
-        "--profile-tsv",
+        "-o",
+        "--output-dir",
         type=str,
-        default=None,
-        help="Specify a TSV file to save mem/perf profiling results.",
+        required=True,
+        help="Specify an output directory to save the log file and the error file "
+        "('.errors.ndjson'). If `--mode json` is specified, all JSON files are also "
+        "saved in this directory",
     )
+    add_output_arguments(parser)
+    add_processing_arguments(parser)
+    add_extraction_arguments(parser)
+    add_run_arguments(parser)
     parser.add_argument(
         "-v",
         "--version",
@@ -248,6 +495,55 @@ def get_dicom2elk_parser():
     return parser
 
 
+def validate_args(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    """Check the arguments of `get_file2json_parser` and `get_dicom2elk_parser`.
+
+    Args:
+        parser (argparse.ArgumentParser): Parser of the arguments, whose `error`
+                                          method exits with a usage message.
+        args (argparse.Namespace): Parsed command line arguments.
+    """
+    if not args.profile and args.profile_tsv is not None:
+        parser.error(
+            "The following argument is required when --profile-tsv is specified: --profile"
+        )
+    if args.io_threads < 1:
+        parser.error("--io-threads must be greater than 0")
+    if args.sink_threads < 1 or args.sink_queue_size < 1:
+        parser.error("--sink-threads and --sink-queue-size must be greater than 0")
+    if any(
+        limit is not None and limit <= 0
+        for limit in (
+            args.max_files_per_sec,
+            args.max_bytes_per_sec,
+            args.max_documents_per_sec,
+        )
+    ):
+        parser.error(
+            "--max-files-per-sec, --max-bytes-per-sec and --max-documents-per-sec "
+            "must be greater than 0"
+        )
+    try:
+        parse_throttle_schedule(args.throttle_schedule)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.auto_tune and args.resume:
+        parser.error("--auto-tune cannot be used with --resume")
+    if args.auto_tune_max_memory is not None and args.auto_tune_max_memory <= 0:
+        parser.error("--auto-tune-max-memory must be greater than 0")
+    if args.shard_max_size <= 0 or (
+        args.shard_max_documents is not None and args.shard_max_documents < 1
+    ):
+        parser.error("--shard-max-size and --shard-max-documents must be greater than 0")
+    if args.bulk_chunk_size < 1 or args.bulk_max_size <= 0:
+        parser.error("--bulk-chunk-size and --bulk-max-size must be greater than 0")
+    if args.bulk_max_retries < 0:
+        parser.error("--bulk-max-retries must be greater than or equal to 0")
+    if args.mode == "parquet" and (args.resume or args.incremental):
+        # The batches are only saved once the Parquet file is complete
+        parser.error("--mode parquet cannot be used with --resume and --incremental")
+
+
 def get_file2list_parser():
     parser = argparse.ArgumentParser(
         "file2list: A simple and fast package that explore a path and list all file it found in its way ",
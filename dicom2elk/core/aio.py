@@ -0,0 +1,284 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides an asyncio engine to extract and upload the metadata of DICOM files.
+
+Within a single event loop, each file is:
+
+1. read up to its pixel data and parsed in a pool of worker processes (or in a
+   thread if no pool is given),
+2. uploaded to Elasticsearch with `AsyncElasticsearch` by chunks of documents,
+
+so that the I/O, CPU and network work of different files overlap. Only the path
+of a file is sent to the worker processes, which read it as the other process
+handlers do (e.g. without its pixel data and bulk data values, see
+`dicom2elk.core.dicom.metadata.extract_metadata_from_dcm`). Semaphores bound the
+number of parses and bulk requests in flight.
+
+The event loop, its threads and the asyncio client are created once per run by
+`AsyncEngine` and reused by the lists (batches) of files of the run.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.pool import Pool as PoolType
+
+import tqdm
+
+from elasticsearch import AsyncElasticsearch
+
+from dicom2elk.core.elasticsearch.api import (
+    BULK_CHUNK_SIZE,
+    get_index_target,
+    send_bulk_to_elasticsearch_async,
+)
+from dicom2elk.core.elasticsearch.client import (
+    create_async_elasticsearch_client,
+    ensure_index,
+    get_elasticsearch_client,
+)
+from dicom2elk.core.elasticsearch.documents import get_index_mappings
+from dicom2elk.utils.logging import create_logger
+from dicom2elk.utils.throttle import Throttle
+
+
+# Maximum number of bulk requests in flight
+MAX_BULK_REQUESTS = 2
+
+
+class AsyncEngine:
+    """Event loop and asyncio client shared by the lists of files of a run.
+
+    The files are parsed in the threads of the default executor of the event loop
+    if no pool of worker processes is used.
+    If a config file is given, the index is checked once with the client of the
+    process (see `dicom2elk.core.elasticsearch.client.ensure_index`), then the
+    documents of all lists are uploaded with the same asyncio client.
+
+    The engine must be closed once the run ends (it can be used as a context manager).
+
+    Args:
+        io_threads (int): Number of threads that parse the files. Defaults to 16.
+        config (str): Path to config file in JSON format which defines all variables
+                      related to Elasticsearch instance (url, port, index, user, pwd).
+                      If None, the documents are not uploaded.
+        logger (logging.Logger): Logger instance.
+        document_format (str): Format of the indexed documents, which defines the
+                               mappings of the index if it is created.
+    """
+
+    def __init__(
+        self,
+        io_threads: int = 16,
+        config: str = None,
+        logger: logging.Logger = create_logger("INFO"),
+        document_format: str = "dicom-json",
+    ):
+        self.loop = asyncio.new_event_loop()
+        # Threads used by `asyncio.to_thread` to parse the files
+        self.loop.set_default_executor(ThreadPoolExecutor(io_threads))
+        self.es, self.index, self.target = None, None, None
+        if config is not None:
+            try:
+                es, es_config = get_elasticsearch_client(config)
+                self.index = es_config["index"]
+                self.target = get_index_target(es_config)
+                ensure_index(es, self.index, get_index_mappings(document_format), logger)
+                self.es = self.run(_create_async_client(es_config))
+            except BaseException:
+                self.close()
+                raise
+
+    def run(self, coroutine):
+        """Run a coroutine in the event loop of the engine.
+
+        Args:
+            coroutine (coroutine): Coroutine to run (e.g. returned by
+                                   `extract_metadata_from_dcm_list_async`).
+
+        Returns:
+            object: Result of the coroutine.
+        """
+        return self.loop.run_until_complete(coroutine)
+
+    def close(self):
+        """Close the asyncio client, the threads and the event loop of the engine."""
+        try:
+            if self.es is not None:
+                self.run(self.es.close())
+                self.es = None
+            self.run(self.loop.shutdown_default_executor())
+        finally:
+            self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+async def _create_async_client(config: dict):
+    # The client is created in the event loop in which it is used
+    return create_async_elasticsearch_client(config)
+
+
+def _run_in_pool(pool: PoolType, func, *args):
+    """Run a function in a pool of worker processes and return an awaitable future."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _set_result(result):
+        if not future.done():
+            future.set_result(result)
+
+    def _set_exception(exception):
+        if not future.done():
+            future.set_exception(exception)
+
+    # The callbacks are called from the result handler thread of the pool
+    pool.apply_async(
+        func,
+        args,
+        callback=lambda result: loop.call_soon_threadsafe(_set_result, result),
+        error_callback=lambda e: loop.call_soon_threadsafe(_set_exception, e),
+    )
+    return future
+
+
+async def extract_metadata_from_dcm_list_async(
+    dcm_list: list,
+    parse_function,
+    pool: PoolType = None,
+    es: AsyncElasticsearch = None,
+    index: str = None,
+    target: str = None,
+    io_threads: int = 16,
+    max_parses: int = 2,
+    max_bulk_requests: int = MAX_BULK_REQUESTS,
+    bulk_chunk_size: int = BULK_CHUNK_SIZE,
+    throttle: Throttle = None,
+    logger: logging.Logger = create_logger("INFO"),
+    document_format: str = "dicom-json",
+    bulk_options: dict = None,
+    stats: dict = None,
+    failed_files: list = None,
+):
+    """Extract the metadata of a list of DICOM files and upload them with asyncio.
+
+    Args:
+        dcm_list (list): List of dicom files to process.
+        parse_function (callable): Function called with the path of a file that reads it
+                                   and returns the path, the result of
+                                   `extract_metadata_from_dcm` and its dictionary of counters.
+                                   If `pool` is given, it must be picklable
+                                   (e.g. `extract_metadata_from_dcm_worker`).
+        pool (multiprocessing.pool.Pool): Pool of worker processes that parse the files.
+                                          If None, the files are parsed in threads.
+        es (elasticsearch.AsyncElasticsearch): Asyncio client to which the documents are
+                                               uploaded (e.g. the client of an `AsyncEngine`),
+                                               left open. If None, they are not uploaded.
+        index (str): Name of the index of the documents. Required if `es` is given.
+        target (str): Identifier of the index in the cache of the content hashes
+                      (see `dicom2elk.core.elasticsearch.api.get_index_target`).
+                      Defaults to `index`.
+        io_threads (int): Maximum number of files parsed at the same time in threads
+                          if `pool` is None. Defaults to 16.
+        max_parses (int): Maximum number of files sent at the same time to `pool`.
+                          Defaults to 2.
+        max_bulk_requests (int): Maximum number of bulk requests in flight.
+                                 Defaults to `MAX_BULK_REQUESTS`.
+        bulk_chunk_size (int): Number of documents sent in each bulk request.
+                               Defaults to `BULK_CHUNK_SIZE`.
+        throttle (dicom2elk.utils.throttle.Throttle): Throttle that limits the documents
+                                                      sent per second. The files are
+                                                      throttled by `parse_function`.
+                                                      Defaults to None.
+        logger (logging.Logger): Logger object.
+        document_format (str): Format of the documents indexed in 'elasticsearch' mode,
+                               'dicom-json' or 'flattened' (see
+                               `dicom2elk.core.elasticsearch.documents`).
+        bulk_options (dict): Keyword arguments of `send_bulk_to_elasticsearch_async`
+                             that define the bulk requests (e.g. "max_chunk_bytes",
+                             "max_retries", "op_type"). Defaults to None.
+        stats (dict): Dictionary of counters that is updated in place with the counters
+                      of the uploads (e.g. "es_documents_indexed"). Defaults to None.
+        failed_files (list): List to which the paths of the files whose document could
+                             not be indexed are appended. Defaults to None.
+
+    Returns:
+        list: List of tuples returned by `parse_function`, in order of completion.
+    """
+    parse_semaphore = asyncio.Semaphore(max_parses if pool is not None else io_threads)
+    bulk_semaphore = asyncio.Semaphore(max_bulk_requests)
+
+    results = []
+    pending_docs = []
+    bulk_tasks = []
+    progress = tqdm.tqdm(
+        total=len(dcm_list), desc="Extracting and saving tags", unit="file"
+    )
+
+    async def upload(docs):
+        if throttle is not None:
+            await asyncio.sleep(throttle.reserve_documents(len(docs)))
+        async with bulk_semaphore:
+            bulk_stats = await send_bulk_to_elasticsearch_async(
+                es,
+                docs,
+                index,
+                logger,
+                document_format,
+                hash_target=target,
+                **(bulk_options or {}),
+            )
+        failed = bulk_stats.pop("failed_files", [])
+        if failed_files is not None:
+            failed_files.extend(failed)
+        if stats is not None:
+            for key, value in bulk_stats.items():
+                stats[key] = stats.get(key, 0) + value
+
+    async def process_file(dcm_file):
+        async with parse_semaphore:
+            if pool is not None:
+                result = await _run_in_pool(pool, parse_function, dcm_file)
+            else:
+                result = await asyncio.to_thread(parse_function, dcm_file)
+
+        results.append(result)
+        progress.update()
+        if es is not None and result[1] is not None:
+            pending_docs.append(result[1])
+            if len(pending_docs) >= bulk_chunk_size:
+                bulk_tasks.append(asyncio.create_task(upload(pending_docs[:])))
+                pending_docs.clear()
+
+    file_tasks = [asyncio.create_task(process_file(dcm_file)) for dcm_file in dcm_list]
+    try:
+        await asyncio.gather(*file_tasks)
+        if pending_docs:
+            bulk_tasks.append(asyncio.create_task(upload(pending_docs[:])))
+        await asyncio.gather(*bulk_tasks)
+    finally:
+        progress.close()
+        # If a file or an upload failed, the other tasks are cancelled and awaited
+        # so that none of them is left running once the coroutine returns
+        tasks = file_tasks + bulk_tasks
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return results
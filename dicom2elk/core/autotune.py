@@ -0,0 +1,237 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides the auto-tuning of the number of workers and of the batch size.
+
+With `--auto-tune`, a run starts with a single worker and small batches.
+After each batch, the throughput (files/sec.) and the memory used by the
+run are measured and the configuration is adjusted by hill-climbing:
+
+* the number of workers or the batch size is doubled or halved, one at a time,
+* a new configuration is kept only if its throughput is higher than the throughput
+  of the best configuration by more than a margin (hysteresis), so that
+  the measurement noise does not make the configuration oscillate,
+* once no move improves the throughput, the best configuration is kept for
+  the rest of the run.
+
+The configuration never exceeds the limits given by the user (`--n-threads`,
+`--batch-size` and `--auto-tune-max-memory`). A configuration that exceeds
+the memory limit is reverted and the limit of the parameter is lowered.
+"""
+
+import logging
+from itertools import islice
+
+import psutil
+
+from dicom2elk.utils.logging import create_logger
+
+
+# Batch size of the first batch of an auto-tuned run
+AUTO_TUNE_START_BATCH_SIZE = 100
+
+# Minimum relative gain of throughput for a new configuration to be kept
+AUTO_TUNE_HYSTERESIS = 0.1
+
+# Moves tried from the best configuration: parameter and factor
+AUTO_TUNE_MOVES = (
+    ("n_threads", 2),
+    ("batch_size", 2),
+    ("n_threads", 0.5),
+    ("batch_size", 0.5),
+)
+
+
+def get_memory_usage():
+    """Get the memory used by the current process and its children (e.g. pool workers).
+
+    Returns:
+        int: Resident set size in bytes.
+    """
+    process = psutil.Process()
+    memory = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            memory += child.memory_info().rss
+        except psutil.Error:
+            # The child exited in the meantime
+            pass
+    return memory
+
+
+class AutoTuner:
+    """Hill-climbing over the number of workers and the batch size of a run.
+
+    Args:
+        max_n_threads (int): Maximum number of worker processes.
+        max_batch_size (int): Maximum batch size.
+        max_memory (int): Maximum memory in bytes used by the run (see `get_memory_usage`).
+                          If None, the memory is not limited.
+        start_n_threads (int): Number of workers of the first batch. Defaults to 1.
+        start_batch_size (int): Size of the first batch. Defaults to `AUTO_TUNE_START_BATCH_SIZE`.
+        hysteresis (float): Minimum relative gain of throughput for a new configuration
+                            to be kept. Defaults to `AUTO_TUNE_HYSTERESIS`.
+        logger (logging.Logger): Logger instance.
+
+    Note:
+        The configuration of the next batch is given by the `n_threads` and `batch_size`
+        attributes, which are updated by `update` after each batch. The batches
+        can be built with `iter_batches`.
+    """
+
+    def __init__(
+        self,
+        max_n_threads: int,
+        max_batch_size: int,
+        max_memory: int = None,
+        start_n_threads: int = 1,
+        start_batch_size: int = AUTO_TUNE_START_BATCH_SIZE,
+        hysteresis: float = AUTO_TUNE_HYSTERESIS,
+        logger: logging.Logger = create_logger("INFO"),
+    ):
+        self.limits = {
+            "n_threads": max(max_n_threads, 1),
+            "batch_size": max(max_batch_size, 1),
+        }
+        self.max_memory = max_memory
+        self.hysteresis = hysteresis
+        self.logger = logger
+        self.config = {
+            "n_threads": min(max(start_n_threads, 1), self.limits["n_threads"]),
+            "batch_size": min(max(start_batch_size, 1), self.limits["batch_size"]),
+        }
+        # Best configuration and its throughput (files/sec.)
+        self.best_config = None
+        self.best_throughput = 0.0
+        # Move under trial and moves left to try from the best configuration
+        self._move = None
+        self._moves = list(AUTO_TUNE_MOVES)
+        self.converged = False
+
+    @property
+    def n_threads(self):
+        """Number of worker processes of the next batch."""
+        return self.config["n_threads"]
+
+    @property
+    def batch_size(self):
+        """Size of the next batch."""
+        return self.config["batch_size"]
+
+    def iter_batches(self, file_list):
+        """Yield batches of files whose size is the batch size at the time they are built.
+
+        Args:
+            file_list (list or iterable): Files to process.
+
+        Yields:
+            list: Batch of files.
+        """
+        file_iterator = iter(file_list)
+        while True:
+            batch = list(islice(file_iterator, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def _apply(self, config: dict, move: tuple):
+        """Get the configuration obtained by applying a move (None if it changes nothing)."""
+        param, factor = move
+        value = min(max(int(config[param] * factor), 1), self.limits[param])
+        if value == config[param]:
+            return None
+        return {**config, param: value}
+
+    def _next_trial(self):
+        """Set the next configuration to try from the best one, or keep it once converged."""
+        if self._move is not None:
+            # Continue in the direction that improved the throughput
+            config = self._apply(self.best_config, self._move)
+            if config is not None:
+                self.config = config
+                return
+        while self._moves:
+            self._move = self._moves.pop(0)
+            config = self._apply(self.best_config, self._move)
+            if config is not None:
+                self.config = config
+                return
+        self._move = None
+        self.config = dict(self.best_config)
+        if not self.converged:
+            self.converged = True
+            self.logger.info(
+                f"Auto-tuning converged: n_threads={self.n_threads}, "
+                f"batch_size={self.batch_size} ({self.best_throughput:.1f} files/sec.)"
+            )
+
+    def update(self, n_files: int, elapsed: float, memory: int = None):
+        """Update the configuration with the measures of the last batch.
+
+        Args:
+            n_files (int): Number of files of the batch.
+            elapsed (float): Time in seconds spent to process the batch.
+            memory (int): Memory in bytes used after the batch (see `get_memory_usage`).
+        """
+        if n_files == 0 or elapsed <= 0:
+            return
+        throughput = n_files / elapsed
+        self.logger.info(
+            f"Auto-tuning: n_threads={self.n_threads}, batch_size={self.batch_size}: "
+            f"{throughput:.1f} files/sec."
+            + (f", {memory / 1024 ** 2:.0f} MB" if memory is not None else "")
+        )
+
+        if self.max_memory is not None and memory is not None and memory > self.max_memory:
+            if self.best_config is not None and self.config != self.best_config:
+                # Revert the configuration under trial and do not exceed the best one
+                param = self._move[0]
+                if self.config[param] > self.best_config[param]:
+                    self.limits[param] = self.best_config[param]
+                self.logger.warning(
+                    f"Auto-tuning: memory limit exceeded, {param} limited to {self.limits[param]}"
+                )
+                self._move = None
+                self._next_trial()
+            else:
+                # Halve the batch size (or the number of workers) and start again
+                param = "batch_size" if self.config["batch_size"] > 1 else "n_threads"
+                self.limits[param] = max(self.config[param] // 2, 1)
+                self.config = {**self.config, param: self.limits[param]}
+                self.logger.warning(
+                    f"Auto-tuning: memory limit exceeded, {param} limited to {self.limits[param]}"
+                )
+                self.best_config, self.best_throughput = None, 0.0
+                self._move = None
+                self._moves = list(AUTO_TUNE_MOVES)
+                self.converged = False
+            return
+
+        if self.best_config is None:
+            self.best_config = dict(self.config)
+            self.best_throughput = throughput
+        elif self.config == self.best_config:
+            # Smooth the measure of the best configuration
+            self.best_throughput = (self.best_throughput + throughput) / 2
+            if self.converged:
+                return
+        elif throughput > self.best_throughput * (1 + self.hysteresis):
+            self.best_config = dict(self.config)
+            self.best_throughput = throughput
+            # Continue with the same move, then try the moves of the other parameter
+            self._moves = [move for move in AUTO_TUNE_MOVES if move[0] != self._move[0]]
+        else:
+            # Revert to the best configuration and try the next move
+            self._move = None
+        self._next_trial()
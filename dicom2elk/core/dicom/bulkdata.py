@@ -0,0 +1,160 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides functions to handle bulk data elements of DICOM files.
+
+Instead of being base64-encoded in the "InlineBinary" attribute, binary elements
+larger than a given threshold are replaced by a stub with a "BulkDataURI" attribute
+(see `DICOM JSON Model <http://dicom.nema.org/medical/dicom/current/output/chtml/part18/sect_F.2.6.html>`_)
+that points to the DICOM file and records the tag and the length of the value.
+"""
+
+import os
+from pathlib import Path
+
+from pydicom import Dataset
+from pydicom.dataelem import RawDataElement
+from pydicom.datadict import dictionary_VR
+
+from dicom2elk.core.dicom.serializer import to_json_dict
+
+
+# Value representations of the binary elements that can be replaced by a stub
+BULK_DATA_VRS = {"OB", "OD", "OF", "OL", "OV", "OW", "UN"}
+
+# Length of the elements encoded with an undefined length
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def get_element_vr(elem):
+    """Get the value representation of a (raw) data element.
+
+    Raw data elements read from files encoded with implicit VR do not have
+    a VR which is then looked up in the DICOM dictionary.
+
+    Args:
+        elem (pydicom.dataelem.DataElement or pydicom.dataelem.RawDataElement): Data element.
+
+    Returns:
+        str: Value representation of the element ("UN" if unknown).
+    """
+    if elem.VR is not None:
+        return elem.VR
+    try:
+        return dictionary_VR(elem.tag)
+    except KeyError:
+        return "UN"
+
+
+def get_bulk_data_uri(dcm_file: str, tag: int, length: int = None):
+    """Build the URI pointing to the value of a bulk data element.
+
+    Args:
+        dcm_file (str): Path to dicom file.
+        tag (int): Tag of the element.
+        length (int): Length in bytes of the value of the element
+                      (None if encoded with an undefined length).
+
+    Returns:
+        str: URI of the form "file:///path/to/file.dcm#tag=00291010&length=1234".
+    """
+    uri = f"{Path(os.path.abspath(dcm_file)).as_uri()}#tag={tag:08X}"
+    if length is not None:
+        uri += f"&length={length}"
+    return uri
+
+
+def stub_deferred_bulk_data_elements(dcm_dataset: Dataset, dcm_file: str):
+    """Replace the deferred bulk data elements at the top level of a dataset by stubs.
+
+    The elements are removed from the dataset without being read so that the
+    deferred read of their value is never triggered.
+
+    Args:
+        dcm_dataset (pydicom.Dataset): Dataset read with `dcmread` and the `defer_size` argument.
+        dcm_file (str): Path to dicom file.
+
+    Returns:
+        tuple: Tuple containing:
+                   * the dictionary of stubs indexed by the hexadecimal tags.
+                   * the number of bytes of the values that have not been read.
+    """
+    stubs = {}
+    bulk_data_bytes = 0
+    for tag in list(dcm_dataset.keys()):
+        elem = dcm_dataset.get_item(tag, keep_deferred=True)
+        # Only deferred raw elements have a None value and a non-null length
+        if not isinstance(elem, RawDataElement) or elem.value is not None:
+            continue
+        if elem.length == 0:
+            continue
+        vr = get_element_vr(elem)
+        if vr not in BULK_DATA_VRS:
+            continue
+        length = elem.length if elem.length != UNDEFINED_LENGTH else None
+        stubs[f"{tag:08X}"] = {
+            "vr": vr,
+            "BulkDataURI": get_bulk_data_uri(dcm_file, tag, length),
+        }
+        bulk_data_bytes += length or 0
+        del dcm_dataset[tag]
+    return stubs, bulk_data_bytes
+
+
+def dataset_to_json_dict(
+    dcm_dataset: Dataset, dcm_file: str, bulk_data_threshold: int = None
+):
+    """Convert a dataset to its DICOM JSON Model representation with bulk data stubs.
+
+    Top-level bulk data elements larger than `bulk_data_threshold` are expected to
+    have been deferred by `dcmread` (`defer_size` argument) and are never read.
+    Bulk data elements nested in sequences are replaced by a stub by the
+    `bulk_data_element_handler` of `dicom2elk.core.dicom.serializer.to_json_dict`.
+
+    Args:
+        dcm_dataset (pydicom.Dataset): Dataset read with `dcmread`.
+        dcm_file (str): Path to dicom file.
+        bulk_data_threshold (int): Size in bytes above which the value of a binary
+                                   element is replaced by a stub. If None, all values
+                                   are base64-encoded in "InlineBinary".
+
+    Returns:
+        tuple: Tuple containing:
+                   * the dictionary representation of the dataset.
+                   * the number of bytes of bulk data that have not been encoded.
+    """
+    if bulk_data_threshold is None:
+        return to_json_dict(dcm_dataset), 0
+
+    stubs, bulk_data_bytes = stub_deferred_bulk_data_elements(dcm_dataset, dcm_file)
+
+    nested_bulk_data_bytes = []
+
+    def bulk_data_element_handler(elem):
+        nested_bulk_data_bytes.append(len(elem.value))
+        return get_bulk_data_uri(dcm_file, elem.tag, len(elem.value))
+
+    # pydicom compares the threshold to the size of the base64-encoded value
+    # which is 4/3 of the size of the raw value
+    json_dict = to_json_dict(
+        dcm_dataset,
+        bulk_data_threshold=(bulk_data_threshold * 4) // 3,
+        bulk_data_element_handler=bulk_data_element_handler,
+    )
+
+    if stubs:
+        json_dict.update(stubs)
+        json_dict = dict(sorted(json_dict.items()))
+
+    return json_dict, bulk_data_bytes + sum(nested_bulk_data_bytes)
@@ -14,17 +14,38 @@
 
 """Module that provides functions to convert DICOM files to JSON files."""
 
-import os
 import tqdm
 import logging
 import time
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from functools import partial
+from itertools import chain
 from multiprocessing import Pool
+from multiprocessing.pool import Pool as PoolType
 
 from pydicom import dcmread
 
-from dicom2elk.utils.io import write_json_file
-from dicom2elk.utils.logging import create_logger, get_logger_basefilename
-from dicom2elk.core.elasticsearch.api import send_bulk_to_elasticsearch
+from dicom2elk.core.aio import AsyncEngine, extract_metadata_from_dcm_list_async
+from dicom2elk.core.dicom.bulkdata import dataset_to_json_dict
+from dicom2elk.core.dicom.raw import PIXEL_DATA_TAG, read_raw_dataset
+from dicom2elk.core.dicom.tags import remove_excluded_tags
+from dicom2elk.utils.io import get_json_file, write_json_file
+from dicom2elk.utils.misc import get_chunksize
+from dicom2elk.utils.errors import get_error_record
+from dicom2elk.utils.throttle import Throttle, get_file_size
+from dicom2elk.utils.logging import (
+    create_logger,
+    init_worker_logging,
+    start_log_listener,
+    stop_log_listener,
+)
+from dicom2elk.core.pipeline import SinkPipeline
+from dicom2elk.core.elasticsearch.api import (
+    BULK_CHUNK_SIZE,
+    send_bulk_to_elasticsearch,
+)
 
 
 def extract_metadata_from_dcm(
@@ -34,29 +55,74 @@ def extract_metadata_from_dcm(
     output_dir: str = None,
     logger: logging.Logger = create_logger("INFO"),
     kwargs: dict = None,
+    exclude_tags: list = None,
+    bulk_data_threshold: int = None,
+    return_stats: bool = False,
+    engine: str = "pydicom",
+    stop_tag: int = None,
+    dcm_bytes: bytes = None,
+    throttle: Throttle = None,
+    json_layout: str = "flat",
 ):
     """Extract relevant tags from dicom file.
 
     Args:
         dcm_file (str): Path to dicom file.
         sleep_time_ms (float): Sleep time in milliseconds to wait after processing
+                               (deprecated, use `throttle` instead).
         mode (str): Mode to use for saving the extracted metadata tags.
-                    Can be either 'json' or 'elasticsearch'.
+                    Can be either 'json', 'elasticsearch', 'ndjson' or 'parquet'. In the other
+                    modes than 'json', the dictionary is returned without being saved.
         output_dir (str): Path to output directory.
         logger (logging.Logger): Logger object.
         kwargs: Arbitrary keyword arguments to pass to the `dcmread` function.
                 In particular, the `stop_before_pixels` argument can be used
-                to stop reading file before reading in pixel data when set to True.
+                to stop reading file before reading in pixel data when set to True,
+                and the `specific_tags` argument can be used to only read the
+                listed tags (see `dicom2elk.core.dicom.tags.get_tag_selection`).
+        exclude_tags (list): List of tags to remove from the dataset before
+                             its conversion (see `dicom2elk.core.dicom.tags.get_tag_selection`).
+        bulk_data_threshold (int): Size in bytes above which the value of a binary element
+                                   is not read and replaced by a "BulkDataURI" stub
+                                   (see `dicom2elk.core.dicom.bulkdata`). If None, all values
+                                   are base64-encoded. Defaults to None.
+        return_stats (bool): If True, also return a dictionary of counters
+                             (e.g. "bulk_data_bytes_skipped"). If the file cannot be
+                             read, it also contains the record of the error under the
+                             "error" key (see `dicom2elk.utils.errors.get_error_record`).
+                             Defaults to False.
+        engine (str): Engine used to read the dicom file. Can be either 'pydicom'
+                      or 'raw' (see `dicom2elk.core.dicom.raw`). The 'raw' engine
+                      falls back to 'pydicom' for files it does not support.
+                      Defaults to 'pydicom'.
+        stop_tag (int): Tag at which the 'raw' engine stops reading the file. If None,
+                        it stops before the pixel data if `stop_before_pixels` is True.
+        dcm_bytes (bytes): Content of the dicom file if it has already been read
+                           (e.g. by the asyncio engine). If None, `dcm_file` is read.
+        throttle (dicom2elk.utils.throttle.Throttle): Throttle shared by the workers
+                                                      that limits the files and bytes read
+                                                      per second. It is not applied if
+                                                      `dcm_bytes` is given.
+        json_layout (str): Layout of the JSON files in `output_dir` in 'json' mode
+                           ('flat', 'hashed' or 'hierarchy', see
+                           `dicom2elk.utils.io.get_json_file`). Defaults to 'flat'.
 
     Returns:
         json_dict (dict) or json_file (str): Dictionary representation of the Dataset conforming
                                              to the DICOM JSON Model as described in the
                                              DICOM Standard, Part 18 (if `output_dir` not specified)
                                              or path to JSON file (if `output_dir` specified).
+                                             If `return_stats` is True, a tuple containing it
+                                             and the dictionary of counters is returned.
 
     Raises:
         ValueError: If `mode` is set to 'json' and `output_dir` is not specified.
-        ValueError: If `mode` is set to 'elasticsearch' and `config` is not specified.
+        ValueError: If `mode` is set to 'json' and `json_layout` is not one of
+                    `dicom2elk.utils.io.JSON_LAYOUTS`.
+
+    Note:
+        The errors raised while reading the file are not raised: they are logged
+        and the file is skipped (see `return_stats`).
     """
     if mode == "json" and output_dir is None:
         raise ValueError("If mode is set to 'json', output_dir must be specified.")
@@ -64,32 +130,187 @@ def extract_metadata_from_dcm(
     if kwargs is None:
         kwargs = {}
 
-    logger.debug(f"Processing {dcm_file}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Processing {dcm_file}")
 
+    kwargs = dict(kwargs)
     stop_before_pixels = kwargs.pop("stop_before_pixels", True)
+    if bulk_data_threshold is not None:
+        kwargs["defer_size"] = bulk_data_threshold
+
+    if throttle is not None and dcm_bytes is None:
+        throttle.wait_file(get_file_size(dcm_file))
+
+    tic = time.perf_counter()
+    stats = {"bulk_data_bytes_skipped": 0, "raw_engine_fallbacks": 0}
+
+    dcm_dataset = None
+    if engine == "raw":
+        if stop_tag is None and stop_before_pixels:
+            stop_tag = PIXEL_DATA_TAG
+        try:
+            dcm_dataset = read_raw_dataset(
+                dcm_file,
+                stop_tag=stop_tag,
+                specific_tags=kwargs.get("specific_tags"),
+                defer_size=kwargs.get("defer_size"),
+                dcm_bytes=dcm_bytes,
+            )
+        except (ValueError, OSError) as e:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Falling back to pydicom for {dcm_file}: {e}")
+            stats["raw_engine_fallbacks"] += 1
 
     try:
-        dcm_dataset = dcmread(dcm_file, stop_before_pixels=stop_before_pixels)
+        if dcm_dataset is None:
+            dcm_dataset = dcmread(
+                dcm_file if dcm_bytes is None else BytesIO(dcm_bytes),
+                stop_before_pixels=stop_before_pixels,
+                **kwargs,
+            )
     except Exception as e:
         logger.error(f"Error while processing {dcm_file}: {e}")
-        log_file = get_logger_basefilename(logger)
-        error_file = log_file.replace('.log', '.errors.txt')
-        logger.info(f"Write error in {error_file}")
-        with open(error_file, "a") as f:
-            f.write(dcm_file)
-        return None
-
-    json_dict = dcm_dataset.to_json_dict()
+        # The error is written by the parent process (see `dicom2elk.utils.errors`)
+        stats["error"] = get_error_record(dcm_file, e, time.perf_counter() - tic)
+        return (None, stats) if return_stats else None
+
+    if exclude_tags:
+        remove_excluded_tags(dcm_dataset, exclude_tags)
+
+    json_dict, stats["bulk_data_bytes_skipped"] = dataset_to_json_dict(
+        dcm_dataset, dcm_file, bulk_data_threshold=bulk_data_threshold
+    )
     json_dict["filepath"] = dcm_file
 
     if mode == "json":
-        file_name = json_dict["00080018"]["Value"][0]
-        json_file = os.path.join(output_dir, file_name + ".json")
-        return write_json_file(json_file, json_dict, sleep_time_ms=sleep_time_ms)
+        json_file = get_json_file(
+            output_dir,
+            json_dict["00080018"]["Value"][0],
+            layout=json_layout,
+            study_instance_uid=json_dict.get("0020000D", {}).get("Value", [None])[0],
+            series_instance_uid=json_dict.get("0020000E", {}).get("Value", [None])[0],
+        )
+        json_file = write_json_file(json_file, json_dict, sleep_time_ms=sleep_time_ms)
+        return (json_file, stats) if return_stats else json_file
 
     time.sleep(sleep_time_ms / 1000.0)  # takes seconds as argument
 
-    return json_dict
+    return (json_dict, stats) if return_stats else json_dict
+
+
+# Options of `extract_metadata_from_dcm` set once in each worker process by `init_worker`
+_worker_options = {}
+
+
+def get_worker_options(
+    mode: str = "json",
+    sleep_time_ms: float = 0.0,
+    output_dir: str = None,
+    logger: logging.Logger = create_logger("INFO"),
+    kwargs: dict = None,
+    exclude_tags: list = None,
+    bulk_data_threshold: int = None,
+    engine: str = "pydicom",
+    stop_tag: int = None,
+    throttle: Throttle = None,
+    json_layout: str = "flat",
+):
+    """Gather the options of `extract_metadata_from_dcm` that are shared by all files of a run.
+
+    See `extract_metadata_from_dcm` for the description of the arguments.
+
+    Returns:
+        dict: Keyword arguments to pass to `extract_metadata_from_dcm`.
+    """
+    return {
+        "mode": mode,
+        "sleep_time_ms": sleep_time_ms,
+        "output_dir": output_dir,
+        "logger": logger,
+        "kwargs": kwargs,
+        "exclude_tags": exclude_tags,
+        "bulk_data_threshold": bulk_data_threshold,
+        "engine": engine,
+        "stop_tag": stop_tag,
+        "throttle": throttle,
+        "json_layout": json_layout,
+    }
+
+
+def init_worker(worker_options: dict, log_queue=None, log_level: int = logging.INFO):
+    """Initialize a worker process with the options returned by `get_worker_options`.
+
+    It is used as `initializer` of the pool of worker processes so that the options
+    (logger, `dcmread` keyword arguments, ...) are sent once per worker instead
+    of once per file.
+
+    Args:
+        worker_options (dict): Keyword arguments to pass to `extract_metadata_from_dcm`.
+        log_queue (multiprocessing.Queue): Queue to which the worker sends its log records
+                                           (see `dicom2elk.utils.logging.start_log_listener`).
+                                           If None, the worker keeps its own handlers.
+        log_level (int): Logging level of the worker if `log_queue` is given.
+    """
+    global _worker_options
+    _worker_options = worker_options
+    if log_queue is not None:
+        init_worker_logging(log_queue, log_level)
+
+
+# Pools of threads of a worker process used by the 'threads' process handler,
+# indexed by their number of threads
+_thread_executors = {}
+
+
+def _extract_metadata_from_dcm_with_path(
+    dcm_file: str, worker_options: dict, dcm_bytes: bytes = None
+):
+    # Keep the path of the file with its result as the results are collected
+    # in their order of completion
+    return (
+        dcm_file,
+        *extract_metadata_from_dcm(
+            dcm_file, return_stats=True, dcm_bytes=dcm_bytes, **worker_options
+        ),
+    )
+
+
+def extract_metadata_from_dcm_worker(dcm_file: str, dcm_bytes: bytes = None):
+    """Extract the metadata of a dicom file in a worker process initialized by `init_worker`.
+
+    Args:
+        dcm_file (str): Path to dicom file.
+        dcm_bytes (bytes): Content of the dicom file if it has already been read.
+
+    Returns:
+        tuple: Tuple containing the path to the dicom file, the result of
+               `extract_metadata_from_dcm` and its dictionary of counters.
+    """
+    return _extract_metadata_from_dcm_with_path(dcm_file, _worker_options, dcm_bytes)
+
+
+def _extract_metadata_from_dcm_threads(
+    executor: ThreadPoolExecutor, dcm_list: list, worker_options: dict
+):
+    """Process files with a pool of threads and yield the results in completion order."""
+    futures = [
+        executor.submit(_extract_metadata_from_dcm_with_path, dcm_file, worker_options)
+        for dcm_file in dcm_list
+    ]
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def _extract_metadata_from_dcm_chunk_worker(task: tuple):
+    # Process a chunk of files with the pool of threads of the worker process
+    dcm_chunk, io_threads = task
+    if io_threads not in _thread_executors:
+        _thread_executors[io_threads] = ThreadPoolExecutor(io_threads)
+    return list(
+        _extract_metadata_from_dcm_threads(
+            _thread_executors[io_threads], dcm_chunk, _worker_options
+        )
+    )
 
 
 def extract_metadata_from_dcm_list(
@@ -101,27 +322,91 @@ def extract_metadata_from_dcm_list(
     n_threads: int = 1,
     sleep_time_ms: float = 0,
     logger: logging.Logger = create_logger("INFO"),
+    worker_options: dict = None,
+    stats: dict = None,
+    pool: PoolType = None,
+    io_threads: int = 16,
+    sink: SinkPipeline = None,
+    async_engine: AsyncEngine = None,
+    processed_files: list = None,
+    errors: list = None,
+    document_format: str = "dicom-json",
+    bulk_options: dict = None,
+    failed_files: list = None,
     **kwargs,
 ):
     """Extract list of dictionary representation of the DICOM files conforming to the DICOM JSON Model.
 
-    It uses the `to_json_dict` method of the pydicom package.
+    Each file is converted by `dicom2elk.core.dicom.bulkdata.dataset_to_json_dict`, which
+    produces the same output as the `to_json_dict` method of the pydicom package with
+    its bulk data elements replaced by stubs.
 
-    It can be parallelized using the `n_threads` argument which leverages the asyncio package.
+    It can be parallelized using the `n_threads` argument. The files are then streamed
+    in chunks to a pool of worker processes and the results are collected in their
+    order of completion.
 
     Args:
         dcm_list (list): List of dicom files to process.
         output_dir (str): Path to output directory.
         config (dict): Dictionary containing the Elasticsearch configuration.
         process_handler (str): Process handler to use for parallel/asynchronous processing.
-                               Can be either 'multiprocessing' or 'asyncio'.
+                               Can be either 'multiprocessing', 'asyncio' or 'threads'.
+                               With 'asyncio', the files are read, parsed (by the worker
+                               processes if `n_threads` > 1) and uploaded concurrently in an
+                               event loop (see `dicom2elk.core.aio`). With 'threads', the
+                               files are processed by `io_threads` threads in each worker
+                               process (or in the main process if `n_threads` is 1) to keep
+                               many reads in flight on network storage.
         mode (str): Mode to use for saving the extracted metadata tags.
-                    Can be either 'json' or 'elasticsearch'.
+                    Can be either 'json', 'elasticsearch', 'ndjson' or 'parquet'. In 'ndjson'
+                    and 'parquet' modes, the documents are written by `sink` (see
+                    `dicom2elk.core.ndjson` and `dicom2elk.core.parquet`).
         n_threads (int): Number of threads to use for parallel/asynchronous processing.
                          Defaults to 1.
-        sleep_time_ms (float): Sleep time in milliseconds to wait between each file processing.
-                               Defaults to 0.
+        sleep_time_ms (float): Sleep time in milliseconds to wait between each file processing
+                               (deprecated, use `throttle` instead). Defaults to 0.
         logger (logging.Logger): Logger object.
+        worker_options (dict): Options of the files of the run returned by `get_worker_options`
+                               (tags to exclude, engine, throttle, JSON layout, ...), built
+                               once and shared by all lists of the run. If given, `output_dir`,
+                               `mode`, `sleep_time_ms`, `logger` and `kwargs` are taken from it.
+                               If None, it is built from them. If `pool` is given, the options
+                               with which its workers were initialized are used.
+        stats (dict): Dictionary of counters (e.g. "bulk_data_bytes_skipped") that is
+                      updated in place with the counters of each processed file.
+        pool (multiprocessing.pool.Pool): Pool of worker processes to use instead of
+                                          creating a new one for the list. It must be
+                                          created by `dicom2elk.core.process.create_worker_pool`
+                                          and is left open.
+        io_threads (int): Number of threads per process used by the 'threads' process
+                          handler, or by the 'asyncio' one without worker processes. It can
+                          be greater than the number of CPUs. Defaults to 16.
+        sink (dicom2elk.core.pipeline.SinkPipeline): Sink stage to which the extracted
+                                                     documents are passed as soon as they are
+                                                     completed. It is left open. If None and
+                                                     `mode` is 'elasticsearch', the documents
+                                                     are uploaded once the whole list is extracted.
+        async_engine (dicom2elk.core.aio.AsyncEngine): Event loop and asyncio client used by
+                                                       the 'asyncio' process handler, shared by
+                                                       the lists of a run and left open. If None,
+                                                       it is created for the list.
+        processed_files (list): List to which a tuple containing the path to the dicom
+                                file and its result is appended for each processed file.
+        errors (list): List to which the record of the error of each file that
+                       cannot be read is appended (see `dicom2elk.utils.errors`).
+        document_format (str): Format of the documents indexed in 'elasticsearch' mode by
+                               the 'asyncio' process handler or without `sink`, 'dicom-json'
+                               or 'flattened' (see `dicom2elk.core.elasticsearch.documents`).
+                               Defaults to 'dicom-json'.
+        bulk_options (dict): Options of the bulk requests of the documents indexed in
+                             'elasticsearch' mode by the 'asyncio' process handler or
+                             without `sink` ("chunk_size", "max_chunk_bytes", "max_retries",
+                             "op_type" and "id_scheme", see
+                             `dicom2elk.core.elasticsearch.api.send_bulk_to_elasticsearch`).
+                             Defaults to None.
+        failed_files (list): List to which the paths of the files whose document could
+                             not be indexed in 'elasticsearch' mode by the 'asyncio'
+                             process handler or without `sink` are appended.
         **kwargs: Arbitrary keyword arguments to pass to the `dcmread` function.
 
     Returns:
@@ -135,66 +420,167 @@ def extract_metadata_from_dcm_list(
     References:
         https://pydicom.github.io/pydicom/dev/reference/generated/pydicom.dataset.Dataset.html#pydicom.dataset.Dataset.to_json_dict
     """
+    if pool is not None and hasattr(pool, "worker_options"):
+        # The workers of the pool were initialized with the options of the run
+        worker_options = pool.worker_options
+    elif worker_options is None:
+        worker_options = get_worker_options(
+            mode=mode,
+            sleep_time_ms=sleep_time_ms,
+            output_dir=output_dir,
+            logger=logger,
+            kwargs=kwargs,
+        )
+    mode = worker_options["mode"]
+    output_dir = worker_options["output_dir"]
+    logger = worker_options["logger"]
+    throttle = worker_options["throttle"]
+
     if mode == "json" and output_dir is None:
         raise ValueError("If mode is set to 'json', output_dir must be specified.")
 
     if mode == "elasticsearch" and config is None:
         raise ValueError("If mode is set to 'elasticsearch', config must be specified.")
 
-    if n_threads > 1:
-        with Pool(n_threads) as p:
-            # prepare arguments
-            args = zip(
-                dcm_list,
-                [mode] * len(dcm_list),
-                [sleep_time_ms] * len(dcm_list),
-                [output_dir] * len(dcm_list),
-                [logger] * len(dcm_list),
-                [kwargs] * len(dcm_list),
+    bulk_options = bulk_options or {}
+    bulk_chunk_size = bulk_options.get("chunk_size", BULK_CHUNK_SIZE)
+
+    processed_dcm_list = []
+    with ExitStack() as stack:
+        if process_handler == "asyncio" and async_engine is None:
+            # The event loop and the asyncio client are only used for this list
+            async_engine = stack.enter_context(
+                AsyncEngine(
+                    io_threads,
+                    config if mode == "elasticsearch" else None,
+                    logger,
+                    document_format,
+                )
             )
-            if process_handler == "multiprocessing":
-                processed_dcm_list = p.starmap(
-                    extract_metadata_from_dcm,
-                    tqdm.tqdm(
-                        args,
-                        total=len(dcm_list),
-                        desc="Extracting and saving tags",
-                        unit="file",
-                    ),
+        if n_threads > 1 or pool is not None:
+            if pool is None:
+                # The listener is stopped once the pool is terminated
+                log_queue, log_listener = start_log_listener()
+                stack.callback(stop_log_listener, log_listener)
+                pool = stack.enter_context(
+                    Pool(
+                        n_threads,
+                        initializer=init_worker,
+                        initargs=(worker_options, log_queue, logging.getLogger().level),
+                    )
+                )
+            chunksize = get_chunksize(len(dcm_list), n_threads)
+            if process_handler == "threads":
+                # Each worker processes a chunk of files with its own pool of threads
+                chunksize = max(chunksize, io_threads)
+                dcm_chunks = (
+                    (dcm_list[i : i + chunksize], io_threads)
+                    for i in range(0, len(dcm_list), chunksize)
+                )
+                results = chain.from_iterable(
+                    pool.imap_unordered(_extract_metadata_from_dcm_chunk_worker, dcm_chunks)
                 )
             elif process_handler == "asyncio":
-                processed_dcm_list = p.starmap_async(
-                    extract_metadata_from_dcm,
-                    tqdm.tqdm(
-                        args,
-                        total=len(dcm_list),
-                        desc="Extracting and saving tags",
-                        unit="file",
+                # Parse in the worker processes and upload in the event loop
+                results = async_engine.run(
+                    extract_metadata_from_dcm_list_async(
+                        dcm_list,
+                        extract_metadata_from_dcm_worker,
+                        pool=pool,
+                        es=async_engine.es,
+                        index=async_engine.index,
+                        target=async_engine.target,
+                        io_threads=io_threads,
+                        max_parses=2 * n_threads,
+                        throttle=throttle,
+                        logger=logger,
+                        document_format=document_format,
+                        bulk_chunk_size=bulk_chunk_size,
+                        bulk_options=bulk_options,
+                        stats=stats,
+                        failed_files=failed_files,
+                    )
+                )
+            else:
+                # Stream the files to the workers in chunks and
+                # consume the results as soon as they are completed
+                results = pool.imap_unordered(
+                    extract_metadata_from_dcm_worker, dcm_list, chunksize=chunksize
+                )
+        elif process_handler == "threads":
+            executor = stack.enter_context(ThreadPoolExecutor(io_threads))
+            results = _extract_metadata_from_dcm_threads(
+                executor, dcm_list, worker_options
+            )
+        elif process_handler == "asyncio":
+
+            # Parse in the threads of the event loop and upload in the event loop
+            results = async_engine.run(
+                extract_metadata_from_dcm_list_async(
+                    dcm_list,
+                    partial(
+                        _extract_metadata_from_dcm_with_path,
+                        worker_options=worker_options,
                     ),
-                ).get()
-            processed_dcm_list = list(processed_dcm_list)
-    else:
-        processed_dcm_list = [
-            extract_metadata_from_dcm(
-                dcm_file,
-                mode=mode,
-                sleep_time_ms=sleep_time_ms,
-                output_dir=output_dir,
-                logger=logger,
-                kwargs=kwargs,
+                    es=async_engine.es,
+                    index=async_engine.index,
+                    target=async_engine.target,
+                    io_threads=io_threads,
+                    throttle=throttle,
+                    logger=logger,
+                    document_format=document_format,
+                    bulk_chunk_size=bulk_chunk_size,
+                    bulk_options=bulk_options,
+                    stats=stats,
+                    failed_files=failed_files,
+                )
             )
-            for dcm_file in dcm_list
-        ]
+        else:
+            results = (
+                _extract_metadata_from_dcm_with_path(dcm_file, worker_options)
+                for dcm_file in dcm_list
+            )
+
+        for dcm_file, processed_dcm, dcm_stats in tqdm.tqdm(
+            results,
+            total=len(dcm_list),
+            desc="Extracting and saving tags",
+            unit="file",
+            # The asyncio engine displays its own progress
+            disable=process_handler == "asyncio",
+        ):
+            processed_dcm_list.append(processed_dcm)
+            if processed_files is not None and processed_dcm is not None:
+                processed_files.append((dcm_file, processed_dcm))
+            error = dcm_stats.pop("error", None)
+            if errors is not None and error is not None:
+                errors.append(error)
+            if sink is not None and processed_dcm is not None:
+                sink.put(processed_dcm)
+            if stats is not None:
+                for key, value in dcm_stats.items():
+                    stats[key] = stats.get(key, 0) + value
 
-    if mode == "elasticsearch":
+    if mode == "elasticsearch" and process_handler != "asyncio" and sink is None:
+        # The asyncio engine and the sink stage upload the documents
+        # as soon as they are extracted
         processed_dcm_list = [
             processed_dcm
             for processed_dcm in processed_dcm_list
             if processed_dcm is not None
         ]
-        send_bulk_to_elasticsearch(
+        bulk_stats = send_bulk_to_elasticsearch(
             dcm_tags_list=processed_dcm_list,
             config=config,
             logger=logger,
+            throttle=throttle,
+            document_format=document_format,
+            **bulk_options,
         )
+        failed = bulk_stats.pop("failed_files", [])
+        if failed_files is not None:
+            failed_files.extend(failed)
+        if stats is not None:
+            for key, value in bulk_stats.items():
+                stats[key] = stats.get(key, 0) + value
     return processed_dcm_list
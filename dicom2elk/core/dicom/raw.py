@@ -0,0 +1,263 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides a raw reader of DICOM files encoded in Explicit VR Little Endian.
+
+Instead of parsing the whole file with `pydicom.dcmread`, the element headers
+are scanned straight from a byte buffer. The values of the elements that are
+not needed are skipped without being decoded and the scan stops at a given tag
+(e.g. before the pixel data). The elements that are kept are returned as the
+raw elements of a `pydicom.Dataset` that can be converted by
+`dicom2elk.core.dicom.serializer.to_json_dict`.
+
+Files that are not supported (no preamble, implicit VR, big endian or deflated
+transfer syntaxes, malformed files) raise a `ValueError` so that the caller can
+fall back to `pydicom.dcmread`.
+"""
+
+import mmap
+from struct import Struct
+
+from pydicom import Dataset
+from pydicom.dataelem import RawDataElement
+from pydicom.tag import BaseTag
+from pydicom.uid import UID
+
+from dicom2elk.core.dicom.bulkdata import BULK_DATA_VRS, UNDEFINED_LENGTH
+
+
+# Tag from which the scan stops when the pixel data is not read
+# (first of Float Pixel Data, Double Float Pixel Data and Pixel Data)
+PIXEL_DATA_TAG = 0x7FE00008
+
+# Tag of the Specific Character Set that is always read
+SPECIFIC_CHARACTER_SET_TAG = 0x00080005
+
+# Tags of the items and delimiters of sequences
+ITEM_TAG = 0xFFFEE000
+ITEM_DELIMITER_TAG = 0xFFFEE00D
+SEQUENCE_DELIMITER_TAG = 0xFFFEE0DD
+
+# VRs encoded with 2 reserved bytes and a 4-byte length
+LONG_LENGTH_VRS = {
+    b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"
+}
+# VRs encoded with a 2-byte length
+SHORT_LENGTH_VRS = {
+    b"AE", b"AS", b"AT", b"CS", b"DA", b"DS", b"DT", b"FD", b"FL", b"IS", b"LO",
+    b"LT", b"PN", b"SH", b"SL", b"SS", b"ST", b"TM", b"UI", b"UL", b"US",
+}
+
+_unpack_tag = Struct("<HH").unpack_from
+_unpack_short_length = Struct("<H").unpack_from
+_unpack_long_length = Struct("<L").unpack_from
+
+
+def _read_element_header(buffer, pos: int):
+    """Read the header of an element encoded in Explicit VR Little Endian.
+
+    Args:
+        buffer (bytes or mmap.mmap): Content of the file.
+        pos (int): Position of the header in the buffer.
+
+    Returns:
+        tuple: Tuple containing the tag, the VR (None for items and delimiters),
+               the length of the value and the position of the value.
+    """
+    if pos + 8 > len(buffer):
+        raise ValueError("Unexpected end of file")
+    group, element = _unpack_tag(buffer, pos)
+    tag = (group << 16) | element
+    if group == 0xFFFE:
+        return tag, None, _unpack_long_length(buffer, pos + 4)[0], pos + 8
+    vr = buffer[pos + 4:pos + 6]
+    if vr in SHORT_LENGTH_VRS:
+        return tag, vr.decode(), _unpack_short_length(buffer, pos + 6)[0], pos + 8
+    if vr in LONG_LENGTH_VRS:
+        if pos + 12 > len(buffer):
+            raise ValueError("Unexpected end of file")
+        return tag, vr.decode(), _unpack_long_length(buffer, pos + 8)[0], pos + 12
+    raise ValueError(f"Invalid VR {vr!r} for tag {tag:08X}")
+
+
+def _skip_undefined_length_sequence(buffer, pos: int):
+    """Scan the items of a sequence of undefined length up to its delimiter.
+
+    Args:
+        buffer (bytes or mmap.mmap): Content of the file.
+        pos (int): Position of the first item of the sequence.
+
+    Returns:
+        int: Position of the Sequence Delimitation Item.
+    """
+    while True:
+        tag, _, length, value_pos = _read_element_header(buffer, pos)
+        if tag == SEQUENCE_DELIMITER_TAG:
+            return pos
+        if tag != ITEM_TAG:
+            raise ValueError(f"Unexpected tag {tag:08X} in sequence")
+        if length != UNDEFINED_LENGTH:
+            pos = value_pos + length
+            continue
+        # Scan the elements of the item up to its delimiter
+        pos = value_pos
+        while True:
+            tag, vr, length, value_pos = _read_element_header(buffer, pos)
+            if tag == ITEM_DELIMITER_TAG:
+                pos = value_pos
+                break
+            if length != UNDEFINED_LENGTH:
+                pos = value_pos + length
+            elif vr == "SQ":
+                pos = _skip_undefined_length_sequence(buffer, value_pos) + 8
+            else:
+                raise ValueError(f"Unsupported undefined length for tag {tag:08X}")
+
+
+def _read_transfer_syntax(buffer):
+    """Read the file meta information.
+
+    Args:
+        buffer (bytes or mmap.mmap): Content of the file.
+
+    Returns:
+        tuple: Tuple containing the Transfer Syntax UID and the position of the dataset.
+    """
+    if buffer[128:132] != b"DICM":
+        raise ValueError("Missing DICOM preamble")
+    transfer_syntax = None
+    pos = 132
+    while buffer[pos:pos + 2] == b"\x02\x00":
+        tag, _, length, value_pos = _read_element_header(buffer, pos)
+        if length == UNDEFINED_LENGTH:
+            raise ValueError("Undefined length in file meta information")
+        if tag == 0x00020010:
+            transfer_syntax = UID(
+                bytes(buffer[value_pos:value_pos + length]).decode("ascii").rstrip("\0 ")
+            )
+        pos = value_pos + length
+    if transfer_syntax is None:
+        raise ValueError("Missing Transfer Syntax UID")
+    return transfer_syntax, pos
+
+
+def is_supported_transfer_syntax(transfer_syntax: UID):
+    """Check if a dataset with the given transfer syntax can be read by `read_raw_dataset`.
+
+    Args:
+        transfer_syntax (pydicom.uid.UID): Transfer Syntax UID of the file.
+
+    Returns:
+        bool: True if the dataset is encoded in Explicit VR Little Endian without deflate.
+    """
+    try:
+        return (
+            transfer_syntax.is_little_endian
+            and not transfer_syntax.is_implicit_VR
+            and not transfer_syntax.is_deflated
+        )
+    except ValueError:
+        # Private or unknown transfer syntax
+        return False
+
+
+def _read_raw_elements(buffer, stop_tag: int, specific_tags: set, defer_size: int):
+    """Scan the elements of a buffer and return the raw elements to keep by tag."""
+    transfer_syntax, pos = _read_transfer_syntax(buffer)
+    if not is_supported_transfer_syntax(transfer_syntax):
+        raise ValueError(f"Unsupported transfer syntax {transfer_syntax}")
+
+    raw_elements = {}
+    end = len(buffer)
+    while pos < end:
+        tag, vr, length, value_pos = _read_element_header(buffer, pos)
+        if vr is None:
+            raise ValueError(f"Unexpected tag {tag:08X} in dataset")
+        if tag >= stop_tag:
+            break
+
+        if length == UNDEFINED_LENGTH:
+            if vr != "SQ":
+                raise ValueError(f"Unsupported undefined length for tag {tag:08X}")
+            # The Sequence Delimitation Item is not part of the value
+            delimiter_pos = _skip_undefined_length_sequence(buffer, value_pos)
+            length = delimiter_pos - value_pos
+            pos = delimiter_pos + 8
+        else:
+            pos = value_pos + length
+            if pos > end:
+                raise ValueError("Unexpected end of file")
+
+        if specific_tags is not None and tag not in specific_tags:
+            continue
+
+        if defer_size is not None and length > defer_size and vr in BULK_DATA_VRS:
+            value = None
+        else:
+            value = bytes(buffer[value_pos:value_pos + length])
+        tag = BaseTag(tag)
+        raw_elements[tag] = RawDataElement(
+            tag, vr, length, value, value_pos, False, True, True, False
+        )
+    return raw_elements
+
+
+def read_raw_dataset(
+    dcm_file: str,
+    stop_tag: int = PIXEL_DATA_TAG,
+    specific_tags: list = None,
+    defer_size: int = None,
+    dcm_bytes: bytes = None,
+):
+    """Read the raw elements of a DICOM file encoded in Explicit VR Little Endian.
+
+    Args:
+        dcm_file (str): Path to dicom file.
+        stop_tag (int): Tag at which the scan stops. Elements with a tag greater than
+                        or equal to it are not read. If None, the whole file is read.
+                        Defaults to the first pixel data tag.
+        specific_tags (list): List of tags to read (as the `specific_tags` argument of
+                              `dcmread`). The values of the other elements are skipped.
+                              If None, all elements are read.
+        defer_size (int): Size in bytes above which the value of a binary element is
+                          not read and left deferred (as with the `defer_size` argument
+                          of `dcmread`). If None, all values are read.
+        dcm_bytes (bytes): Content of the dicom file if it has already been read.
+                           If None, the file is mapped in memory.
+
+    Returns:
+        pydicom.Dataset: Dataset of raw data elements (without file meta information).
+
+    Raises:
+        ValueError: If the file is not supported or is malformed.
+    """
+    if specific_tags is not None:
+        specific_tags = {int(tag) for tag in specific_tags}
+        specific_tags.add(SPECIFIC_CHARACTER_SET_TAG)
+    if stop_tag is None:
+        stop_tag = 0xFFFFFFFF + 1
+
+    if dcm_bytes is not None:
+        raw_elements = _read_raw_elements(dcm_bytes, stop_tag, specific_tags, defer_size)
+    else:
+        with open(dcm_file, "rb") as fp:
+            # The values that are skipped are never read from the mapped file
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                raw_elements = _read_raw_elements(
+                    buffer, stop_tag, specific_tags, defer_size
+                )
+
+    dcm_dataset = Dataset(raw_elements)
+    dcm_dataset.set_original_encoding(False, True)
+    return dcm_dataset
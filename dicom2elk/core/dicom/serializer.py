@@ -0,0 +1,365 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides a fast serializer of DICOM datasets to the DICOM JSON Model.
+
+It produces the same output as the `to_json_dict` method of `pydicom.Dataset`
+but walks the dataset only once and converts the raw bytes of the elements
+straight to their JSON representation with one precomputed converter per VR,
+without creating the intermediate `pydicom.DataElement` objects.
+
+Elements that cannot be converted this way (ambiguous or unknown VRs, deferred
+values, escape sequences in text values, invalid values, ...) or a pydicom
+configuration that changes the conversion of the values fall back to
+`pydicom.DataElement.to_json_dict`.
+"""
+
+import base64
+import math
+from struct import calcsize, unpack
+
+from pydicom import Dataset, config
+from pydicom.datadict import dictionary_VR
+from pydicom.dataelem import RawDataElement
+from pydicom.hooks import hooks, raw_element_value, raw_element_vr
+
+
+# Encoding used by pydicom for the VRs restricted to the default character repertoire
+DEFAULT_ENCODING = "iso8859"
+
+# Escape character starting the code extensions of ISO 2022 character sets
+ESC = b"\x1b"
+
+# LUT descriptor tags whose value is fixed by pydicom when converted
+LUT_DESCRIPTOR_TAGS = {0x00281101, 0x00281102, 0x00281103, 0x00283002}
+
+# Cache of the keys of the JSON dictionary indexed by tag
+_JSON_KEYS = {}
+
+
+class _FallbackError(Exception):
+    """Raised by a converter when the element must be converted by pydicom."""
+
+
+def get_json_key(tag: int):
+    """Get the key of an element in the DICOM JSON Model from the cache.
+
+    Args:
+        tag (int): Tag of the element.
+
+    Returns:
+        str: Uppercase hexadecimal representation of the tag (e.g. "00100010").
+    """
+    try:
+        return _JSON_KEYS[tag]
+    except KeyError:
+        json_key = _JSON_KEYS[tag] = f"{tag:08X}"
+        return json_key
+
+
+def _decode(byte_string: bytes, encodings: list):
+    if ESC in byte_string:
+        raise _FallbackError()
+    return byte_string.decode(encodings[0])
+
+
+def _split_strings(value: str):
+    values = value.rstrip(" \x00").split("\\")
+    if len(values) == 1 and not values[0]:
+        return None
+    return values
+
+
+def _convert_string(byte_string, is_little_endian, encodings):
+    # AS, CS, DA, DT and TM
+    return _split_strings(byte_string.decode(DEFAULT_ENCODING))
+
+
+def _convert_AE(byte_string, is_little_endian, encodings):
+    values = [v.strip() for v in byte_string.decode(DEFAULT_ENCODING).split("\\")]
+    if len(values) == 1 and not values[0]:
+        return None
+    return values
+
+
+def _convert_UI(byte_string, is_little_endian, encodings):
+    values = _split_strings(byte_string.decode(DEFAULT_ENCODING).rstrip("\0 "))
+    if values is None:
+        return None
+    values = [v.strip() for v in values]
+    if len(values) == 1 and not values[0]:
+        return None
+    return values
+
+
+def _convert_UR(byte_string, is_little_endian, encodings):
+    value = byte_string.decode(DEFAULT_ENCODING).rstrip()
+    if "\\" in value:
+        raise _FallbackError()
+    return [value] if value else None
+
+
+def _to_float(value: str):
+    if not value.strip() or "_" in value:
+        raise _FallbackError()
+    number = float(value)
+    if not math.isfinite(number):
+        raise _FallbackError()
+    return number
+
+
+def _to_int(value: str):
+    if not value.strip() or "_" in value:
+        raise _FallbackError()
+    return int(value)
+
+
+def _convert_DS(byte_string, is_little_endian, encodings):
+    values = _split_strings(byte_string.decode(DEFAULT_ENCODING).strip())
+    if values is None:
+        return None
+    return [_to_float(v) for v in values]
+
+
+def _convert_IS(byte_string, is_little_endian, encodings):
+    values = _split_strings(byte_string.decode(DEFAULT_ENCODING))
+    if values is None:
+        return None
+    return [_to_int(v) for v in values]
+
+
+def _convert_text(byte_string, is_little_endian, encodings):
+    # SH, LO and UC
+    values = [v.rstrip("\0 ") for v in _decode(byte_string, encodings).split("\\")]
+    if len(values) == 1 and not values[0]:
+        return None
+    return values
+
+
+def _convert_single_string(byte_string, is_little_endian, encodings):
+    # ST, LT and UT
+    value = _decode(byte_string, encodings).rstrip("\0 ")
+    return [value] if value else None
+
+
+def _convert_PN(byte_string, is_little_endian, encodings):
+    values = _decode(byte_string.rstrip(b"\x00 "), encodings).split("\\")
+    if len(values) == 1 and not values[0]:
+        return None
+    json_values = []
+    for value in values:
+        components = value.split("=")
+        # Remove empty components from the end as pydicom does
+        while components and not components[-1]:
+            components.pop()
+        if not components:
+            raise _FallbackError()
+        json_value = {"Alphabetic": components[0]}
+        if len(components) > 1:
+            json_value["Ideographic"] = components[1]
+        if len(components) > 2:
+            json_value["Phonetic"] = components[2]
+        json_values.append(json_value)
+    return json_values
+
+
+def _convert_AT(byte_string, is_little_endian, encodings):
+    length = len(byte_string)
+    if length % 4:
+        raise _FallbackError()
+    endianness = "<" if is_little_endian else ">"
+    values = unpack(f"{endianness}{length // 2}H", byte_string)
+    return [
+        f"{(values[i] << 16) | values[i + 1]:08X}" for i in range(0, len(values), 2)
+    ]
+
+
+def _number_converter(struct_format: str):
+    bytes_per_value = calcsize("=" + struct_format)
+
+    def _convert_numbers(byte_string, is_little_endian, encodings):
+        length = len(byte_string)
+        if length % bytes_per_value:
+            raise _FallbackError()
+        endianness = "<" if is_little_endian else ">"
+        return list(
+            unpack(f"{endianness}{length // bytes_per_value}{struct_format}", byte_string)
+        )
+
+    return _convert_numbers
+
+
+# Converters of the raw bytes of non-empty elements to the "Value" of the
+# DICOM JSON Model, indexed by VR. They return None if the value is empty.
+VALUE_CONVERTERS = {
+    "AE": _convert_AE,
+    "AS": _convert_string,
+    "AT": _convert_AT,
+    "CS": _convert_string,
+    "DA": _convert_string,
+    "DS": _convert_DS,
+    "DT": _convert_string,
+    "FD": _number_converter("d"),
+    "FL": _number_converter("f"),
+    "IS": _convert_IS,
+    "LO": _convert_text,
+    "LT": _convert_single_string,
+    "PN": _convert_PN,
+    "SH": _convert_text,
+    "SL": _number_converter("l"),
+    "SS": _number_converter("h"),
+    "ST": _convert_single_string,
+    "SV": _number_converter("q"),
+    "TM": _convert_string,
+    "UC": _convert_text,
+    "UI": _convert_UI,
+    "UL": _number_converter("L"),
+    "UR": _convert_UR,
+    "US": _number_converter("H"),
+    "UT": _convert_single_string,
+    "UV": _number_converter("Q"),
+}
+
+# Binary VRs whose value is base64-encoded in "InlineBinary"
+BINARY_VRS = {"OB", "OD", "OF", "OL", "OV", "OW"}
+
+
+def use_fast_conversion():
+    """Check if the pydicom configuration allows the fast conversion of raw elements.
+
+    Returns:
+        bool: False if an option or a hook of pydicom that changes the conversion
+              of the raw values is set, True otherwise.
+    """
+    return (
+        not config.datetime_conversion
+        and not config.use_DS_numpy
+        and not config.use_IS_numpy
+        and not config.use_DS_decimal
+        and not config.use_none_as_empty_text_VR_value
+        and config.data_element_callback is None
+        and config.settings.reading_validation_mode != config.RAISE
+        and hooks.raw_element_vr is raw_element_vr
+        and hooks.raw_element_value is raw_element_value
+        and not hooks.raw_element_kwargs
+    )
+
+
+def _raw_element_to_json_dict(
+    elem: RawDataElement, encodings: list, bulk_data_threshold: int, has_handler: bool
+):
+    """Convert a raw element, raising `_FallbackError` if pydicom must do it."""
+    if elem.value is None or elem.tag in LUT_DESCRIPTOR_TAGS:
+        raise _FallbackError()
+
+    vr = elem.VR
+    if vr is None:
+        if elem.tag.is_private:
+            raise _FallbackError()
+        try:
+            vr = dictionary_VR(elem.tag)
+        except KeyError:
+            raise _FallbackError()
+
+    if vr in BINARY_VRS:
+        json_element = {"vr": vr}
+        if elem.value:
+            # Base64 makes the encoded value 1/3 longer (see pydicom)
+            if has_handler and len(elem.value) > (bulk_data_threshold // 4) * 3:
+                raise _FallbackError()
+            json_element["InlineBinary"] = base64.b64encode(elem.value).decode("utf-8")
+        return json_element
+
+    converter = VALUE_CONVERTERS.get(vr)
+    if converter is None:
+        raise _FallbackError()
+
+    json_element = {"vr": vr}
+    if elem.length:
+        try:
+            value = converter(elem.value, elem.is_little_endian, encodings)
+        except (ValueError, LookupError):
+            raise _FallbackError()
+        if value:
+            json_element["Value"] = value
+    return json_element
+
+
+def to_json_dict(
+    dcm_dataset: Dataset,
+    bulk_data_threshold: int = 1024,
+    bulk_data_element_handler=None,
+    fast_conversion: bool = None,
+):
+    """Return the dictionary representation of a dataset conforming to the DICOM JSON Model.
+
+    The output is identical to the one of `pydicom.Dataset.to_json_dict`.
+
+    Args:
+        dcm_dataset (pydicom.Dataset): Dataset to serialize.
+        bulk_data_threshold (int): Size of the base64-encoded value above which a binary
+                                   value is provided by `bulk_data_element_handler`.
+                                   Ignored if no handler is given. Defaults to 1024.
+        bulk_data_element_handler (callable): Callable that accepts a bulk data element
+                                              and returns its "BulkDataURI". Defaults to None.
+        fast_conversion (bool): If True, raw elements are converted by the converters of
+                                `VALUE_CONVERTERS`. If None (default), it is set by
+                                `use_fast_conversion`.
+
+    Returns:
+        dict: Dictionary representation of the dataset.
+    """
+    if fast_conversion is None:
+        fast_conversion = use_fast_conversion()
+
+    # Character sets of the dataset as Python encodings (inherited by sequence items)
+    encodings = dcm_dataset._character_set
+    if isinstance(encodings, str):
+        encodings = [encodings]
+    has_handler = bulk_data_element_handler is not None
+
+    json_dataset = {}
+    for tag in dcm_dataset.keys():
+        json_key = get_json_key(tag)
+        elem = dcm_dataset.get_item(tag, keep_deferred=True)
+
+        if fast_conversion and isinstance(elem, RawDataElement):
+            try:
+                json_dataset[json_key] = _raw_element_to_json_dict(
+                    elem, encodings, bulk_data_threshold, has_handler
+                )
+                continue
+            except _FallbackError:
+                pass
+
+        data_element = dcm_dataset[tag]
+        if data_element.VR == "SQ":
+            json_dataset[json_key] = {
+                "vr": "SQ",
+                "Value": [
+                    to_json_dict(
+                        item,
+                        bulk_data_threshold=bulk_data_threshold,
+                        bulk_data_element_handler=bulk_data_element_handler,
+                        fast_conversion=fast_conversion,
+                    )
+                    for item in data_element.value
+                ],
+            }
+        else:
+            json_dataset[json_key] = data_element.to_json_dict(
+                bulk_data_element_handler=bulk_data_element_handler,
+                bulk_data_threshold=bulk_data_threshold,
+            )
+    return json_dataset
@@ -0,0 +1,208 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides functions to select the DICOM tags to extract."""
+
+from pydicom import Dataset
+from pydicom.datadict import tag_for_keyword
+from pydicom.tag import BaseTag, Tag
+
+from dicom2elk.core.dicom.bulkdata import get_element_vr
+
+
+# Name of the pseudo-preset that matches all private tags.
+# It can only be used in the list of excluded tags.
+PRIVATE_TAGS = "private"
+
+# Tags that are always extracted when a list of included tags is given
+# as they are needed to name the output JSON files / Elasticsearch documents.
+REQUIRED_TAGS = ["SOPInstanceUID"]
+
+# Named presets of DICOM keywords that can be used in the list of
+# included / excluded tags of the config file.
+TAG_PRESETS = {
+    "patient": [
+        "PatientName",
+        "PatientID",
+        "PatientBirthDate",
+        "PatientSex",
+        "PatientAge",
+        "PatientSize",
+        "PatientWeight",
+    ],
+    "study": [
+        "StudyInstanceUID",
+        "StudyID",
+        "StudyDate",
+        "StudyTime",
+        "StudyDescription",
+        "AccessionNumber",
+        "ReferringPhysicianName",
+        "InstitutionName",
+    ],
+    "series": [
+        "SeriesInstanceUID",
+        "SeriesNumber",
+        "SeriesDate",
+        "SeriesTime",
+        "SeriesDescription",
+        "Modality",
+        "BodyPartExamined",
+        "ProtocolName",
+        "Manufacturer",
+        "ManufacturerModelName",
+        "StationName",
+        "FrameOfReferenceUID",
+    ],
+    "instance": [
+        "SOPClassUID",
+        "SOPInstanceUID",
+        "InstanceNumber",
+        "ImageType",
+        "AcquisitionNumber",
+        "AcquisitionDate",
+        "AcquisitionTime",
+        "ContentDate",
+        "ContentTime",
+        "Rows",
+        "Columns",
+        "NumberOfFrames",
+    ],
+}
+
+
+def parse_tag(tag: str):
+    """Convert a DICOM keyword or a hexadecimal tag to a pydicom tag.
+
+    Args:
+        tag (str): DICOM keyword (e.g. "PatientID") or hexadecimal tag
+                   in the form "00100020", "0x00100020", "0010,0020"
+                   or "(0010,0020)".
+
+    Returns:
+        pydicom.tag.BaseTag: Corresponding tag.
+
+    Raises:
+        ValueError: If `tag` is neither a known DICOM keyword nor a valid hexadecimal tag.
+    """
+    tag_value = tag_for_keyword(tag)
+    if tag_value is not None:
+        return BaseTag(tag_value)
+
+    hex_tag = tag.strip().strip("()").replace(",", "")
+    if hex_tag.lower().startswith("0x"):
+        hex_tag = hex_tag[2:]
+    if len(hex_tag) != 8:
+        raise ValueError(f"Invalid DICOM keyword or tag: {tag}")
+    try:
+        return Tag(int(hex_tag, 16))
+    except ValueError:
+        raise ValueError(f"Invalid DICOM keyword or tag: {tag}")
+
+
+def resolve_tags(tags: list, allow_private: bool = False):
+    """Expand presets and convert a list of keywords / hexadecimal tags to pydicom tags.
+
+    Args:
+        tags (list): List of DICOM keywords, hexadecimal tags or names of presets
+                     defined in `TAG_PRESETS`.
+        allow_private (bool): If True, the "private" pseudo-preset is kept as is
+                              in the returned list. Defaults to False.
+
+    Returns:
+        list: Sorted list of unique tags (and "private" if present and allowed).
+
+    Raises:
+        ValueError: If "private" is given while `allow_private` is False.
+    """
+    resolved_tags = set()
+    has_private = False
+    for tag in tags:
+        if tag == PRIVATE_TAGS:
+            if not allow_private:
+                raise ValueError(f"'{PRIVATE_TAGS}' can only be used in excluded tags.")
+            has_private = True
+        elif tag in TAG_PRESETS:
+            resolved_tags.update(parse_tag(keyword) for keyword in TAG_PRESETS[tag])
+        else:
+            resolved_tags.add(parse_tag(tag))
+    resolved_tags = sorted(resolved_tags)
+    if has_private:
+        resolved_tags.append(PRIVATE_TAGS)
+    return resolved_tags
+
+
+def get_tag_selection(config: dict):
+    """Get the lists of tags to include / exclude from the config.
+
+    The selection is defined in the "tags" section of the config file such as::
+
+        "tags": {
+            "include": ["study", "series", "instance", "PatientID"],
+            "exclude": ["private", "(0029,1010)"]
+        }
+
+    Args:
+        config (dict): Dictionary loaded from the config file in JSON format.
+
+    Returns:
+        tuple: Tuple containing:
+                   * the list of tags to include (None if all tags should be extracted).
+                   * the list of tags to exclude.
+    """
+    tags_config = config.get("tags", {}) if config is not None else {}
+
+    include_tags = tags_config.get("include")
+    if include_tags:
+        include_tags = resolve_tags(list(include_tags) + REQUIRED_TAGS)
+    else:
+        include_tags = None
+
+    exclude_tags = resolve_tags(tags_config.get("exclude", []), allow_private=True)
+    return include_tags, exclude_tags
+
+
+def remove_private_tags(dcm_dataset: Dataset):
+    """Remove the private tags from a dataset and its sequences in place.
+
+    Unlike `pydicom.Dataset.remove_private_tags`, the private elements are removed
+    without being converted so that deferred values are never read.
+
+    Args:
+        dcm_dataset (pydicom.Dataset): Dataset read with `dcmread`.
+    """
+    for tag in list(dcm_dataset.keys()):
+        if tag.is_private:
+            del dcm_dataset[tag]
+        elif get_element_vr(dcm_dataset.get_item(tag, keep_deferred=True)) == "SQ":
+            for item in dcm_dataset[tag].value:
+                remove_private_tags(item)
+
+
+def remove_excluded_tags(dcm_dataset: Dataset, exclude_tags: list):
+    """Remove the excluded tags from a dataset in place.
+
+    Args:
+        dcm_dataset (pydicom.Dataset): Dataset read with `dcmread`.
+        exclude_tags (list): List of tags returned by `get_tag_selection`.
+
+    Returns:
+        pydicom.Dataset: The dataset without the excluded tags.
+    """
+    for tag in exclude_tags:
+        if tag == PRIVATE_TAGS:
+            remove_private_tags(dcm_dataset)
+        elif tag in dcm_dataset:
+            del dcm_dataset[tag]
+    return dcm_dataset
@@ -0,0 +1,97 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides functions to convert the values of the DICOM JSON Model to native types."""
+
+import datetime
+
+
+def parse_date(value):
+    """Convert a DA value to a date.
+
+    Args:
+        value (str): Value in the format YYYYMMDD (or YYYY.MM.DD in old files).
+
+    Returns:
+        datetime.date: Date, or None if the value is invalid.
+    """
+    try:
+        return datetime.datetime.strptime(str(value).replace(".", ""), "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+def parse_time(value):
+    """Convert a TM value to a time.
+
+    Args:
+        value (str): Value in the format HH[MM[SS[.FFFFFF]]] (or HH:MM:SS in old files).
+
+    Returns:
+        datetime.time: Time, or None if the value is invalid.
+    """
+    value = str(value).replace(":", "").strip()
+    hhmmss, _, fraction = value.partition(".")
+    if len(hhmmss) not in (2, 4, 6) or not hhmmss.isdigit():
+        return None
+    try:
+        return datetime.time(
+            int(hhmmss[0:2]),
+            int(hhmmss[2:4] or 0),
+            int(hhmmss[4:6] or 0),
+            int(fraction[:6].ljust(6, "0")),
+        )
+    except ValueError:
+        return None
+
+
+def parse_datetime(value):
+    """Convert a DT value to a datetime.
+
+    Args:
+        value (str): Value in the format YYYY[MM[DD[HH[MM[SS[.FFFFFF]]]]]][&ZZXX]
+                     where &ZZXX is an optional offset from UTC (e.g. "+0100").
+
+    Returns:
+        datetime.datetime: Datetime (aware if the value has an offset), or None
+                           if the value is invalid.
+    """
+    value = str(value).strip()
+    offset = None
+    for sign in "+-":
+        if sign in value:
+            value, zone = value.split(sign, 1)
+            if len(zone) != 4 or not zone.isdigit():
+                return None
+            offset = datetime.timedelta(hours=int(zone[:2]), minutes=int(zone[2:]))
+            offset = datetime.timezone(offset if sign == "+" else -offset)
+            break
+    digits, _, fraction = value.partition(".")
+    if len(digits) not in (4, 6, 8, 10, 12, 14) or not digits.isdigit():
+        return None
+    # Missing components are set to their first value
+    digits = digits + "0101000000"[len(digits) - 4 :]
+    try:
+        return datetime.datetime(
+            int(digits[0:4]),
+            int(digits[4:6]),
+            int(digits[6:8]),
+            int(digits[8:10]),
+            int(digits[10:12]),
+            int(digits[12:14]),
+            int(fraction[:6].ljust(6, "0")),
+            tzinfo=offset,
+        )
+    except ValueError:
+        return None
@@ -15,15 +15,204 @@
 """Module that provides functions to interact with Elasticsearch using the Python API."""
 
 
-from dicom2elk.utils.config import get_config
+import asyncio
+import hashlib
+import json
+import sqlite3 as sq
+import time
+
+from dicom2elk.core.elasticsearch.client import (
+    ensure_index,
+    get_elasticsearch_client,
+)
+from dicom2elk.core.elasticsearch.documents import (
+    get_document_source,
+    get_index_mappings,
+)
+from dicom2elk.utils.cache import (
+    connect_cache,
+    create_document_hash_table,
+    get_document_hashes,
+    update_document_hashes,
+)
 from dicom2elk.utils.logging import create_logger
+from dicom2elk.utils.throttle import Throttle
+
+
+from elasticsearch import AsyncElasticsearch, Elasticsearch, helpers
+
+
+# Maximum number of documents of each bulk request
+BULK_CHUNK_SIZE = 500
+
+# Maximum size in bytes of each bulk request
+BULK_MAX_CHUNK_BYTES = 10 * 1024**2
+
+# Maximum number of times a rejected document is sent again
+BULK_MAX_RETRIES = 5
+
+# Time in seconds to wait before the first retry (doubled at each retry)
+BULK_INITIAL_BACKOFF = 2.0
+
+# Maximum time in seconds to wait before a retry
+BULK_MAX_BACKOFF = 60.0
+
+# Statuses of the documents that are sent again (too many requests, unavailable)
+BULK_RETRY_STATUSES = (429, 503)
+
+# Status of the documents that already exist with the 'create' operation
+BULK_CONFLICT_STATUS = 409
+
+# Operations of the bulk actions
+BULK_OP_TYPES = ("index", "create", "update")
+
+# Schemes of the `_id` of the documents
+ES_ID_SCHEMES = ("sop-instance-uid", "sop-instance-uid-filepath")
 
 
-from elasticsearch import Elasticsearch, helpers
+def get_document_id(dcm_tags: dict, id_scheme: str = "sop-instance-uid"):
+    """Get the `_id` of the document of a DICOM file.
+
+    The `_id` only depends on the content of the file (and on its path), so that
+    the same file is indexed in the same document by all runs and all nodes.
+
+    Args:
+        dcm_tags (dict): Dictionary representation of the DICOM file.
+        id_scheme (str): Scheme of the `_id`. With 'sop-instance-uid', it is the
+                         SOPInstanceUID of the file, or the SHA-1 hash of its path if it
+                         has none. With 'sop-instance-uid-filepath', it is the SHA-1 hash
+                         of its SOPInstanceUID and its path, so that the copies of a file
+                         are different documents. Defaults to 'sop-instance-uid'.
+
+    Returns:
+        str: `_id` of the document.
+
+    Raises:
+        ValueError: If `id_scheme` is not one of `ES_ID_SCHEMES`.
+    """
+    sop_instance_uid = dcm_tags.get("00080018", {}).get("Value", [None])[0]
+    if id_scheme == "sop-instance-uid":
+        if sop_instance_uid:
+            return sop_instance_uid
+        return hashlib.sha1(dcm_tags["filepath"].encode()).hexdigest()
+    if id_scheme == "sop-instance-uid-filepath":
+        key = f"{sop_instance_uid or ''}\0{dcm_tags['filepath']}"
+        return hashlib.sha1(key.encode()).hexdigest()
+    raise ValueError(
+        f"Invalid id scheme: {id_scheme} (expected one of {list(ES_ID_SCHEMES)})"
+    )
+
+
+def get_document_hash(dcm_tags: dict):
+    """Get the hash of the content of the document of a DICOM file.
+
+    Args:
+        dcm_tags (dict): Dictionary representation of the DICOM file.
+
+    Returns:
+        str: SHA-1 hash of the document serialized with sorted keys.
+    """
+    content = json.dumps(dcm_tags, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def get_index_target(config: dict):
+    """Get the identifier of the index of a config in the cache of the content hashes.
+
+    Args:
+        config (dict): Dictionary loaded from the config file in JSON format which
+                       defines all variables related to Elasticsearch instance
+                       (url, port, index, user, pwd).
+
+    Returns:
+        str: The Elasticsearch instance and the name of the index ('url:port/index').
+    """
+    return f"{config['url']}:{config['port']}/{config['index']}"
+
+
+def filter_unchanged_documents(
+    dcm_tags_list: list,
+    db_connection: sq.Connection,
+    target: str,
+    document_format: str = "dicom-json",
+    id_scheme: str = "sop-instance-uid",
+):
+    """Remove the documents whose content has not changed since their last upload.
+
+    Args:
+        dcm_tags_list (list): List of dictionary representation of the DICOM files.
+        db_connection (sq.Connection): The connection to the cache of the content
+                                       hashes (see `dicom2elk.utils.cache`).
+        target (str): The index to which the documents are uploaded (see
+                      `get_index_target`). The documents are compared with the
+                      hashes of their last upload to this index only.
+        document_format (str): Format of the documents (see
+                               `dicom2elk.core.elasticsearch.documents`). The hash
+                               is computed on the document in this format.
+        id_scheme (str): Scheme of the `_id` of the documents (see `get_document_id`).
+
+    Returns:
+        tuple: Tuple containing:
+                   * the list of tuples (`_id`, content hash, document) of the new
+                     or changed documents.
+                   * the number of unchanged documents.
+    """
+    documents = []
+    for dcm_tags in dcm_tags_list:
+        source = get_document_source(dcm_tags, document_format)
+        documents.append(
+            (get_document_id(dcm_tags, id_scheme), get_document_hash(source), source)
+        )
+    cached_hashes = get_document_hashes(
+        db_connection, target, [document_id for document_id, _, _ in documents]
+    )
+    changed_documents = [
+        (document_id, document_hash, dcm_tags)
+        for document_id, document_hash, dcm_tags in documents
+        if cached_hashes.get(document_id) != document_hash
+    ]
+    return changed_documents, len(documents) - len(changed_documents)
+
+
+def _filter_unchanged_documents_in_db(
+    dcm_tags_list: list,
+    hash_db: str,
+    target: str,
+    document_format: str = "dicom-json",
+    id_scheme: str = "sop-instance-uid",
+):
+    """Remove the unchanged documents with a connection to `hash_db` of the calling thread."""
+    db_connection = connect_cache(hash_db)
+    try:
+        create_document_hash_table(db_connection)
+        return filter_unchanged_documents(
+            dcm_tags_list, db_connection, target, document_format, id_scheme
+        )
+    finally:
+        db_connection.close()
+
+
+def _update_document_hashes_in_db(hash_db: str, target: str, document_hashes: list):
+    """Store the content hashes with a connection to `hash_db` of the calling thread."""
+    db_connection = connect_cache(hash_db)
+    try:
+        update_document_hashes(db_connection, target, document_hashes)
+    finally:
+        db_connection.close()
 
 
 def send_bulk_to_elasticsearch(
-    dcm_tags_list: list, config: str, logger=create_logger("INFO")
+    dcm_tags_list: list,
+    config: str,
+    logger=create_logger("INFO"),
+    hash_db: str = None,
+    throttle: Throttle = None,
+    document_format: str = "dicom-json",
+    chunk_size: int = BULK_CHUNK_SIZE,
+    max_chunk_bytes: int = BULK_MAX_CHUNK_BYTES,
+    max_retries: int = BULK_MAX_RETRIES,
+    op_type: str = "index",
+    id_scheme: str = "sop-instance-uid",
 ):
     """Send list of dictionary representation of the DICOM files to Elasticsearch.
 
@@ -32,37 +221,398 @@ def send_bulk_to_elasticsearch(
         config (str): Path to config file in JSON format which defines all variables
                       related to Elasticsearch instance (url, port, index, user, pwd).
         logger (logging.Logger): Logger instance.
+        hash_db (str): Path to the SQLite cache of the content hashes of the uploaded
+                       documents. If given, the documents whose content has not changed
+                       since their last upload to the index of `config` are not sent
+                       again. Defaults to None.
+        throttle (dicom2elk.utils.throttle.Throttle): Throttle that limits the documents
+                                                      sent per second. Defaults to None.
+        document_format (str): Format of the indexed documents, 'dicom-json' or 'flattened'
+                               (see `dicom2elk.core.elasticsearch.documents`).
+                               Defaults to 'dicom-json'.
+        chunk_size (int): Maximum number of documents of each bulk request.
+        max_chunk_bytes (int): Maximum size in bytes of each bulk request.
+        max_retries (int): Maximum number of times a rejected document is sent again
+                           (see `index_documents`).
+        op_type (str): Operation of the bulk actions, 'index', 'create' or 'update'
+                       (see `index_documents`). Defaults to 'index'.
+        id_scheme (str): Scheme of the `_id` of the documents (see `get_document_id`).
+                         Defaults to 'sop-instance-uid'.
+
+    Returns:
+        dict: Counters of the upload ("es_documents_unchanged" and the counters
+              returned by `index_documents`), and the list of the paths of the
+              files whose document could not be indexed ("failed_files"), which
+              must not be recorded as saved.
 
     Note:
-        The dictionary representation of the DICOM files must contain a "filepath" key.
-        This key is used to identify the file in Elasticsearch.
+        The documents are identified in Elasticsearch by the SOPInstanceUID of
+        the DICOM files by default (see `get_document_id`), so that uploading
+        a file again does not duplicate its document.
     """
-    # Load config file
-    config = get_config(config)
-
-    # Connect to Elasticsearch instance
-    es = Elasticsearch(
-        [config["url"]],
-        http_auth=(config["user"], config["pwd"]),
-        scheme="https",
-        port=config["port"],
-    )
+    stats, failed_documents = {}, []
+    db_connection = None
+    if hash_db is not None:
+        target = get_index_target(get_elasticsearch_client(config)[1])
+        db_connection = connect_cache(hash_db)
+    try:
+        if db_connection is not None:
+            create_document_hash_table(db_connection)
+            documents, n_unchanged = filter_unchanged_documents(
+                dcm_tags_list, db_connection, target, document_format, id_scheme
+            )
+            logger.debug(f"Skipping {n_unchanged} unchanged documents")
+        else:
+            documents = [
+                (
+                    get_document_id(dcm_tags, id_scheme),
+                    None,
+                    get_document_source(dcm_tags, document_format),
+                )
+                for dcm_tags in dcm_tags_list
+            ]
+            n_unchanged = 0
+        if documents:
+            if throttle is not None:
+                throttle.wait_documents(len(documents))
+            indexed_documents, failed_documents, stats = _send_bulk_to_elasticsearch(
+                documents,
+                config,
+                logger,
+                document_format,
+                chunk_size=chunk_size,
+                max_chunk_bytes=max_chunk_bytes,
+                max_retries=max_retries,
+                op_type=op_type,
+            )
+            if db_connection is not None:
+                # The hashes are only stored once the documents are indexed
+                update_document_hashes(
+                    db_connection,
+                    target,
+                    [document[:2] for document in indexed_documents],
+                )
+    finally:
+        if db_connection is not None:
+            db_connection.close()
+    return {
+        "es_documents_unchanged": n_unchanged,
+        **stats,
+        "failed_files": get_failed_files(failed_documents),
+    }
 
-    # Create index
-    if es.indices.exists(config["index"]):
-        logger.warning(f"Index {config['index']} already exists")
-    else:
-        es.indices.create(config["index"])
+
+def get_failed_files(documents: list):
+    """Get the paths of the files of tuples (`_id`, content hash, document).
+
+    Args:
+        documents (list): Tuples of the documents that could not be indexed.
+
+    Returns:
+        list: Paths of the dicom files of the documents.
+    """
+    return [source.get("filepath") for _, _, source in documents]
+
+
+def _iter_bulk_actions(documents: list, index: str, op_type: str = "index"):
+    """Yield the bulk actions of tuples (`_id`, content hash, document)."""
+    for document_id, _, source in documents:
+        if op_type == "update":
+            # Create the document if it does not exist
+            yield {
+                "_op_type": "update",
+                "_index": index,
+                "_id": document_id,
+                "doc": source,
+                "doc_as_upsert": True,
+            }
+        else:
+            yield {
+                "_op_type": op_type,
+                "_index": index,
+                "_id": document_id,
+                "_source": source,
+            }
+
+
+def _sort_bulk_results(
+    documents: list,
+    results,
+    index: str,
+    retry: bool,
+    op_type: str = "index",
+    logger=create_logger("INFO"),
+):
+    """Sort the documents of a streaming bulk in indexed, rejected and failed documents.
+
+    Args:
+        documents (list): Tuples (`_id`, content hash, document) sent in order.
+        results (iterable): Tuples (success, item) of the documents in the same order.
+        index (str): Name of the Elasticsearch index.
+        retry (bool): If True, the documents rejected with a status of
+                      `BULK_RETRY_STATUSES` are returned to be sent again.
+                      Otherwise, they are failed.
+        op_type (str): Operation of the bulk actions. With 'create', the documents
+                       that already exist are neither indexed nor failed.
+        logger (logging.Logger): Logger instance.
+
+    Returns:
+        tuple: Tuple containing:
+                   * the list of indexed documents.
+                   * the list of documents to send again.
+                   * the list of failed documents.
+                   * the number of documents that already exist.
+    """
+    indexed, rejected, failed, n_existing = [], [], [], 0
+    for document, (success, item) in zip(documents, results):
+        if success:
+            indexed.append(document)
+            continue
+        result = next(iter(item.values()))
+        if op_type == "create" and result.get("status") == BULK_CONFLICT_STATUS:
+            n_existing += 1
+        elif retry and result.get("status") in BULK_RETRY_STATUSES:
+            rejected.append(document)
+        else:
+            failed.append(document)
+            logger.error(
+                f"Error while indexing document {document[0]} in {index}: "
+                f"{result.get('error', result.get('status'))}"
+            )
+    return indexed, rejected, failed, n_existing
+
+
+def _check_op_type(op_type: str):
+    """Raise a ValueError if an operation is not one of `BULK_OP_TYPES`."""
+    if op_type not in BULK_OP_TYPES:
+        raise ValueError(
+            f"Invalid operation: {op_type} (expected one of {list(BULK_OP_TYPES)})"
+        )
+
+
+def _get_backoff(retry: int, initial_backoff: float, max_backoff: float):
+    """Get the time to wait before a retry (exponential backoff)."""
+    return min(initial_backoff * 2 ** (retry - 1), max_backoff)
+
+
+def index_documents(
+    es: Elasticsearch,
+    documents: list,
+    index: str,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    max_chunk_bytes: int = BULK_MAX_CHUNK_BYTES,
+    max_retries: int = BULK_MAX_RETRIES,
+    initial_backoff: float = BULK_INITIAL_BACKOFF,
+    max_backoff: float = BULK_MAX_BACKOFF,
+    op_type: str = "index",
+    logger=create_logger("INFO"),
+):
+    """Index documents with streaming bulk requests and send the rejected ones again.
+
+    The bulk actions are generated as the requests are sent, and each request
+    is limited by both its number of documents and its size. The documents rejected
+    because the cluster is overloaded (statuses of `BULK_RETRY_STATUSES`) are sent
+    again after an exponential backoff. The other errors of the documents are logged
+    without failing the upload, while the connection errors are raised.
+
+    With the 'index' operation, the existing documents are replaced. With 'create',
+    they are left unchanged and counted, so that a run can be repeated without
+    indexing the same documents again. With 'update', their fields are updated
+    with the fields of the new documents, which are created if they do not exist.
+
+    Args:
+        es (elasticsearch.Elasticsearch): Elasticsearch client.
+        documents (list): Tuples (`_id`, content hash, document) to index.
+        index (str): Name of the Elasticsearch index.
+        chunk_size (int): Maximum number of documents of each bulk request.
+                          Defaults to `BULK_CHUNK_SIZE`.
+        max_chunk_bytes (int): Maximum size in bytes of each bulk request.
+                               Defaults to `BULK_MAX_CHUNK_BYTES`.
+        max_retries (int): Maximum number of times a rejected document is sent again.
+                           Defaults to `BULK_MAX_RETRIES`.
+        initial_backoff (float): Time in seconds to wait before the first retry,
+                                 doubled at each retry. Defaults to `BULK_INITIAL_BACKOFF`.
+        max_backoff (float): Maximum time in seconds to wait before a retry.
+                             Defaults to `BULK_MAX_BACKOFF`.
+        op_type (str): Operation of the bulk actions, one of `BULK_OP_TYPES`.
+                       Defaults to 'index'.
+        logger (logging.Logger): Logger instance.
+
+    Returns:
+        tuple: Tuple containing:
+                   * the list of indexed documents.
+                   * the list of documents that could not be indexed (including
+                     the ones still rejected after the last retry).
+                   * the counters of the upload ("es_documents_indexed",
+                     "es_documents_retried", "es_documents_failed" and
+                     "es_documents_existing").
+
+    Raises:
+        ValueError: If `op_type` is not one of `BULK_OP_TYPES`.
+    """
+    _check_op_type(op_type)
+    indexed, failed = [], []
+    stats = {"es_documents_retried": 0, "es_documents_existing": 0}
+    for retry in range(max_retries + 1):
+        if retry > 0:
+            stats["es_documents_retried"] += len(documents)
+            time.sleep(_get_backoff(retry, initial_backoff, max_backoff))
+        results = helpers.streaming_bulk(
+            es,
+            _iter_bulk_actions(documents, index, op_type),
+            chunk_size=chunk_size,
+            max_chunk_bytes=max_chunk_bytes,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+        indexed_documents, documents, failed_documents, n_existing = _sort_bulk_results(
+            documents, results, index, retry < max_retries, op_type, logger
+        )
+        indexed.extend(indexed_documents)
+        failed.extend(failed_documents)
+        stats["es_documents_existing"] += n_existing
+        if not documents:
+            break
+    stats["es_documents_indexed"] = len(indexed)
+    stats["es_documents_failed"] = len(failed)
+    return indexed, failed, stats
+
+
+def _send_bulk_to_elasticsearch(
+    documents: list,
+    config: str,
+    logger=create_logger("INFO"),
+    document_format: str = "dicom-json",
+    **bulk_options,
+):
+    """Send tuples (`_id`, content hash, document) to Elasticsearch with `index_documents`.
+
+    The client of the config file and the check of its index are shared by all
+    calls of the process (see `dicom2elk.core.elasticsearch.client`).
+    """
+    es, config = get_elasticsearch_client(config)
+    ensure_index(es, config["index"], get_index_mappings(document_format), logger)
 
     # Bulk upload to Elasticsearch
-    actions = [
-        {
-            "_index": config["index"],
-            "_type": "_doc",
-            "_id": i,
-            "_source": dcm_tags,
-        }
-        for i, dcm_tags in enumerate(dcm_tags_list)
-    ]
-    helpers.bulk(es, actions)
+    return index_documents(
+        es, documents, config["index"], logger=logger, **bulk_options
+    )
+
+
+async def send_bulk_to_elasticsearch_async(
+    es: AsyncElasticsearch,
+    dcm_tags_list: list,
+    index: str,
+    logger=create_logger("INFO"),
+    document_format: str = "dicom-json",
+    hash_db: str = None,
+    hash_target: str = None,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    max_chunk_bytes: int = BULK_MAX_CHUNK_BYTES,
+    max_retries: int = BULK_MAX_RETRIES,
+    initial_backoff: float = BULK_INITIAL_BACKOFF,
+    max_backoff: float = BULK_MAX_BACKOFF,
+    op_type: str = "index",
+    id_scheme: str = "sop-instance-uid",
+):
+    """Send list of dictionary representation of the DICOM files to Elasticsearch with asyncio.
+
+    The documents are indexed as by `index_documents`, with the asyncio client.
+    As with `send_bulk_to_elasticsearch`, the documents whose content has not changed
+    since their last upload are not sent again if `hash_db` is given. The cache is
+    read and written in a thread so as not to block the event loop.
+
+    Args:
+        es (elasticsearch.AsyncElasticsearch): Asyncio client of the Elasticsearch instance
+                                               (see `dicom2elk.core.elasticsearch.client`).
+        dcm_tags_list (list): List of dictionary representation of the DICOM files.
+        index (str): Name of the Elasticsearch index.
+        logger (logging.Logger): Logger instance.
+        document_format (str): Format of the indexed documents, 'dicom-json' or 'flattened'.
+        hash_db (str): Path to the SQLite cache of the content hashes of the uploaded
+                       documents (see `send_bulk_to_elasticsearch`). Defaults to None.
+        hash_target (str): Identifier of the index in the cache of the content hashes
+                           (see `get_index_target`). Defaults to `index`.
+        chunk_size (int): Maximum number of documents of each bulk request.
+        max_chunk_bytes (int): Maximum size in bytes of each bulk request.
+        max_retries (int): Maximum number of times a rejected document is sent again.
+        initial_backoff (float): Time in seconds to wait before the first retry.
+        max_backoff (float): Maximum time in seconds to wait before a retry.
+        op_type (str): Operation of the bulk actions, 'index', 'create' or 'update'.
+        id_scheme (str): Scheme of the `_id` of the documents (see `get_document_id`).
 
+    Returns:
+        dict: Counters of the upload ("es_documents_unchanged", "es_documents_indexed",
+              "es_documents_retried", "es_documents_failed" and "es_documents_existing"),
+              and the list of the paths of the files whose document could not be
+              indexed ("failed_files").
+
+    Raises:
+        ValueError: If `op_type` is not one of `BULK_OP_TYPES`.
+    """
+    _check_op_type(op_type)
+    if hash_target is None:
+        hash_target = index
+    if hash_db is not None:
+        documents, n_unchanged = await asyncio.to_thread(
+            _filter_unchanged_documents_in_db,
+            dcm_tags_list,
+            hash_db,
+            hash_target,
+            document_format,
+            id_scheme,
+        )
+        logger.debug(f"Skipping {n_unchanged} unchanged documents")
+    else:
+        documents = [
+            (
+                get_document_id(dcm_tags, id_scheme),
+                None,
+                get_document_source(dcm_tags, document_format),
+            )
+            for dcm_tags in dcm_tags_list
+        ]
+        n_unchanged = 0
+    indexed = []
+    stats = {
+        "es_documents_unchanged": n_unchanged,
+        "es_documents_indexed": 0,
+        "es_documents_retried": 0,
+        "es_documents_failed": 0,
+        "es_documents_existing": 0,
+        "failed_files": [],
+    }
+    for retry in range(max_retries + 1):
+        if retry > 0:
+            stats["es_documents_retried"] += len(documents)
+            await asyncio.sleep(_get_backoff(retry, initial_backoff, max_backoff))
+        results = [
+            result
+            async for result in helpers.async_streaming_bulk(
+                es,
+                _iter_bulk_actions(documents, index, op_type),
+                chunk_size=chunk_size,
+                max_chunk_bytes=max_chunk_bytes,
+                raise_on_error=False,
+                raise_on_exception=False,
+            )
+        ]
+        indexed_documents, documents, failed_documents, n_existing = _sort_bulk_results(
+            documents, results, index, retry < max_retries, op_type, logger
+        )
+        indexed.extend(indexed_documents)
+        stats["es_documents_failed"] += len(failed_documents)
+        stats["failed_files"].extend(get_failed_files(failed_documents))
+        stats["es_documents_existing"] += n_existing
+        if not documents:
+            break
+    stats["es_documents_indexed"] = len(indexed)
+    if hash_db is not None and indexed:
+        # The hashes are only stored once the documents are indexed
+        await asyncio.to_thread(
+            _update_document_hashes_in_db,
+            hash_db,
+            hash_target,
+            [document[:2] for document in indexed],
+        )
+    return stats
@@ -0,0 +1,186 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides the Elasticsearch clients shared by the uploads of a process.
+
+The config file of an Elasticsearch instance is read and its client is created once
+per process, at the first call of `get_elasticsearch_client`, then the client and its
+pool of keep-alive connections are reused by all batches and sink threads of the run
+(the client is thread-safe). The index is checked once per client (see `ensure_index`).
+The clients are closed with `close_elasticsearch_clients` once the run ends.
+
+The clients are not shared with the child processes: a process forked after the
+creation of a client creates its own.
+
+The asyncio clients (see `create_async_elasticsearch_client`) are bound to the event
+loop in which they are used: the 'asyncio' process handler creates one for the event
+loop of the run (see `dicom2elk.core.aio.AsyncEngine`) and checks its index with
+`ensure_index` and the client of the process.
+"""
+
+import logging
+import os
+import threading
+
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+
+from dicom2elk.utils.config import get_config
+from dicom2elk.utils.logging import create_logger
+
+
+# Maximum number of connections kept alive to each node of the cluster
+ES_CONNECTIONS_PER_NODE = 16
+
+# Timeout in seconds of a request (bulk requests of several MB can be slow to index)
+ES_REQUEST_TIMEOUT = 60
+
+# Maximum number of times a request that failed on a connection error or a timeout is sent again
+ES_MAX_RETRIES = 3
+
+# Clients indexed by process id and path to config file, with their config
+_clients = {}
+
+# Indices checked by `ensure_index`, indexed by process id, client and name
+_checked_indices = set()
+
+_clients_lock = threading.Lock()
+
+
+def get_client_options(
+    config: dict, connections_per_node: int = ES_CONNECTIONS_PER_NODE
+):
+    """Get the keyword arguments of the Elasticsearch clients of a config.
+
+    Args:
+        config (dict): Dictionary loaded from the config file in JSON format which defines
+                       all variables related to Elasticsearch instance
+                       (url, port, index, user, pwd).
+        connections_per_node (int): Maximum number of connections kept alive to each node.
+                                    Defaults to `ES_CONNECTIONS_PER_NODE`.
+
+    Returns:
+        dict: Keyword arguments of `elasticsearch.Elasticsearch` and
+              `elasticsearch.AsyncElasticsearch`.
+    """
+    return {
+        "hosts": [{"host": config["url"], "port": config["port"], "scheme": "https"}],
+        "basic_auth": (config["user"], config["pwd"]),
+        "connections_per_node": connections_per_node,
+        "request_timeout": ES_REQUEST_TIMEOUT,
+        "max_retries": ES_MAX_RETRIES,
+        "retry_on_timeout": True,
+    }
+
+
+def create_elasticsearch_client(
+    config: dict, connections_per_node: int = ES_CONNECTIONS_PER_NODE
+):
+    """Connect to the Elasticsearch instance of a config.
+
+    Args:
+        config (dict): Dictionary loaded from the config file in JSON format which defines
+                       all variables related to Elasticsearch instance
+                       (url, port, index, user, pwd).
+        connections_per_node (int): Maximum number of connections kept alive to each node.
+                                    Defaults to `ES_CONNECTIONS_PER_NODE`.
+
+    Returns:
+        elasticsearch.Elasticsearch: Client to close after use.
+    """
+    return Elasticsearch(**get_client_options(config, connections_per_node))
+
+
+def create_async_elasticsearch_client(
+    config: dict, connections_per_node: int = ES_CONNECTIONS_PER_NODE
+):
+    """Connect to the Elasticsearch instance of a config with the asyncio client.
+
+    Args:
+        config (dict): Dictionary loaded from the config file in JSON format which defines
+                       all variables related to Elasticsearch instance
+                       (url, port, index, user, pwd).
+        connections_per_node (int): Maximum number of connections kept alive to each node.
+                                    Defaults to `ES_CONNECTIONS_PER_NODE`.
+
+    Returns:
+        elasticsearch.AsyncElasticsearch: Asyncio client to close after use, in the
+                                          event loop in which it is used.
+    """
+    return AsyncElasticsearch(**get_client_options(config, connections_per_node))
+
+
+def get_elasticsearch_client(
+    config_file: str, connections_per_node: int = ES_CONNECTIONS_PER_NODE
+):
+    """Get the client of the Elasticsearch instance of a config file in the current process.
+
+    Args:
+        config_file (str): Path to config file in JSON format which defines all variables
+                           related to Elasticsearch instance (url, port, index, user, pwd).
+        connections_per_node (int): Maximum number of connections kept alive to each node,
+                                    used if the client is created by this call.
+                                    Defaults to `ES_CONNECTIONS_PER_NODE`.
+
+    Returns:
+        tuple: Tuple containing:
+                   * the client (`elasticsearch.Elasticsearch`), closed by
+                     `close_elasticsearch_clients`.
+                   * the config loaded from `config_file`.
+    """
+    key = (os.getpid(), os.path.abspath(config_file))
+    with _clients_lock:
+        if key not in _clients:
+            config = get_config(config_file)
+            _clients[key] = (
+                create_elasticsearch_client(config, connections_per_node),
+                config,
+            )
+        return _clients[key]
+
+
+def ensure_index(
+    es: Elasticsearch,
+    index: str,
+    mappings: dict = None,
+    logger: logging.Logger = create_logger("INFO"),
+):
+    """Create an index if it does not exist, once per client.
+
+    Args:
+        es (elasticsearch.Elasticsearch): Client returned by `get_elasticsearch_client`.
+        index (str): Name of the index.
+        mappings (dict): Mappings of the index if it is created. Defaults to None.
+        logger (logging.Logger): Logger instance.
+    """
+    key = (os.getpid(), id(es), index)
+    with _clients_lock:
+        if key in _checked_indices:
+            return
+        if es.indices.exists(index=index):
+            logger.warning(f"Index {index} already exists")
+        else:
+            es.indices.create(index=index, mappings=mappings)
+        _checked_indices.add(key)
+
+
+def close_elasticsearch_clients():
+    """Close the clients created by `get_elasticsearch_client` in the current process."""
+    pid = os.getpid()
+    with _clients_lock:
+        for key in [key for key in _clients if key[0] == pid]:
+            es, _ = _clients.pop(key)
+            es.close()
+        _checked_indices.difference_update(
+            [key for key in _checked_indices if key[0] == pid]
+        )
@@ -0,0 +1,201 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides the formats of the documents indexed in Elasticsearch.
+
+In the 'dicom-json' format, the documents are indexed as extracted, in the DICOM
+JSON Model::
+
+    {"00100010": {"vr": "PN", "Value": [{"Alphabetic": "Doe^John"}]},
+     "00080020": {"vr": "DA", "Value": ["20040826"]}, ...}
+
+In the 'flattened' format, the fields are named after the DICOM keyword of their
+tag, single values are unwrapped and the values are converted to the types of
+Elasticsearch, which keeps the mapping small and allows range queries::
+
+    {"PatientName": "Doe^John", "StudyDate": "2004-08-26", "StudyTime": "18:50:59.500",
+     "ImageType": ["ORIGINAL", "PRIMARY"], "SeriesNumber": 3, ...,
+     "PrivateTags": {"00291010": ...}}
+
+DA, DT and TM values are detected as dates by the mappings returned by
+`get_index_mappings`, IS and DS values are converted to numbers, person names
+are reduced to their alphabetic representation and sequences are converted to
+(lists of) objects. Binary values and invalid dates or numbers are dropped.
+"""
+
+from functools import lru_cache
+
+from pydicom.datadict import keyword_for_tag
+
+from dicom2elk.core.dicom.values import parse_date, parse_datetime, parse_time
+
+
+# Formats of the documents indexed in Elasticsearch
+ES_DOCUMENT_FORMATS = ("dicom-json", "flattened")
+
+# Field of the private tags in the 'flattened' format
+PRIVATE_TAGS_FIELD = "PrivateTags"
+
+# Formats of the strings detected as dates in the 'flattened' format
+# (DA, DT with and without offset, and TM values, see `flatten_dicom_json`)
+FLATTENED_DYNAMIC_DATE_FORMATS = [
+    "strict_date",
+    "strict_date_time||strict_date_hour_minute_second_fraction",
+    "strict_hour_minute_second_fraction",
+]
+
+
+def is_private_tag(tag: str):
+    """Check if a key of the DICOM JSON Model is a private tag (odd group number).
+
+    Args:
+        tag (str): Tag in the format of the DICOM JSON Model (e.g. "00291010").
+
+    Returns:
+        bool: True if `tag` is a private tag.
+    """
+    try:
+        return len(tag) == 8 and int(tag[:4], 16) % 2 == 1
+    except ValueError:
+        return False
+
+
+@lru_cache(maxsize=None)
+def get_field_name(tag: str):
+    """Get the name of the field of a tag in the 'flattened' format.
+
+    Args:
+        tag (str): Tag in the format of the DICOM JSON Model (e.g. "00100010").
+
+    Returns:
+        str: DICOM keyword of the tag (e.g. "PatientName"), or the tag itself
+             if it has none.
+    """
+    try:
+        return keyword_for_tag(int(tag, 16)) or tag
+    except ValueError:
+        return tag
+
+
+def _convert_value(value, vr: str):
+    """Convert a value of the DICOM JSON Model to its Elasticsearch type (None if invalid)."""
+    if value is None:
+        return None
+    if vr == "SQ":
+        return flatten_dicom_json(value)
+    if vr == "PN":
+        if not isinstance(value, dict):
+            return str(value)
+        return next(
+            (
+                value[group]
+                for group in ("Alphabetic", "Ideographic", "Phonetic")
+                if value.get(group)
+            ),
+            None,
+        )
+    if vr == "DA":
+        parsed_value = parse_date(value)
+        return parsed_value.isoformat() if parsed_value is not None else None
+    if vr in ("TM", "DT"):
+        # Elasticsearch dates have a precision of a millisecond
+        parsed_value = parse_time(value) if vr == "TM" else parse_datetime(value)
+        if parsed_value is None:
+            return None
+        return parsed_value.isoformat(timespec="milliseconds")
+    try:
+        if vr == "IS":
+            return int(float(value))
+        if vr == "DS":
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return value
+
+
+def flatten_dicom_json(json_dict: dict):
+    """Convert a document in the DICOM JSON Model to the 'flattened' format.
+
+    Args:
+        json_dict (dict): Document returned by
+                          `dicom2elk.core.dicom.metadata.extract_metadata_from_dcm`
+                          (or item of a sequence).
+
+    Returns:
+        dict: Document with a field per tag that has a value. The private tags are
+              gathered in the `PRIVATE_TAGS_FIELD` object under their tag. The other
+              keys (e.g. "filepath") are kept as is.
+    """
+    document = {}
+    private_tags = {}
+    for key, element in json_dict.items():
+        if not isinstance(element, dict) or "vr" not in element:
+            document[key] = element
+            continue
+        values = [
+            converted_value
+            for converted_value in (
+                _convert_value(value, element["vr"])
+                for value in element.get("Value", [])
+            )
+            if converted_value is not None
+        ]
+        if not values:
+            continue
+        value = values[0] if len(values) == 1 else values
+        if is_private_tag(key):
+            private_tags[key] = value
+        else:
+            document[get_field_name(key)] = value
+    if private_tags:
+        document[PRIVATE_TAGS_FIELD] = private_tags
+    return document
+
+
+def get_document_source(dcm_tags: dict, document_format: str = "dicom-json"):
+    """Get the source of the document of a DICOM file in a format of `ES_DOCUMENT_FORMATS`.
+
+    Args:
+        dcm_tags (dict): Dictionary representation of the DICOM file.
+        document_format (str): Format of the document ('dicom-json' or 'flattened').
+                               Defaults to 'dicom-json'.
+
+    Returns:
+        dict: Source of the document.
+
+    Raises:
+        ValueError: If `document_format` is not one of `ES_DOCUMENT_FORMATS`.
+    """
+    if document_format == "dicom-json":
+        return dcm_tags
+    if document_format == "flattened":
+        return flatten_dicom_json(dcm_tags)
+    raise ValueError(
+        f"Invalid document format: {document_format} "
+        f"(expected one of {list(ES_DOCUMENT_FORMATS)})"
+    )
+
+
+def get_index_mappings(document_format: str = "dicom-json"):
+    """Get the mappings of a new index for a document format.
+
+    Args:
+        document_format (str): Format of the documents ('dicom-json' or 'flattened').
+
+    Returns:
+        dict: Mappings of the index, or None to use the default dynamic mappings.
+    """
+    if document_format == "flattened":
+        return {"dynamic_date_formats": FLATTENED_DYNAMIC_DATE_FORMATS}
+    return None
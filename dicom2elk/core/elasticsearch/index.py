@@ -0,0 +1,413 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that manages the Elasticsearch index during a bulk load.
+
+Before the first batch of a run in 'elasticsearch' mode (see `bulk_load_index`):
+
+* an index template named ``dicom2elk-<index>`` is put with explicit mappings of the
+  extracted tags (the included tags of the config file, or the tags of all presets)
+  typed after their VR (see `get_template_mappings`). The private tags are kept in the
+  documents but are not mapped (``dynamic: false``), so that they do not make the
+  mapping explode,
+* the index is created if it does not exist, with the mappings of the template,
+* the refresh is disabled (``refresh_interval: -1``) and the replicas are removed
+  (``number_of_replicas: 0``) to speed up the indexing.
+
+Once the run ends, even if it fails, the original settings are restored
+and the index is refreshed so that the documents can be searched.
+
+The original settings are saved in the ``_meta`` of the mappings of the index before
+the bulk load settings are applied, with the runs that are loading the index. So, the
+original settings are not lost if a run is killed before it restores them, and several
+runs can load the same index at the same time (e.g. on several nodes): the settings are
+only restored by the last run to finish. The runs that were killed are not counted
+(see `_is_live_run`).
+"""
+
+import logging
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+import psutil
+from elasticsearch import Elasticsearch
+from pydicom.datadict import dictionary_VR, keyword_for_tag
+from pydicom.tag import Tag
+
+from dicom2elk.core.dicom.tags import TAG_PRESETS, resolve_tags
+from dicom2elk.core.elasticsearch.client import get_elasticsearch_client
+from dicom2elk.core.elasticsearch.documents import (
+    FLATTENED_DYNAMIC_DATE_FORMATS,
+    PRIVATE_TAGS_FIELD,
+)
+from dicom2elk.utils.logging import create_logger
+
+
+# Settings of the index during a bulk load
+BULK_LOAD_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+
+# Key of the original settings and of the runs of a bulk load in the `_meta` of the index
+BULK_LOAD_META_KEY = "dicom2elk_bulk_load"
+
+# Time in seconds after which a run of another host is considered to have been killed
+BULK_LOAD_RUN_TIMEOUT = 24 * 3600
+
+# Names of the private tags in the DICOM JSON Model (odd group number)
+PRIVATE_TAG_PATTERN = "^[0-9A-Fa-f]{3}[13579BDFbdf][0-9A-Fa-f]{4}$"
+
+# Mappings of the strings that are searched as text and as keywords
+TEXT_MAPPING = {
+    "type": "text",
+    "fields": {"keyword": {"type": "keyword", "ignore_above": 256}},
+}
+
+# Mappings of the values indexed by VR (the other VRs are mapped as keywords)
+VR_MAPPINGS = {
+    "IS": {"type": "long", "ignore_malformed": True},
+    "SS": {"type": "long"},
+    "US": {"type": "long"},
+    "SL": {"type": "long"},
+    "UL": {"type": "long"},
+    "SV": {"type": "long"},
+    "UV": {"type": "unsigned_long"},
+    "DS": {"type": "double", "ignore_malformed": True},
+    "FL": {"type": "double"},
+    "FD": {"type": "double"},
+    "LO": TEXT_MAPPING,
+    "LT": TEXT_MAPPING,
+    "PN": TEXT_MAPPING,
+    "SH": TEXT_MAPPING,
+    "ST": TEXT_MAPPING,
+    "UC": TEXT_MAPPING,
+    "UT": TEXT_MAPPING,
+}
+
+# Mappings of the dates by VR and document format
+DATE_MAPPINGS = {
+    "dicom-json": {
+        # DA values are the only dates with a fixed format in the DICOM JSON Model
+        "DA": {"type": "date", "format": "basic_date", "ignore_malformed": True},
+    },
+    "flattened": {
+        "DA": {"type": "date", "format": FLATTENED_DYNAMIC_DATE_FORMATS[0]},
+        "DT": {"type": "date", "format": FLATTENED_DYNAMIC_DATE_FORMATS[1]},
+        "TM": {"type": "date", "format": FLATTENED_DYNAMIC_DATE_FORMATS[2]},
+    },
+}
+
+# VRs whose values are not mapped explicitly
+UNMAPPED_VRS = {"SQ", "OB", "OD", "OF", "OL", "OV", "OW", "UN"}
+
+
+def _get_value_mapping(vr: str, document_format: str):
+    """Get the mapping of the values of a VR (None if they are not mapped explicitly)."""
+    vrs = vr.split(" or ")
+    if any(vr in UNMAPPED_VRS for vr in vrs):
+        return None
+    mappings = [
+        DATE_MAPPINGS[document_format].get(vr) or VR_MAPPINGS.get(vr, {"type": "keyword"})
+        for vr in vrs
+    ]
+    if any(mapping != mappings[0] for mapping in mappings):
+        # e.g. "US or SS" values are numbers but "US or OW" are not mapped
+        return {"type": "keyword"}
+    mapping = dict(mappings[0])
+    if vr == "PN" and document_format == "dicom-json":
+        # Person names are objects with a representation per group
+        return {
+            "properties": {
+                group: dict(TEXT_MAPPING)
+                for group in ("Alphabetic", "Ideographic", "Phonetic")
+            }
+        }
+    return mapping
+
+
+def get_template_mappings(tags: list = None, document_format: str = "dicom-json"):
+    """Get the explicit mappings of the index template.
+
+    Args:
+        tags (list): Tags to map (e.g. the included tags returned by
+                     `dicom2elk.core.dicom.tags.get_tag_selection`). If None, the tags
+                     of all presets of `dicom2elk.core.dicom.tags.TAG_PRESETS` are mapped.
+        document_format (str): Format of the documents ('dicom-json' or 'flattened',
+                               see `dicom2elk.core.elasticsearch.documents`).
+
+    Returns:
+        dict: Mappings of the index. The other public tags are mapped dynamically
+              and the private tags are not mapped.
+    """
+    if tags is None:
+        tags = resolve_tags(list(TAG_PRESETS))
+    properties = {"filepath": {"type": "keyword"}}
+    for tag in tags:
+        tag = Tag(tag)
+        if tag.is_private:
+            continue
+        try:
+            vr = dictionary_VR(tag)
+        except KeyError:
+            continue
+        value_mapping = _get_value_mapping(vr, document_format)
+        if value_mapping is None:
+            continue
+        if document_format == "flattened":
+            properties[keyword_for_tag(tag) or f"{tag:08X}"] = value_mapping
+        else:
+            properties[f"{tag:08X}"] = {
+                "properties": {"vr": {"type": "keyword"}, "Value": value_mapping}
+            }
+    # The private tags (also in the items of sequences) are objects whose fields
+    # are not mapped: in the 'flattened' format, they are gathered in an object
+    # (see `dicom2elk.core.elasticsearch.documents.flatten_dicom_json`)
+    private_tags_template = {
+        "match_mapping_type": "object",
+        "mapping": {"type": "object", "dynamic": False},
+    }
+    if document_format == "flattened":
+        private_tags_template["match"] = PRIVATE_TAGS_FIELD
+    else:
+        private_tags_template["match_pattern"] = "regex"
+        private_tags_template["match"] = PRIVATE_TAG_PATTERN
+    mappings = {
+        "dynamic_templates": [{"private_tags": private_tags_template}],
+        "properties": properties,
+    }
+    if document_format == "flattened":
+        mappings["dynamic_date_formats"] = FLATTENED_DYNAMIC_DATE_FORMATS
+    return mappings
+
+
+def put_index_template(
+    es: Elasticsearch,
+    index: str,
+    mappings: dict,
+    logger: logging.Logger = create_logger("INFO"),
+):
+    """Put the index template of an index and create the index if it does not exist.
+
+    Args:
+        es (elasticsearch.Elasticsearch): Elasticsearch client.
+        index (str): Name of the index.
+        mappings (dict): Mappings returned by `get_template_mappings`.
+        logger (logging.Logger): Logger instance.
+    """
+    es.indices.put_index_template(
+        name=f"dicom2elk-{index}",
+        index_patterns=[index],
+        template={"mappings": mappings},
+        # Take precedence over the built-in templates
+        priority=200,
+    )
+    if es.indices.exists(index=index):
+        logger.warning(
+            f"Index {index} already exists, the mappings of the template only apply "
+            "to new indices"
+        )
+    else:
+        es.indices.create(index=index)
+
+
+def resolve_index(es: Elasticsearch, index: str):
+    """Get the concrete index of a name that can be an alias.
+
+    Args:
+        es (elasticsearch.Elasticsearch): Elasticsearch client.
+        index (str): Name of an index or of an alias.
+
+    Returns:
+        str: Name of the index, or of the write index of the alias (or of its only index).
+
+    Raises:
+        ValueError: If `index` is an alias of several indices without write index.
+    """
+    if not es.indices.exists_alias(name=index):
+        return index
+    indices = es.indices.get_alias(name=index)
+    if len(indices) == 1:
+        return next(iter(indices))
+    write_indices = [
+        name
+        for name, value in indices.items()
+        if value["aliases"][index].get("is_write_index")
+    ]
+    if len(write_indices) != 1:
+        raise ValueError(f"Alias {index} points to several indices without write index.")
+    return write_indices[0]
+
+
+def _get_meta(es: Elasticsearch, index: str):
+    """Get the `_meta` of the mappings of an index."""
+    response = es.indices.get_mapping(index=index)
+    return dict(response[index]["mappings"].get("_meta", {}))
+
+
+def _is_live_run(run: dict):
+    """Check if a run of a bulk load recorded in the `_meta` of the index is still running."""
+    if run["host"] == socket.gethostname():
+        return psutil.pid_exists(run["pid"])
+    return time.time() - run["started"] < BULK_LOAD_RUN_TIMEOUT
+
+
+def _is_bulk_load_value(name: str, value):
+    """Check if the value of a setting is the one of `BULK_LOAD_SETTINGS`."""
+    return value is not None and str(value) == str(BULK_LOAD_SETTINGS[name])
+
+
+def apply_bulk_load_settings(
+    es: Elasticsearch, index: str, logger: logging.Logger = create_logger("INFO")
+):
+    """Disable the refresh and the replicas of an index for a bulk load.
+
+    The original values of the settings are saved in the `_meta` of the index by the
+    first run, with the id of the run, before the settings are changed. The values
+    equal to the ones of `BULK_LOAD_SETTINGS` (left by a killed run of an older version)
+    are not taken as original values: the settings are reset to their default instead.
+
+    Args:
+        es (elasticsearch.Elasticsearch): Elasticsearch client.
+        index (str): Name of the index (not an alias, see `resolve_index`).
+        logger (logging.Logger): Logger instance.
+
+    Returns:
+        str: Id of the run, to pass to `restore_index_settings`.
+    """
+    meta = _get_meta(es, index)
+    bulk_load = meta.get(BULK_LOAD_META_KEY)
+    runs = {}
+    if bulk_load is not None:
+        runs = {
+            run_id: run for run_id, run in bulk_load["runs"].items() if _is_live_run(run)
+        }
+        original_settings = bulk_load["original_settings"]
+    else:
+        response = es.indices.get_settings(index=index)
+        index_settings = response[index]["settings"]["index"]
+        original_settings = {}
+        for name in BULK_LOAD_SETTINGS:
+            value = index_settings.get(name)
+            if _is_bulk_load_value(name, value):
+                logger.warning(
+                    f"Setting {name} of index {index} has its bulk load value {value}, "
+                    "it will be reset to its default"
+                )
+                value = None
+            original_settings[name] = value
+    run_id = f"{socket.gethostname()}:{os.getpid()}:{time.time()}"
+    runs[run_id] = {"host": socket.gethostname(), "pid": os.getpid(), "started": time.time()}
+    meta[BULK_LOAD_META_KEY] = {"original_settings": original_settings, "runs": runs}
+    # The original settings are saved before they are changed
+    es.indices.put_mapping(index=index, meta=meta)
+    es.indices.put_settings(index=index, settings={"index": BULK_LOAD_SETTINGS})
+    logger.info(f"Bulk load settings of index {index}: {BULK_LOAD_SETTINGS}")
+    return run_id
+
+
+def restore_index_settings(
+    es: Elasticsearch,
+    index: str,
+    run_id: str,
+    logger: logging.Logger = create_logger("INFO"),
+):
+    """Restore the settings of an index after a bulk load and refresh it.
+
+    The settings are only restored by the last of the runs that are loading the index,
+    with the original settings saved in the `_meta` of the index.
+
+    Args:
+        es (elasticsearch.Elasticsearch): Elasticsearch client.
+        index (str): Name of the index (not an alias, see `resolve_index`).
+        run_id (str): Id of the run returned by `apply_bulk_load_settings`.
+        logger (logging.Logger): Logger instance.
+    """
+    meta = _get_meta(es, index)
+    bulk_load = meta.pop(BULK_LOAD_META_KEY, None)
+    if bulk_load is None:
+        logger.warning(f"No original settings of index {index} to restore")
+        return
+    runs = {
+        other_run_id: run
+        for other_run_id, run in bulk_load["runs"].items()
+        if other_run_id != run_id and _is_live_run(run)
+    }
+    if runs:
+        bulk_load["runs"] = runs
+        meta[BULK_LOAD_META_KEY] = bulk_load
+        es.indices.put_mapping(index=index, meta=meta)
+        logger.info(
+            f"The settings of index {index} will be restored by the last of "
+            f"{len(runs)} other runs"
+        )
+        return
+    original_settings = bulk_load["original_settings"]
+    es.indices.put_settings(index=index, settings={"index": original_settings})
+    es.indices.put_mapping(index=index, meta=meta)
+    es.indices.refresh(index=index)
+    logger.info(f"Restored the settings of index {index}: {original_settings}")
+
+
+@contextmanager
+def bulk_load_index(
+    config_file: str,
+    tags: list = None,
+    document_format: str = "dicom-json",
+    index_template: bool = True,
+    bulk_load_settings: bool = True,
+    logger: logging.Logger = create_logger("INFO"),
+):
+    """Prepare the index of a config for a bulk load and restore it once the load ends.
+
+    Args:
+        config_file (str): Path to config file in JSON format which defines all variables
+                           related to Elasticsearch instance (url, port, index, user, pwd).
+        tags (list): Tags mapped by the index template (see `get_template_mappings`).
+        document_format (str): Format of the documents ('dicom-json' or 'flattened').
+        index_template (bool): If True, the index template is put and the index is created
+                               if it does not exist (see `put_index_template`).
+        bulk_load_settings (bool): If True, the settings of `BULK_LOAD_SETTINGS` are applied
+                                   during the load, and the original settings are restored
+                                   and the index is refreshed when it ends, even if it fails
+                                   (by the last run if several runs load the index). If the
+                                   index of the config is an alias, the settings of its
+                                   write index are changed.
+        logger (logging.Logger): Logger instance.
+
+    Yields:
+        None
+
+    Note:
+        The client of the config file is shared with the uploads of the process
+        (see `dicom2elk.core.elasticsearch.client.get_elasticsearch_client`) and is
+        left open.
+    """
+    if not index_template and not bulk_load_settings:
+        yield
+        return
+    es, config = get_elasticsearch_client(config_file)
+    index = config["index"]
+    if index_template:
+        put_index_template(
+            es, index, get_template_mappings(tags, document_format), logger
+        )
+    run_id = None
+    if bulk_load_settings:
+        index = resolve_index(es, index)
+        run_id = apply_bulk_load_settings(es, index, logger)
+    try:
+        yield
+    finally:
+        if run_id is not None:
+            restore_index_settings(es, index, run_id, logger)
@@ -0,0 +1,200 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides the writer of the 'ndjson' mode.
+
+The documents are appended as compact one-line JSON objects to shard files
+(optionally compressed with gzip or zstd on the fly) named after the dicom list
+file::
+
+    <list name>-<YYYYmmddTHHMMSS>-<pid>-<shard index>.ndjson[.gz|.zst]
+
+A shard is written under a hidden temporary name (``.<shard name>.tmp``) and is
+renamed to its final name only once it is complete and synchronized to disk,
+so that shippers such as Filebeat or Logstash never read a partial shard.
+A shard is kept open across the batches of a run and is only closed once it
+reaches its maximum size (before compression) or its maximum number of
+documents, and at the end of the run. The batches are recorded as completed
+once their documents are in published shards (see `get_n_published_documents` and
+`dicom2elk.core.process.create_sink_pipeline`).
+"""
+
+import gzip
+import json
+import logging
+import os
+import time
+
+from dicom2elk.utils.logging import create_logger
+
+
+# Compressions of the NDJSON shards and extensions of their files
+NDJSON_COMPRESSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# Default maximum size in bytes of a shard before compression
+NDJSON_SHARD_MAX_BYTES = 256 * 1024**2
+
+
+class NDJSONShardWriter:
+    """Append documents to rolling NDJSON shard files.
+
+    Args:
+        output_dir (str): Path to output directory.
+        prefix (str): Prefix of the shard names (e.g. the name of the dicom list file).
+        compression (str): Compression of the shards ('none', 'gzip' or 'zstd').
+                           'zstd' requires the `zstandard` package. Defaults to 'none'.
+        max_shard_bytes (int): Maximum size of a shard in bytes before compression.
+                               Defaults to `NDJSON_SHARD_MAX_BYTES`.
+        max_shard_documents (int): Maximum number of documents of a shard.
+                                   If None, the shards are only limited by their size.
+        logger (logging.Logger): Logger instance.
+
+    Raises:
+        ValueError: If `compression` is not one of `NDJSON_COMPRESSIONS`.
+        ImportError: If `compression` is 'zstd' and `zstandard` is not installed.
+
+    Note:
+        The writer is not thread-safe. It is used by a single sink thread
+        and must be closed with `close` to publish the last shard.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        prefix: str,
+        compression: str = "none",
+        max_shard_bytes: int = NDJSON_SHARD_MAX_BYTES,
+        max_shard_documents: int = None,
+        logger: logging.Logger = create_logger("INFO"),
+    ):
+        if compression not in NDJSON_COMPRESSIONS:
+            raise ValueError(
+                f"Invalid compression: {compression} "
+                f"(expected one of {list(NDJSON_COMPRESSIONS)})"
+            )
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError(
+                    "The 'zstandard' package is required to compress the shards with zstd."
+                )
+            self._zstd_compressor = zstandard.ZstdCompressor()
+        self.output_dir = output_dir
+        self.compression = compression
+        self.max_shard_bytes = max_shard_bytes
+        self.max_shard_documents = max_shard_documents
+        self.logger = logger
+        # Shards of different runs of the same list do not overwrite each other
+        self._basename = f"{prefix}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self._n_shards = 0
+        self._raw_file = None
+        self._file = None
+        self._shard_file = None
+        self._shard_bytes = 0
+        self._shard_documents = 0
+        self.shard_files = []
+        # Number of documents of the published shards
+        self._n_published_documents = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open_shard(self):
+        """Open the next shard under its temporary name."""
+        self._shard_file = os.path.join(
+            self.output_dir,
+            f"{self._basename}-{self._n_shards:05d}.ndjson"
+            + NDJSON_COMPRESSIONS[self.compression],
+        )
+        self._n_shards += 1
+        self._raw_file = open(self._get_temp_file(self._shard_file), "wb")
+        if self.compression == "gzip":
+            self._file = gzip.GzipFile(fileobj=self._raw_file, mode="wb")
+        elif self.compression == "zstd":
+            self._file = self._zstd_compressor.stream_writer(
+                self._raw_file, closefd=False
+            )
+        else:
+            self._file = self._raw_file
+        self._shard_bytes = 0
+        self._shard_documents = 0
+
+    @staticmethod
+    def _get_temp_file(shard_file: str):
+        return os.path.join(
+            os.path.dirname(shard_file), "." + os.path.basename(shard_file) + ".tmp"
+        )
+
+    def write(self, documents: list):
+        """Append documents to the current shard, rolling over to a new shard when it is full.
+
+        Args:
+            documents (list): Documents to write (JSON serializable dictionaries).
+
+        Returns:
+            dict: Counters of the write ("ndjson_shards" closed because they were full).
+        """
+        n_closed = 0
+        for document in documents:
+            if self._file is None:
+                self._open_shard()
+            line = (json.dumps(document, separators=(",", ":")) + "\n").encode()
+            self._file.write(line)
+            self._shard_bytes += len(line)
+            self._shard_documents += 1
+            if self._shard_bytes >= self.max_shard_bytes or (
+                self.max_shard_documents is not None
+                and self._shard_documents >= self.max_shard_documents
+            ):
+                n_closed += self.close_shard()["ndjson_shards"]
+        return {"ndjson_shards": n_closed}
+
+    def close_shard(self):
+        """Complete the current shard and publish it under its final name.
+
+        Returns:
+            dict: Counters of the call ("ndjson_shards" closed: 0 or 1).
+        """
+        if self._file is None:
+            return {"ndjson_shards": 0}
+        if self._file is not self._raw_file:
+            # Write the end of the compressed stream
+            self._file.close()
+        self._raw_file.flush()
+        os.fsync(self._raw_file.fileno())
+        self._raw_file.close()
+        os.replace(self._get_temp_file(self._shard_file), self._shard_file)
+        self.logger.debug(
+            f"Closed {self._shard_file} ({self._shard_documents} documents)"
+        )
+        self.shard_files.append(self._shard_file)
+        self._n_published_documents += self._shard_documents
+        self._file, self._raw_file = None, None
+        return {"ndjson_shards": 1}
+
+    def get_n_published_documents(self):
+        """Get the number of documents written to the shards published so far.
+
+        Returns:
+            int: Number of documents of the published shards.
+        """
+        return self._n_published_documents
+
+    def close(self):
+        """Close the last shard."""
+        return self.close_shard()
@@ -0,0 +1,298 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides the writer of the 'parquet' mode.
+
+The configured tags of each document are flattened into typed columns named
+after their DICOM keyword, so that the metadata can be loaded by pandas or Spark
+with column pruning and predicate pushdown::
+
+    StudyDate (date), StudyTime (time), SeriesNumber (int64),
+    ImageType (list of strings), PatientName (string), ..., filepath (string)
+
+The type of a column is given by the VR of its tag in the DICOM data dictionary
+(see `get_parquet_columns`) and multi-valued tags are stored as lists. Sequences
+and binary values are not exported. The documents of a run are written to a single
+Parquet file named after the dicom list file, with a row group per batch::
+
+    <list name>-<YYYYmmddTHHMMSS>-<pid>.parquet
+
+The file is written under a hidden temporary name (``.<file name>.tmp``) and is
+renamed to its final name once it is complete and synchronized to disk.
+The `pyarrow` package is required.
+"""
+
+import logging
+import os
+import time
+
+from pydicom.datadict import dictionary_VM, dictionary_VR, keyword_for_tag
+from pydicom.tag import Tag
+
+from dicom2elk.core.dicom.tags import TAG_PRESETS, resolve_tags
+from dicom2elk.core.dicom.values import parse_date, parse_time
+from dicom2elk.utils.logging import create_logger
+
+
+# Compressions of the Parquet files
+PARQUET_COMPRESSIONS = ("none", "snappy", "gzip", "zstd")
+
+# Column of the path of the dicom file of each document
+FILEPATH_COLUMN = "filepath"
+
+# Types of the columns indexed by VR (the other VRs are stored as strings)
+PARQUET_VR_TYPES = {
+    "DA": "date",
+    "TM": "time",
+    "IS": "int",
+    "SS": "int",
+    "US": "int",
+    "SL": "int",
+    "UL": "int",
+    "SV": "int",
+    "UV": "uint",
+    "DS": "float",
+    "FL": "float",
+    "FD": "float",
+}
+
+# VRs whose values are not exported
+PARQUET_SKIPPED_VRS = {"SQ", "OB", "OD", "OF", "OL", "OV", "OW", "UN"}
+
+
+def get_parquet_columns(tags: list = None):
+    """Get the columns of the Parquet files from a list of tags.
+
+    Args:
+        tags (list): Tags to export (e.g. the included tags returned by
+                     `dicom2elk.core.dicom.tags.get_tag_selection`). If None, the tags
+                     of all presets of `dicom2elk.core.dicom.tags.TAG_PRESETS` are exported.
+
+    Returns:
+        list: Columns as tuples containing:
+                  * the tag in the format of the DICOM JSON Model (e.g. "0020000D").
+                  * the name of the column (DICOM keyword or tag if it has none).
+                  * the type of the column ('date', 'time', 'int', 'uint', 'float'
+                    or 'string').
+                  * True if the column contains lists of values (VM other than 1).
+              Sequences and binary values are not exported.
+    """
+    if tags is None:
+        tags = resolve_tags(list(TAG_PRESETS))
+    columns = []
+    for tag in tags:
+        tag = Tag(tag)
+        try:
+            vr, vm = dictionary_VR(tag), dictionary_VM(tag)
+        except KeyError:
+            # Private or unknown tag (its values are stored as strings)
+            vr, vm = "LO", "1-n"
+        vrs = vr.split(" or ")
+        if any(vr in PARQUET_SKIPPED_VRS for vr in vrs):
+            continue
+        column_types = {PARQUET_VR_TYPES.get(vr, "string") for vr in vrs}
+        columns.append(
+            (
+                f"{tag:08X}",
+                keyword_for_tag(tag) or f"{tag:08X}",
+                column_types.pop() if len(column_types) == 1 else "string",
+                vm != "1",
+            )
+        )
+    return columns
+
+
+def _convert_value(value, column_type: str):
+    """Convert a value of the DICOM JSON Model to the type of its column (None if invalid)."""
+    if value is None:
+        return None
+    if column_type == "date":
+        return parse_date(value)
+    if column_type == "time":
+        return parse_time(value)
+    try:
+        if column_type in ("int", "uint"):
+            return int(float(value))
+        if column_type == "float":
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(value, dict):
+        # Person name
+        return value.get("Alphabetic")
+    return str(value)
+
+
+def flatten_document(json_dict: dict, columns: list):
+    """Flatten a document in the DICOM JSON Model into a row of typed values.
+
+    Args:
+        json_dict (dict): Document returned by
+                          `dicom2elk.core.dicom.metadata.extract_metadata_from_dcm`.
+        columns (list): Columns returned by `get_parquet_columns`.
+
+    Returns:
+        dict: Values indexed by column name, including the path of the dicom file.
+              The missing values are None.
+    """
+    row = {}
+    for tag, name, column_type, multiple in columns:
+        values = json_dict.get(tag, {}).get("Value")
+        if not values:
+            row[name] = None
+        elif multiple:
+            row[name] = [_convert_value(value, column_type) for value in values]
+        else:
+            row[name] = _convert_value(values[0], column_type)
+    row[FILEPATH_COLUMN] = json_dict.get(FILEPATH_COLUMN)
+    return row
+
+
+def get_parquet_schema(columns: list):
+    """Get the Arrow schema of the Parquet files.
+
+    Args:
+        columns (list): Columns returned by `get_parquet_columns`.
+
+    Returns:
+        pyarrow.Schema: Schema with a field per column and the path of the dicom file.
+
+    Raises:
+        ImportError: If `pyarrow` is not installed.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("The 'pyarrow' package is required to write Parquet files.")
+    arrow_types = {
+        "date": pa.date32(),
+        "time": pa.time64("us"),
+        "int": pa.int64(),
+        "uint": pa.uint64(),
+        "float": pa.float64(),
+        "string": pa.string(),
+    }
+    fields = []
+    for _, name, column_type, multiple in columns:
+        arrow_type = arrow_types[column_type]
+        fields.append(pa.field(name, pa.list_(arrow_type) if multiple else arrow_type))
+    fields.append(pa.field(FILEPATH_COLUMN, pa.string()))
+    return pa.schema(fields)
+
+
+class ParquetBatchWriter:
+    """Write documents to a Parquet file with a row group per batch.
+
+    Args:
+        output_dir (str): Path to output directory.
+        prefix (str): Prefix of the file name (e.g. the name of the dicom list file).
+        tags (list): Tags to export (see `get_parquet_columns`).
+        compression (str): Compression of the column chunks ('none', 'snappy', 'gzip'
+                           or 'zstd'). Defaults to 'snappy'.
+        logger (logging.Logger): Logger instance.
+
+    Raises:
+        ValueError: If `compression` is not one of `PARQUET_COMPRESSIONS`.
+        ImportError: If `pyarrow` is not installed.
+
+    Note:
+        The writer is not thread-safe. It is used by a single sink thread
+        and must be closed with `close` to publish the file.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        prefix: str,
+        tags: list = None,
+        compression: str = "snappy",
+        logger: logging.Logger = create_logger("INFO"),
+    ):
+        if compression not in PARQUET_COMPRESSIONS:
+            raise ValueError(
+                f"Invalid compression: {compression} "
+                f"(expected one of {list(PARQUET_COMPRESSIONS)})"
+            )
+        self.columns = get_parquet_columns(tags)
+        self.schema = get_parquet_schema(self.columns)
+        self.compression = compression
+        self.logger = logger
+        # Files of different runs of the same list do not overwrite each other
+        self.parquet_file = os.path.join(
+            output_dir,
+            f"{prefix}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}.parquet",
+        )
+        self._temp_file = os.path.join(
+            output_dir, "." + os.path.basename(self.parquet_file) + ".tmp"
+        )
+        self._writer = None
+        self._rows = []
+        self.n_row_groups = 0
+        self.n_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, documents: list):
+        """Flatten documents and buffer them until the end of the batch.
+
+        Args:
+            documents (list): Documents in the DICOM JSON Model.
+        """
+        self._rows.extend(flatten_document(document, self.columns) for document in documents)
+
+    def write_row_group(self):
+        """Write the buffered documents as a row group.
+
+        Returns:
+            dict: Counters of the call ("parquet_row_groups" written: 0 or 1).
+        """
+        if not self._rows:
+            return {"parquet_row_groups": 0}
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(
+                self._temp_file, self.schema, compression=self.compression
+            )
+        table = pa.Table.from_pylist(self._rows, schema=self.schema)
+        self._writer.write_table(table, row_group_size=len(self._rows))
+        self.n_row_groups += 1
+        self.n_rows += len(self._rows)
+        self._rows = []
+        return {"parquet_row_groups": 1}
+
+    def close(self):
+        """Write the last row group and publish the file under its final name.
+
+        Returns:
+            dict: Counters of the call ("parquet_row_groups" written: 0 or 1).
+        """
+        stats = self.write_row_group()
+        if self._writer is None:
+            return stats
+        self._writer.close()
+        self._writer = None
+        with open(self._temp_file, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(self._temp_file, self.parquet_file)
+        self.logger.info(
+            f"Wrote {self.parquet_file} ({self.n_rows} documents, "
+            f"{self.n_row_groups} row groups)"
+        )
+        return stats
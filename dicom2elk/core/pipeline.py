@@ -0,0 +1,257 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides the sink stage of the producer-consumer pipeline.
+
+The extraction stage (`extract_metadata_from_dcm_list`) puts the documents
+into a `SinkPipeline` as soon as they are extracted. The documents are grouped
+in chunks that are passed through a bounded queue to sink threads, which save
+them (e.g. send bulk requests to Elasticsearch) while the next files are
+extracted. When the queue is full, the extraction waits for the sink threads
+(backpressure), so that the time of a run approaches the time of its slowest
+stage instead of the sum of the time of its stages.
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from dicom2elk.utils.logging import create_logger
+
+
+# Maximum number of chunks of documents waiting in the queue of the sink threads
+SINK_QUEUE_SIZE = 4
+
+# Number of documents passed at once to the sink function
+SINK_CHUNK_SIZE = 500
+
+
+class SinkPipeline:
+    """Stage that consumes chunks of documents with a pool of sink threads.
+
+    Args:
+        sink_function (callable): Function called by the sink threads with a list
+                                  of documents (e.g. `send_bulk_to_elasticsearch`).
+                                  If it returns a dictionary of counters, they are
+                                  added to `stats`, except its "failed_files" list of
+                                  the paths of the documents that could not be saved,
+                                  which are added to `failed_files`.
+        n_workers (int): Number of sink threads. Defaults to 1.
+        queue_size (int): Maximum number of chunks waiting in the queue.
+                          Defaults to `SINK_QUEUE_SIZE`.
+        chunk_size (int): Number of documents passed at once to `sink_function`.
+                          Defaults to `SINK_CHUNK_SIZE`.
+        logger (logging.Logger): Logger instance.
+        flush_function (callable): Function called by the sink thread without argument
+                                   after the chunk queued by `flush` or `close` is saved
+                                   (e.g. to close an NDJSON shard). If it returns a dictionary
+                                   of counters, they are added to `stats`. It requires a
+                                   single sink thread.
+        close_function (callable): Function called without argument by `close` once
+                                   all documents are saved (e.g. to publish a Parquet
+                                   file). If it returns a dictionary of counters, they
+                                   are added to `stats`. It is not called if a sink
+                                   thread failed.
+        published_function (callable): Function called without argument that returns the
+                                       number of documents published so far (e.g. in
+                                       the closed NDJSON shards). If given, a chunk is
+                                       only counted in `n_completed_chunks` once all its
+                                       documents are published. It requires a single
+                                       sink thread.
+
+    Note:
+        The pipeline must be closed with `close` (or used as a context manager)
+        to flush the last chunk and wait for the sink threads. The first error
+        raised by `sink_function` is raised again by `put` or `close`.
+
+    Raises:
+        ValueError: If `flush_function` or `published_function` is given with more
+                    than one sink thread.
+    """
+
+    def __init__(
+        self,
+        sink_function,
+        n_workers: int = 1,
+        queue_size: int = SINK_QUEUE_SIZE,
+        chunk_size: int = SINK_CHUNK_SIZE,
+        logger: logging.Logger = create_logger("INFO"),
+        flush_function=None,
+        close_function=None,
+        published_function=None,
+    ):
+        if flush_function is not None and n_workers > 1:
+            raise ValueError("A flush function requires a single sink thread.")
+        if published_function is not None and n_workers > 1:
+            raise ValueError("A published function requires a single sink thread.")
+        self.sink_function = sink_function
+        self.flush_function = flush_function
+        self.close_function = close_function
+        self.published_function = published_function
+        self.chunk_size = chunk_size
+        self.logger = logger
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._chunk = []
+        self._lock = threading.Lock()
+        self._error = None
+        self._closed = False
+        # Sequence numbers of the chunks queued and completed out of order
+        self._n_queued_chunks = 0
+        self._completed_chunks = set()
+        self.n_completed_chunks = 0
+        # Chunks saved but not published yet, with the number of documents
+        # that must be published to complete them (see `published_function`)
+        self._unpublished_chunks = deque()
+        self._n_saved_documents = 0
+        # Paths of the files whose document could not be saved by the completed chunks
+        self.failed_files = set()
+        # Counters of the sink stage
+        self.stats = {
+            "sink_documents": 0,
+            "sink_busy_time": 0.0,
+            "sink_wait_time": 0.0,
+        }
+        self._workers = [
+            threading.Thread(target=self._run, name=f"dicom2elk-sink-{i}", daemon=True)
+            for i in range(max(n_workers, 1))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        """Consume the chunks of the queue up to the end marker (None)."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            seq, chunk, flush = item
+            if self._error is not None:
+                # Drain the queue without saving once a chunk failed
+                continue
+            tic = time.perf_counter()
+            try:
+                chunk_stats = self.sink_function(chunk) if chunk else None
+                flush_stats = None
+                if flush and self.flush_function is not None:
+                    flush_stats = self.flush_function()
+            except Exception as e:
+                self.logger.error(f"Error in sink thread: {e}")
+                self._error = e
+                continue
+            with self._lock:
+                for function_stats in (chunk_stats, flush_stats):
+                    if isinstance(function_stats, dict):
+                        function_stats = dict(function_stats)
+                        self.failed_files.update(function_stats.pop("failed_files", []))
+                        for key, value in function_stats.items():
+                            self.stats[key] = self.stats.get(key, 0) + value
+                self.stats["sink_documents"] += len(chunk)
+                self.stats["sink_busy_time"] += time.perf_counter() - tic
+                if self.published_function is not None:
+                    self._n_saved_documents += len(chunk)
+                    self._unpublished_chunks.append((seq, self._n_saved_documents))
+                    self._complete_published_chunks()
+                else:
+                    self._complete_chunk(seq)
+
+    def _complete_chunk(self, seq: int):
+        """Advance the number of chunks completed without gap."""
+        self._completed_chunks.add(seq)
+        while self.n_completed_chunks in self._completed_chunks:
+            self._completed_chunks.remove(self.n_completed_chunks)
+            self.n_completed_chunks += 1
+
+    def _complete_published_chunks(self):
+        """Complete the saved chunks whose documents are all published."""
+        n_published = self.published_function()
+        while self._unpublished_chunks and self._unpublished_chunks[0][1] <= n_published:
+            self._complete_chunk(self._unpublished_chunks.popleft()[0])
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("A sink thread failed") from self._error
+
+    def _put_chunk(self, chunk: list, flush: bool = False):
+        """Put a chunk in the queue, waiting for a free slot if it is full."""
+        tic = time.perf_counter()
+        self._queue.put((self._n_queued_chunks, chunk, flush))
+        self._n_queued_chunks += 1
+        self.stats["sink_wait_time"] += time.perf_counter() - tic
+
+    def put(self, document):
+        """Add a document to the current chunk and queue it once it is full.
+
+        Args:
+            document: Document passed to `sink_function` in a chunk.
+
+        Raises:
+            RuntimeError: If a sink thread failed.
+        """
+        self._raise_error()
+        self._chunk.append(document)
+        if len(self._chunk) >= self.chunk_size:
+            self._put_chunk(self._chunk)
+            self._chunk = []
+
+    def flush(self):
+        """Queue the current chunk even if it is not full, without waiting for it to be saved.
+
+        The flush function, if any, is called once the chunk is saved.
+
+        Returns:
+            int: Number of chunks queued so far. All documents put before the call
+                 are saved once `n_completed_chunks` reaches this number.
+
+        Raises:
+            RuntimeError: If a sink thread failed.
+        """
+        self._raise_error()
+        if self._chunk or self.flush_function is not None:
+            self._put_chunk(self._chunk, flush=True)
+            self._chunk = []
+        return self._n_queued_chunks
+
+    def close(self):
+        """Queue the last chunk and wait for the sink threads to save all documents.
+
+        Raises:
+            RuntimeError: If a sink thread failed.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._chunk or self.flush_function is not None:
+            self._put_chunk(self._chunk, flush=True)
+            self._chunk = []
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._raise_error()
+        if self.close_function is not None:
+            close_stats = self.close_function()
+            if isinstance(close_stats, dict):
+                for key, value in close_stats.items():
+                    self.stats[key] = self.stats.get(key, 0) + value
+        if self.published_function is not None:
+            # The last documents are published by the close function
+            self._complete_published_chunks()
@@ -16,56 +16,784 @@
 
 import argparse
 import logging
+import os
+import sqlite3 as sq
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import Pool as PoolType
 
-from dicom2elk.core.dicom.metadata import extract_metadata_from_dcm_list
-from dicom2elk.utils.logging import create_logger
+from dicom2elk.core.aio import AsyncEngine
+from dicom2elk.core.autotune import AutoTuner, get_memory_usage
+from dicom2elk.core.dicom.metadata import (
+    extract_metadata_from_dcm_list,
+    get_worker_options,
+    init_worker,
+)
+from dicom2elk.core.elasticsearch.api import (
+    get_index_target,
+    send_bulk_to_elasticsearch,
+)
+from dicom2elk.core.elasticsearch.client import (
+    ES_CONNECTIONS_PER_NODE,
+    close_elasticsearch_clients,
+    get_elasticsearch_client,
+)
+from dicom2elk.core.elasticsearch.index import bulk_load_index
+from dicom2elk.core.ndjson import NDJSONShardWriter
+from dicom2elk.core.parquet import ParquetBatchWriter
+from dicom2elk.core.pipeline import SinkPipeline
+from dicom2elk.utils.cache import (
+    connect_cache,
+    create_fingerprint_table,
+    get_cached_signatures,
+    get_file_signatures,
+    update_fingerprints,
+)
+from dicom2elk.utils.config import get_config
+from dicom2elk.utils.errors import append_error_records
+from dicom2elk.utils.journal import JournalWriter, read_journal
+from dicom2elk.utils.logging import create_logger, start_log_listener, stop_log_listener
+from dicom2elk.utils.manifest import append_manifest_entries
+from dicom2elk.utils.throttle import Throttle, create_throttle
 
 
-def process_batches(
-    dcm_list_batches: list,
+def get_worker_options_from_args(
     args: argparse.Namespace,
     logger: logging.Logger = create_logger("INFO"),
     kwargs: dict = None,
+    exclude_tags: list = None,
 ):
-    """Process batches of dicom files.
+    """Gather the options of the worker processes from the command line arguments.
+
+    The throttle of the run (see `get_throttle_from_args`) is created here so
+    that it is shared by the worker processes of the pool created with the options.
 
     Args:
-        dcm_list_batches (list): List of batches of dicom files to process.
         args (argparse.Namespace): Arguments passed to the main function.
         logger (logging.Logger): Logger instance.
-        **kwargs: Arbitrary keyword arguments to pass to the `dcmread` function.
+        kwargs (dict): Keyword arguments to pass to the `dcmread` function.
+        exclude_tags (list): List of tags to remove from each dataset before its conversion.
 
     Returns:
-        tuple: Tuple containing:
-                   * the number of dicom files processed.
-                   * the number of dicom files skipped.
+        dict: Options returned by `dicom2elk.core.dicom.metadata.get_worker_options`.
     """
-    if kwargs is None:
-        kwargs = {}
+    return get_worker_options(
+        mode=args.mode,
+        sleep_time_ms=args.sleep_time_ms,
+        output_dir=args.output_dir,
+        logger=logger,
+        kwargs={} if kwargs is None else kwargs,
+        exclude_tags=exclude_tags,
+        bulk_data_threshold=args.bulk_data_threshold,
+        engine=args.engine,
+        stop_tag=args.stop_tag,
+        throttle=get_throttle_from_args(args),
+        json_layout=args.json_layout,
+    )
 
-    total_dcm_processed, total_dcm_skipped = 0, 0
-    for i, dcm_list_batch in enumerate(dcm_list_batches):
-        logger.info(
-            f"Processing batch #{i+1} of {len(dcm_list_batches)} (batch size: {args.batch_size})"
+
+def get_throttle_from_args(args: argparse.Namespace):
+    """Create the throttle of a run from the command line arguments.
+
+    Args:
+        args (argparse.Namespace): Arguments passed to the main function.
+
+    Returns:
+        dicom2elk.utils.throttle.Throttle: Throttle shared by the workers of the run,
+                                           or None if no limit is given.
+    """
+    return create_throttle(
+        files_per_sec=args.max_files_per_sec,
+        bytes_per_sec=args.max_bytes_per_sec,
+        documents_per_sec=args.max_documents_per_sec,
+        schedule=args.throttle_schedule,
+    )
+
+
+def get_bulk_options_from_args(args: argparse.Namespace):
+    """Get the options of the bulk requests from the command line arguments.
+
+    Args:
+        args (argparse.Namespace): Arguments passed to the main function.
+
+    Returns:
+        dict: Keyword arguments of `dicom2elk.core.elasticsearch.api.send_bulk_to_elasticsearch`
+              and `send_bulk_to_elasticsearch_async` ("hash_db", "chunk_size",
+              "max_chunk_bytes", "max_retries", "op_type" and "id_scheme"). With
+              `args.skip_unchanged`, "hash_db" is the cache of the content hashes
+              (see `get_cache_db`), otherwise it is None.
+    """
+    return {
+        "hash_db": get_cache_db(args) if args.skip_unchanged else None,
+        "chunk_size": args.bulk_chunk_size,
+        "max_chunk_bytes": int(args.bulk_max_size * 1024**2),
+        "max_retries": args.bulk_max_retries,
+        "op_type": args.es_op_type,
+        "id_scheme": args.es_id_scheme,
+    }
+
+
+def create_worker_pool(
+    n_threads: int, max_tasks_per_child: int = None, worker_options: dict = None
+):
+    """Create a pool of worker processes that can be reused across batches.
+
+    The log records of the workers are handled by a listener thread of the main
+    process, which is stopped by `close_worker_pool`.
+
+    Args:
+        n_threads (int): Number of worker processes.
+        max_tasks_per_child (int): Number of tasks (chunks of files) after which a worker
+                                   process is replaced by a fresh one to contain memory leaks.
+                                   If None, workers live as long as the pool.
+        worker_options (dict): Options set once in each worker process
+                               (see `get_worker_options_from_args`).
+
+    Returns:
+        multiprocessing.pool.Pool: Pool of worker processes (None if `n_threads` <= 1).
+    """
+    if n_threads <= 1:
+        return None
+    if worker_options is None:
+        worker_options = get_worker_options()
+    # The workers log through a queue to the handlers of the main process
+    log_queue, log_listener = start_log_listener()
+    pool = Pool(
+        n_threads,
+        initializer=init_worker,
+        initargs=(worker_options, log_queue, logging.getLogger().level),
+        maxtasksperchild=max_tasks_per_child,
+    )
+    # Keep track of the options to check that the pool is used for the same run
+    pool.worker_options = worker_options
+    pool.log_listener = log_listener
+    return pool
+
+
+def close_worker_pool(pool: PoolType):
+    """Wait for the workers of a pool created by `create_worker_pool` to exit.
+
+    Args:
+        pool (multiprocessing.pool.Pool): Pool of worker processes (ignored if None).
+    """
+    if pool is not None:
+        pool.close()
+        pool.join()
+        # Handle the last records of the workers once they have exited
+        stop_log_listener(getattr(pool, "log_listener", None))
+
+
+def get_cache_db(args: argparse.Namespace):
+    """Get the path of the local SQLite cache used by `--incremental` and `--skip-unchanged`.
+
+    Args:
+        args (argparse.Namespace): Arguments passed to the main function.
+
+    Returns:
+        str: Path given by `--cache-db`, or 'dicom2elk.cache.db' in the output directory.
+    """
+    if args.cache_db is None:
+        return os.path.join(args.output_dir, "dicom2elk.cache.db")
+    return args.cache_db
+
+
+def get_cache_target(args: argparse.Namespace):
+    """Get the destination of the files of a run in the fingerprint cache.
+
+    The files extracted by a run are only skipped by the next incremental runs
+    to the same destination.
+
+    Args:
+        args (argparse.Namespace): Arguments passed to the main function.
+
+    Returns:
+        str: The mode followed by the index of the config file in 'elasticsearch' mode
+             (see `dicom2elk.core.elasticsearch.api.get_index_target`), or by the
+             absolute path of the output directory in the other modes.
+    """
+    if args.mode == "elasticsearch":
+        return f"{args.mode}:{get_index_target(get_config(args.config))}"
+    return f"{args.mode}:{os.path.abspath(args.output_dir)}"
+
+
+def create_sink_pipeline(
+    args: argparse.Namespace,
+    logger: logging.Logger = create_logger("INFO"),
+    throttle: Throttle = None,
+    tags: list = None,
+):
+    """Create the sink stage that saves the documents extracted by the batches.
+
+    In 'elasticsearch' mode, the documents are uploaded by sink threads while the
+    next files are extracted. With `args.skip_unchanged`, the documents whose content
+    hash is the same as at their last upload are not sent again. In 'ndjson' mode,
+    a single sink thread appends the documents of all batches to rolling NDJSON shards,
+    and a batch is completed once its documents are in published shards (see
+    `dicom2elk.core.ndjson`). In 'parquet' mode, a single sink thread writes the
+    documents of each batch as a row group of a Parquet file, which is published when
+    the stage is closed (see `dicom2elk.core.parquet`). In 'json' mode, the JSON files
+    are written by the extraction workers, and the 'asyncio' process handler uploads
+    the documents in its own event loop (also skipping the unchanged documents, see
+    `get_bulk_options_from_args`), so no sink stage is needed.
+
+    Args:
+        args (argparse.Namespace): Arguments passed to the main function.
+        logger (logging.Logger): Logger instance.
+        throttle (dicom2elk.utils.throttle.Throttle): Throttle that limits the documents
+                                                      sent per second by all sink threads.
+        tags (list): Tags exported in 'parquet' mode (e.g. the included tags of the config
+                     file). If None, the tags of all presets are exported.
+
+    Returns:
+        dicom2elk.core.pipeline.SinkPipeline: Sink stage to close after use (or None).
+    """
+    prefix = os.path.splitext(os.path.basename(args.input_dcm_list))[0]
+    if args.mode == "ndjson":
+        writer = NDJSONShardWriter(
+            args.output_dir,
+            prefix,
+            compression=args.ndjson_compression,
+            max_shard_bytes=int(args.shard_max_size * 1024**2),
+            max_shard_documents=args.shard_max_documents,
+            logger=logger,
+        )
+        return SinkPipeline(
+            writer.write,
+            queue_size=args.sink_queue_size,
+            logger=logger,
+            close_function=writer.close,
+            published_function=writer.get_n_published_documents,
+        )
+    if args.mode == "parquet":
+        writer = ParquetBatchWriter(
+            args.output_dir,
+            prefix,
+            tags=tags,
+            compression=args.parquet_compression,
+            logger=logger,
         )
+        return SinkPipeline(
+            writer.write,
+            queue_size=args.sink_queue_size,
+            logger=logger,
+            flush_function=writer.write_row_group,
+            close_function=writer.close,
+        )
+    if args.mode != "elasticsearch" or args.process_handler == "asyncio":
+        return None
+    return SinkPipeline(
+        partial(
+            send_bulk_to_elasticsearch,
+            config=args.config,
+            logger=logger,
+            throttle=throttle,
+            document_format=args.es_document_format,
+            **get_bulk_options_from_args(args),
+        ),
+        n_workers=args.sink_threads,
+        queue_size=args.sink_queue_size,
+        logger=logger,
+    )
+
+
+def _get_sop_instance_uid(processed_dcm):
+    # JSON files are named after the SOPInstanceUID of their dicom file
+    if isinstance(processed_dcm, str):
+        return os.path.splitext(os.path.basename(processed_dcm))[0]
+    return processed_dcm.get("00080018", {}).get("Value", [None])[0]
+
+
+def _record_completed_batches(
+    pending_batches: deque,
+    sink: SinkPipeline = None,
+    journal: JournalWriter = None,
+    cache_connection: sq.Connection = None,
+    failed_files: set = None,
+    logger: logging.Logger = create_logger("INFO"),
+    cache_target: str = None,
+):
+    """Record the pending batches whose documents are all saved in the journal and the cache.
+
+    The files whose document could not be saved (in `failed_files` or in the
+    `failed_files` of the sink) are not recorded in the cache, and their batch is
+    not recorded in the journal, so that they are processed again by the next run.
+    """
+    while pending_batches and (
+        sink is None or pending_batches[0][2] <= sink.n_completed_chunks
+    ):
+        batch_index, n_files, _, fingerprints, batch_files = pending_batches.popleft()
+        batch_failed_files = {
+            dcm_file
+            for dcm_file in batch_files
+            if (failed_files is not None and dcm_file in failed_files)
+            or (sink is not None and dcm_file in sink.failed_files)
+        }
+        if cache_connection is not None:
+            update_fingerprints(
+                cache_connection,
+                cache_target,
+                [
+                    fingerprint
+                    for fingerprint in fingerprints
+                    if fingerprint[0] not in batch_failed_files
+                ],
+            )
+        if journal is not None:
+            if batch_failed_files:
+                logger.warning(
+                    f"Batch #{batch_index + 1} is not recorded in the journal: the "
+                    f"documents of {len(batch_failed_files)} files could not be saved"
+                )
+            else:
+                journal.record(batch_index, n_files)
+
+
+class RunContext:
+    """Resources shared by the batches of a run processed by `process_batches`.
+
+    The context is set up once for the run: the pool of worker processes, the index
+    and the clients of the 'elasticsearch' mode, the event loop of the 'asyncio'
+    process handler, the sink pipeline, the journal, the fingerprint cache, the error
+    file and the manifest. Each batch is then processed by `process_batch`, and the
+    context is closed once the run ends, even if it fails (it can be used as a context
+    manager): the last documents are uploaded and their batches recorded, then the
+    journal, the cache and the pool are closed, and the settings of the index are
+    restored last.
+
+    Args:
+        args (argparse.Namespace): Validated arguments passed to the main function.
+        logger (logging.Logger): Logger instance.
+        worker_options (dict): Options of the files of the run returned by
+                               `get_worker_options_from_args`. If None, they are taken
+                               from `pool`, or built from `args` if no pool is given.
+        stats (dict): Dictionary of run counters that is updated in place. If None,
+                      a new dictionary is used.
+        pool (multiprocessing.pool.Pool): Pool of worker processes created by
+                                          `create_worker_pool` with `worker_options`
+                                          that is left open. If None, a pool is
+                                          created for the run.
+        journal_file (str): Path to the journal of the completed batches.
+        cache_file (str): Path to the SQLite fingerprint cache of incremental runs.
+        error_file (str): Path to the NDJSON file of the records of the files that
+                          cannot be read.
+        tuner (dicom2elk.core.autotune.AutoTuner): Auto-tuner of the number of worker
+                                                   processes and of the batch size.
+        manifest_file (str): Path to the manifest of the JSON files written in 'json' mode.
+
+    Raises:
+        ValueError: If `tuner` and `pool` are both given.
+        ValueError: If `pool` was created with other options than `worker_options`.
+    """
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        logger: logging.Logger = create_logger("INFO"),
+        worker_options: dict = None,
+        stats: dict = None,
+        pool: PoolType = None,
+        journal_file: str = None,
+        cache_file: str = None,
+        error_file: str = None,
+        tuner: AutoTuner = None,
+        manifest_file: str = None,
+    ):
+        if tuner is not None and pool is not None:
+            raise ValueError("The number of workers of a shared pool cannot be auto-tuned.")
+        if pool is not None:
+            if worker_options is None:
+                # Use the options with which the workers of the pool were initialized
+                worker_options = getattr(pool, "worker_options", None)
+            elif getattr(pool, "worker_options", None) is not worker_options:
+                # The options are built once per run and shared by the pool and the batches
+                raise ValueError("The pool was created with other worker options.")
+        if worker_options is None:
+            worker_options = get_worker_options_from_args(args, logger)
+
+        self.args = args
+        self.logger = logger
+        self.worker_options = worker_options
+        self.stats = stats if stats is not None else {}
+        self.tuner = tuner
+        self.error_file = error_file
+        self.manifest_file = manifest_file
+        self.n_threads = tuner.n_threads if tuner is not None else args.n_threads
+        self.pool = pool
+        # Tags selected by the config file
+        self.specific_tags = (worker_options["kwargs"] or {}).get("specific_tags")
+        self.bulk_options = get_bulk_options_from_args(args)
+        # The throttle is shared by the workers of the pool and the sink threads
+        self.throttle = worker_options.get("throttle")
+        if self.throttle is not None:
+            logger.info(f"Throttling the run: {self.throttle}")
+
+        self.completed_batches = {}
+        if journal_file is not None and args.resume:
+            self.completed_batches = read_journal(journal_file, args.batch_size, logger)
+            logger.info(
+                f"Number of batches already processed: {len(self.completed_batches)}"
+            )
+        if error_file is not None and not args.resume:
+            open(error_file, "w").close()
+        if manifest_file is not None and not args.resume:
+            open(manifest_file, "w").close()
+
+        # Batches extracted but whose documents may not be uploaded yet, with
+        # the number of sink chunks that must be completed to record them
+        self.pending_batches = deque()
+        # Files whose document could not be uploaded without sink stage
+        self.failed_files = set()
+        self.total_dcm_processed, self.total_dcm_skipped = 0, 0
+        self.sink, self.journal, self.async_engine = None, None, None
+        self.cache_connection, self.cache_target, self.stat_executor = None, None, None
+        # The resources are released in the reverse order of their setup
+        self._stack = ExitStack()
+        try:
+            self._setup(journal_file, cache_file, owns_pool=pool is None)
+        except BaseException:
+            self.close()
+            raise
+
+    def _setup(self, journal_file: str, cache_file: str, owns_pool: bool):
+        args = self.args
+        if args.mode == "elasticsearch":
+            # The client is created once and shared by the index management
+            # and all uploads of the run, then closed once the index is restored
+            self._stack.callback(close_elasticsearch_clients)
+            get_elasticsearch_client(
+                args.config,
+                connections_per_node=max(args.sink_threads, ES_CONNECTIONS_PER_NODE),
+            )
+            self._stack.enter_context(
+                bulk_load_index(
+                    args.config,
+                    tags=self.specific_tags,
+                    document_format=args.es_document_format,
+                    index_template=not args.no_index_template,
+                    bulk_load_settings=not args.keep_index_settings,
+                    logger=self.logger,
+                )
+            )
+        if args.process_handler == "asyncio":
+            # The event loop and the asyncio client are shared by all batches
+            # and closed before the settings of the index are restored
+            self.async_engine = self._stack.enter_context(
+                AsyncEngine(
+                    args.io_threads,
+                    args.config if args.mode == "elasticsearch" else None,
+                    self.logger,
+                    args.es_document_format,
+                )
+            )
+        if owns_pool:
+            self._stack.callback(self._close_pool)
+            self.pool = create_worker_pool(
+                self.n_threads, args.max_tasks_per_child, self.worker_options
+            )
+        if cache_file is not None:
+            self.cache_connection = self._stack.enter_context(
+                closing(connect_cache(cache_file))
+            )
+            create_fingerprint_table(self.cache_connection)
+            self.cache_target = get_cache_target(args)
+            # The files are stated by threads as their stat calls mostly wait for I/O
+            self.stat_executor = ThreadPoolExecutor(args.io_threads)
+            self._stack.callback(self.stat_executor.shutdown)
+        if journal_file is not None:
+            self.journal = self._stack.enter_context(
+                JournalWriter(journal_file, args.batch_size, append=args.resume)
+            )
+        # The sink is closed first, so that the batches of its last documents are recorded
+        self._stack.callback(self._close_sink)
+        self.sink = create_sink_pipeline(
+            args, self.logger, self.throttle, tags=self.specific_tags
+        )
+
+    def _close_pool(self):
+        # The pool may have been created again by the tuner
+        close_worker_pool(self.pool)
+        self.pool = None
+
+    def _close_sink(self):
+        if self.sink is not None:
+            # Wait for the last documents to be uploaded
+            self.sink.close()
+            for key, value in self.sink.stats.items():
+                self.stats[key] = self.stats.get(key, 0) + value
+        self._record_completed_batches()
+
+    def _record_completed_batches(self):
+        _record_completed_batches(
+            self.pending_batches,
+            self.sink,
+            self.journal,
+            self.cache_connection,
+            self.failed_files,
+            self.logger,
+            self.cache_target,
+        )
+
+    def process_batch(self, batch_index: int, dcm_list_batch: list, n_batches: int = None):
+        """Process a batch of dicom files with the resources of the run.
+
+        A batch recorded in the journal of a resumed run is skipped.
+
+        Args:
+            batch_index (int): Index of the batch in the run.
+            dcm_list_batch (list): Dicom files of the batch.
+            n_batches (int): Number of batches displayed in the logs.
+        """
+        args, stats, tuner = self.args, self.stats, self.tuner
+        if batch_index in self.completed_batches:
+            stats["resumed_files"] = (
+                stats.get("resumed_files", 0) + self.completed_batches[batch_index]
+            )
+            return
+        if tuner is not None and tuner.n_threads != self.n_threads:
+            # Create the pool again with the number of workers chosen by the tuner
+            close_worker_pool(self.pool)
+            self.pool = None
+            self.n_threads = tuner.n_threads
+            self.pool = create_worker_pool(
+                self.n_threads, args.max_tasks_per_child, self.worker_options
+            )
+        self.logger.info(
+            f"Processing batch #{batch_index + 1} of "
+            f"{n_batches if n_batches is not None else '?'} "
+            f"(batch size: {tuner.batch_size if tuner is not None else args.batch_size})"
+        )
+        n_files = len(dcm_list_batch)
+        if self.cache_connection is not None:
+            # Skip the files that have not changed since their last extraction
+            signatures = get_file_signatures(dcm_list_batch, self.stat_executor)
+            cached_signatures = get_cached_signatures(
+                self.cache_connection, self.cache_target, dcm_list_batch
+            )
+            dcm_list_batch = [
+                dcm_file
+                for dcm_file in dcm_list_batch
+                if signatures[dcm_file] is None
+                or cached_signatures.get(dcm_file) != signatures[dcm_file]
+            ]
+            stats["cache_hits"] = (
+                stats.get("cache_hits", 0) + n_files - len(dcm_list_batch)
+            )
+            stats["cache_misses"] = stats.get("cache_misses", 0) + len(dcm_list_batch)
+
+        processed_files = [] if self.cache_connection is not None else None
+        errors = []
+        batch_failed_files = []
+        tic = time.perf_counter()
         processed_dcm_list_batch = extract_metadata_from_dcm_list(
             dcm_list_batch,
-            output_dir=args.output_dir,
+            config=args.config,
             process_handler=args.process_handler,
-            mode=args.mode,
-            n_threads=args.n_threads,
-            sleep_time_ms=args.sleep_time_ms,
-            logger=logger,
-            **kwargs,
+            n_threads=self.n_threads,
+            worker_options=self.worker_options,
+            stats=stats,
+            pool=self.pool,
+            io_threads=args.io_threads,
+            sink=self.sink,
+            async_engine=self.async_engine,
+            processed_files=processed_files,
+            errors=errors,
+            document_format=args.es_document_format,
+            bulk_options=self.bulk_options,
+            failed_files=batch_failed_files,
         )
+        self.failed_files.update(batch_failed_files)
+        toc = time.perf_counter()
+        stats["extraction_time"] = stats.get("extraction_time", 0.0) + toc - tic
+        if tuner is not None:
+            tuner.update(len(dcm_list_batch), toc - tic, get_memory_usage())
+
+        # Write the errors of the batch at once
+        stats["errors"] = stats.get("errors", 0) + len(errors)
+        if self.error_file is not None:
+            append_error_records(self.error_file, errors)
 
         # Remove None values
         processed_dcm_list_batch = [
             dcm_file for dcm_file in processed_dcm_list_batch if dcm_file is not None
         ]
 
+        # Record the JSON files of the batch at once
+        if self.manifest_file is not None and args.mode == "json":
+            append_manifest_entries(
+                self.manifest_file, args.output_dir, processed_dcm_list_batch
+            )
+
         # Update counters
-        total_dcm_processed += len(processed_dcm_list_batch)
-        total_dcm_skipped += len(dcm_list_batch) - len(processed_dcm_list_batch)
+        self.total_dcm_processed += len(processed_dcm_list_batch)
+        self.total_dcm_skipped += len(dcm_list_batch) - len(processed_dcm_list_batch)
+
+        # Queue the last documents of the batch (and write its Parquet row group)
+        n_chunks = self.sink.flush() if self.sink is not None else 0
+        if self.journal is not None or self.cache_connection is not None:
+            fingerprints = [
+                (dcm_file, *signatures[dcm_file], _get_sop_instance_uid(processed_dcm))
+                for dcm_file, processed_dcm in processed_files or []
+                if signatures[dcm_file] is not None
+            ]
+            self.pending_batches.append(
+                (batch_index, n_files, n_chunks, fingerprints, set(dcm_list_batch))
+            )
+            self._record_completed_batches()
+
+    def close(self):
+        """Upload the last documents, record their batches and release the resources."""
+        self._stack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 
-    return total_dcm_processed, total_dcm_skipped
+def process_batches(
+    dcm_list_batches: list,
+    args: argparse.Namespace,
+    logger: logging.Logger = create_logger("INFO"),
+    worker_options: dict = None,
+    stats: dict = None,
+    pool: PoolType = None,
+    n_batches: int = None,
+    journal_file: str = None,
+    cache_file: str = None,
+    error_file: str = None,
+    tuner: AutoTuner = None,
+    manifest_file: str = None,
+):
+    """Process batches of dicom files.
+
+    The batches are processed with the resources of a `RunContext` set up once for
+    the run. They are processed by the same pool of worker processes: if no pool
+    is given, it is created for all batches and closed once they are processed.
+
+    The extraction and the upload of the documents are overlapped: the extracted
+    documents are passed through a bounded queue to sink threads that upload
+    them while the next files (of the same or the next batch) are extracted
+    (see `create_sink_pipeline`).
+
+    If a journal file is given, each batch is recorded once all its files are saved
+    (see `dicom2elk.utils.journal`). A batch with documents that could not be indexed,
+    even after the retries, is not recorded, and the fingerprints of their files are
+    not stored in the cache (see `_record_completed_batches`). With `args.resume`, the
+    batches recorded by a previous run are skipped.
+
+    If a cache file is given (incremental run), the files whose size and modification
+    time are the same as at their last successful extraction are skipped, and the
+    fingerprints of the files extracted by the run are stored (see `dicom2elk.utils.cache`).
+
+    The files and bytes read and the documents sent per second are limited by the
+    throttle of the worker options (see `get_throttle_from_args`).
+
+    In 'elasticsearch' mode, the index template is put and the refresh and the replicas
+    of the index are disabled during the run, then restored once all documents are
+    uploaded, even if the run fails (see `dicom2elk.core.elasticsearch.index`). A single
+    client, created at the start of the run, is shared by the index management and
+    the uploads of all batches, and is closed once the run ends
+    (see `dicom2elk.core.elasticsearch.client`). Likewise, the 'asyncio' process handler
+    runs all batches in the same event loop and uploads them with the same asyncio
+    client (see `dicom2elk.core.aio.AsyncEngine`).
+
+    If an auto-tuner is given, the number of worker processes of each batch is taken
+    from it, the pool is created again when it changes, and the tuner is updated
+    with the throughput and the memory of each batch (see `dicom2elk.core.autotune`).
+
+    Args:
+        dcm_list_batches (list or iterable): Batches of dicom files to process. It can be
+                                             any iterable (e.g. the generator returned by
+                                             `prepare_file_list_batches` with `lazy=True`).
+        args (argparse.Namespace): Arguments passed to the main function.
+        logger (logging.Logger): Logger instance.
+        worker_options (dict): Options of the files of the run returned by
+                               `get_worker_options_from_args`, built once and passed to all
+                               batches. If None, they are taken from `pool`, or built from
+                               `args` if no pool is given.
+        stats (dict): Dictionary of run counters (e.g. "bulk_data_bytes_skipped")
+                      that is updated in place, including the time spent in each stage
+                      ("extraction_time", "sink_busy_time", "sink_wait_time").
+        pool (multiprocessing.pool.Pool): Pool of worker processes created by
+                                          `create_worker_pool` with `worker_options`
+                                          that is left open.
+        n_batches (int): Number of batches displayed in the logs. If None, it is
+                         taken from `len(dcm_list_batches)` when it is available.
+        journal_file (str): Path to the journal of the completed batches. If None,
+                            no journal is written and the run cannot be resumed.
+        cache_file (str): Path to the SQLite fingerprint cache of incremental runs.
+                          If None, all files are processed.
+        error_file (str): Path to the NDJSON file to which the records of the files
+                          that cannot be read are appended after each batch (see
+                          `dicom2elk.utils.errors`). It is truncated unless the run is
+                          resumed. If None, the errors are only logged.
+        tuner (dicom2elk.core.autotune.AutoTuner): Auto-tuner of the number of worker
+                                                   processes and of the batch size. The
+                                                   batches must be built by its `iter_batches`
+                                                   method. It cannot be used with `pool`.
+        manifest_file (str): Path to the manifest to which the JSON files written by
+                             each batch are appended in 'json' mode (see
+                             `dicom2elk.utils.manifest`). It is truncated unless the
+                             run is resumed. If None, no manifest is written.
+
+    Returns:
+        tuple: Tuple containing:
+                   * the number of dicom files processed.
+                   * the number of dicom files skipped.
+
+    Raises:
+        ValueError: If `tuner` and `pool` are both given.
+        ValueError: If `pool` was created with other options than `worker_options`.
+    """
+    if n_batches is None and hasattr(dcm_list_batches, "__len__"):
+        n_batches = len(dcm_list_batches)
+
+    with RunContext(
+        args,
+        logger,
+        worker_options,
+        stats,
+        pool,
+        journal_file,
+        cache_file,
+        error_file,
+        tuner,
+        manifest_file,
+    ) as run:
+        for i, dcm_list_batch in enumerate(dcm_list_batches):
+            run.process_batch(i, dcm_list_batch, n_batches)
+
+    return run.total_dcm_processed, run.total_dcm_skipped
+
+
+def log_stage_throughput(
+    stats: dict, n_files: int, logger: logging.Logger = create_logger("INFO")
+):
+    """Log the throughput of the extraction and sink stages of a run.
+
+    Args:
+        stats (dict): Dictionary of run counters updated by `process_batches`.
+        n_files (int): Number of dicom files processed or skipped.
+        logger (logging.Logger): Logger instance.
+    """
+    # Time during which the extraction waited for a free slot in the sink queue
+    wait_time = stats.get("sink_wait_time", 0.0)
+    extraction_time = stats.get("extraction_time", 0.0) - wait_time
+    if extraction_time > 0:
+        logger.info(
+            f"Extraction stage: {n_files} files in {extraction_time:.2f} sec. "
+            f"({n_files / extraction_time:.1f} files/sec.)"
+        )
+    busy_time = stats.get("sink_busy_time", 0.0)
+    if busy_time > 0:
+        n_documents = stats.get("sink_documents", 0)
+        logger.info(
+            f"Upload stage: {n_documents} documents in {busy_time:.2f} sec. "
+            f"({n_documents / busy_time:.1f} documents/sec. per sink thread), "
+            f"extraction blocked by a full queue for {wait_time:.2f} sec."
+        )
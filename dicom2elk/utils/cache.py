@@ -0,0 +1,267 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides functions to interact with the local SQL cache of dicom2elk runs.
+
+The cache stores:
+
+* the stat signature (size, modification time) of each dicom file at its last
+  successful extraction to a destination (the mode and the output directory or the
+  index of the run), with its SOPInstanceUID. A file whose signature has not changed
+  since then is skipped by the next `--incremental` run to the same destination.
+* the content hash of each document uploaded to Elasticsearch indexed by its index
+  (Elasticsearch instance and index name) and its `_id`. A document whose hash has
+  not changed is not sent again to the same index (`--skip-unchanged`).
+
+The cache is written by the main thread and by the sink threads of a run. The
+connections returned by `connect_cache` wait for the locks of the other
+connections and use the write-ahead log, so that the readers do not block the
+writer, and the writes of the threads of a process are serialized.
+"""
+
+import os
+import sqlite3 as sq
+import threading
+
+
+# Maximum number of paths looked up in a single query
+# (below the default limit of SQLite on the number of variables)
+LOOKUP_SIZE = 500
+
+# Time in seconds a connection waits for the lock of another connection
+CACHE_TIMEOUT = 60.0
+
+# Serializes the writes of the threads of the process
+_write_lock = threading.Lock()
+
+
+def connect_cache(cache_db: str):
+    """Connect to the cache in write-ahead log mode.
+
+    Args:
+        cache_db (str): Path to the SQLite cache.
+
+    Returns:
+        sq.Connection: The connection to the cache, to close after use.
+    """
+    db_connection = sq.connect(cache_db, timeout=CACHE_TIMEOUT)
+    try:
+        with _write_lock:
+            db_connection.execute("PRAGMA journal_mode=WAL;")
+    except BaseException:
+        db_connection.close()
+        raise
+    return db_connection
+
+
+def _drop_outdated_table(db_connection: sq.Connection, table: str, column: str):
+    """Drop a table created by an older version, which does not have a column."""
+    columns = [row[1] for row in db_connection.execute(f"PRAGMA table_info({table});")]
+    if columns and column not in columns:
+        db_connection.execute(f"DROP TABLE {table};")
+
+
+def create_fingerprint_table(
+    db_connection: sq.Connection, table: str = "dicom_fingerprints"
+):
+    """Create the table to store the fingerprints of the dicom files if it does not exist.
+
+    The fingerprints are indexed by the destination of the run (see
+    `dicom2elk.core.process.get_cache_target`) and by the path of the files, so
+    that the files are extracted again to a new destination. A table created by
+    an older version, whose fingerprints are only indexed by path, is dropped.
+
+    Args:
+        db_connection (sq.Connection): The connection to the database.
+        table (str): The name of the table. Default is 'dicom_fingerprints'.
+    """
+    with _write_lock:
+        _drop_outdated_table(db_connection, table, "target")
+        db_connection.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                         (target TEXT,
+                          path TEXT,
+                          size INTEGER,
+                          mtime_ns INTEGER,
+                          sop_instance_uid TEXT,
+                          extraction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                          PRIMARY KEY (target, path)
+                          );''')
+        db_connection.commit()
+
+
+def get_file_signature(file_path: str):
+    """Get the stat signature of a file.
+
+    Args:
+        file_path (str): The file path.
+
+    Returns:
+        tuple: The size and the modification time (in ns) of the file,
+               or None if the file cannot be accessed.
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def get_file_signatures(file_paths: list, executor=None):
+    """Get the stat signatures of a list of files.
+
+    Args:
+        file_paths (list): The file paths.
+        executor (concurrent.futures.Executor): Executor whose threads get the signatures,
+                                                so that the stat calls of files on network
+                                                storage overlap. If None, they are got one
+                                                after the other.
+
+    Returns:
+        dict: The signature of each file (see `get_file_signature`) indexed by path.
+    """
+    if executor is None:
+        return {file_path: get_file_signature(file_path) for file_path in file_paths}
+    return dict(zip(file_paths, executor.map(get_file_signature, file_paths)))
+
+
+def get_cached_signatures(
+    db_connection: sq.Connection,
+    target: str,
+    file_paths: list,
+    table: str = "dicom_fingerprints",
+):
+    """Get the signatures stored in the cache for a list of files.
+
+    Args:
+        db_connection (sq.Connection): The connection to the database.
+        target (str): The destination to which the files are extracted.
+        file_paths (list): The file paths to look up.
+        table (str): The name of the table. Default is 'dicom_fingerprints'.
+
+    Returns:
+        dict: The size and modification time of the cached files indexed by path.
+    """
+    signatures = {}
+    for i in range(0, len(file_paths), LOOKUP_SIZE):
+        paths = file_paths[i : i + LOOKUP_SIZE]
+        rows = db_connection.execute(
+            f"SELECT path, size, mtime_ns FROM {table} "
+            f"WHERE target = ? AND path IN ({', '.join('?' * len(paths))});",
+            [target, *paths],
+        )
+        for path, size, mtime_ns in rows:
+            signatures[path] = (size, mtime_ns)
+    return signatures
+
+
+def update_fingerprints(
+    db_connection: sq.Connection,
+    target: str,
+    fingerprints: list,
+    table: str = "dicom_fingerprints",
+):
+    """Store the fingerprints of successfully extracted files.
+
+    Args:
+        db_connection (sq.Connection): The connection to the database.
+        target (str): The destination to which the files were extracted.
+        fingerprints (list): Tuples containing the path, the size, the modification
+                             time (in ns) and the SOPInstanceUID of each file.
+        table (str): The name of the table. Default is 'dicom_fingerprints'.
+    """
+    with _write_lock:
+        db_connection.executemany(
+            f"INSERT OR REPLACE INTO {table} "
+            f"(target, path, size, mtime_ns, sop_instance_uid) VALUES (?, ?, ?, ?, ?);",
+            [(target, *fingerprint) for fingerprint in fingerprints],
+        )
+        db_connection.commit()
+
+
+def create_document_hash_table(
+    db_connection: sq.Connection, table: str = "document_hashes"
+):
+    """Create the table to store the content hashes of the uploaded documents if it does not exist.
+
+    The hashes are indexed by the Elasticsearch index to which the documents are uploaded
+    (see `dicom2elk.core.elasticsearch.api.get_index_target`) and by their `_id`, so
+    that the documents are sent again to a new index. A table created by an older version,
+    whose hashes are only indexed by `_id`, is dropped.
+
+    Args:
+        db_connection (sq.Connection): The connection to the database.
+        table (str): The name of the table. Default is 'document_hashes'.
+    """
+    with _write_lock:
+        _drop_outdated_table(db_connection, table, "target")
+        db_connection.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                         (target TEXT,
+                          id TEXT,
+                          hash TEXT,
+                          upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                          PRIMARY KEY (target, id)
+                          );''')
+        db_connection.commit()
+
+
+def get_document_hashes(
+    db_connection: sq.Connection,
+    target: str,
+    document_ids: list,
+    table: str = "document_hashes",
+):
+    """Get the content hashes stored in the cache for a list of documents.
+
+    Args:
+        db_connection (sq.Connection): The connection to the database.
+        target (str): The index to which the documents are uploaded.
+        document_ids (list): The `_id` of the documents to look up.
+        table (str): The name of the table. Default is 'document_hashes'.
+
+    Returns:
+        dict: The content hashes of the cached documents indexed by `_id`.
+    """
+    hashes = {}
+    for i in range(0, len(document_ids), LOOKUP_SIZE):
+        ids = document_ids[i : i + LOOKUP_SIZE]
+        rows = db_connection.execute(
+            f"SELECT id, hash FROM {table} "
+            f"WHERE target = ? AND id IN ({', '.join('?' * len(ids))});",
+            [target, *ids],
+        )
+        hashes.update(rows)
+    return hashes
+
+
+def update_document_hashes(
+    db_connection: sq.Connection,
+    target: str,
+    document_hashes: list,
+    table: str = "document_hashes",
+):
+    """Store the content hashes of successfully uploaded documents.
+
+    Args:
+        db_connection (sq.Connection): The connection to the database.
+        target (str): The index to which the documents were uploaded.
+        document_hashes (list): Tuples containing the `_id` and the content hash
+                                of each document.
+        table (str): The name of the table. Default is 'document_hashes'.
+    """
+    with _write_lock:
+        db_connection.executemany(
+            f"INSERT OR REPLACE INTO {table} (target, id, hash) VALUES (?, ?, ?);",
+            [(target, *document_hash) for document_hash in document_hashes],
+        )
+        db_connection.commit()
@@ -0,0 +1,84 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module for the records of the dicom files that cannot be processed.
+
+The workers return a record for each file that cannot be read, and the records
+are appended by the parent process to an NDJSON error file (one JSON object per
+line) once per batch::
+
+    {"path": "/data/1.dcm", "exception": "InvalidDicomError", "message": "...", "elapsed": 0.01}
+
+The error file can be given as input list of a new run to retry the files
+(see `dicom2elk.utils.io.read_dcm_list_file`).
+"""
+
+import json
+import os
+
+
+# Extension of the error files that are read as lists of dicom files
+ERROR_FILE_EXTENSION = ".errors.ndjson"
+
+
+def get_error_record(dcm_file: str, exception: Exception, elapsed: float):
+    """Get the record of the error raised while processing a dicom file.
+
+    Args:
+        dcm_file (str): Path to dicom file.
+        exception (Exception): Exception raised while processing the file.
+        elapsed (float): Time in seconds spent on the file before the error.
+
+    Returns:
+        dict: Record with the "path", "exception", "message" and "elapsed" keys.
+    """
+    return {
+        "path": dcm_file,
+        "exception": type(exception).__name__,
+        "message": str(exception),
+        "elapsed": round(elapsed, 6),
+    }
+
+
+def get_error_file(output_dir: str, input_dcm_list: str):
+    """Get the path of the error file of a dicom list file (named as its log file).
+
+    Args:
+        output_dir (str): Path to output directory.
+        input_dcm_list (str): Path to dicom list file.
+
+    Returns:
+        str: Path to error file.
+    """
+    basename = os.path.basename(input_dcm_list)
+    if basename.endswith(ERROR_FILE_EXTENSION):
+        # Retry of the errors of a previous run
+        basename = basename[: -len(ERROR_FILE_EXTENSION)] + ".retry"
+    else:
+        basename = os.path.splitext(basename)[0]
+    return os.path.join(output_dir, basename + ERROR_FILE_EXTENSION)
+
+
+def append_error_records(error_file: str, error_records: list):
+    """Append error records to an NDJSON error file in a single write.
+
+    Args:
+        error_file (str): Path to error file.
+        error_records (list): Records returned by `get_error_record`.
+    """
+    if not error_records:
+        return
+    lines = "".join(json.dumps(record) + "\n" for record in error_records)
+    with open(error_file, "a") as f:
+        f.write(lines)
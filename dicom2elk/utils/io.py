@@ -16,28 +16,139 @@
 
 import tqdm
 from multiprocessing import Pool
+from dicom2elk.utils.errors import ERROR_FILE_EXTENSION
 from dicom2elk.utils.logging import create_logger
 
+import hashlib
 import json
 import os
 import time
 import logging
 
 
-def read_dcm_list_file(dcm_list_file):
+# Size of the blocks read by `count_lines`
+COUNT_LINES_BLOCK_SIZE = 1024 * 1024
+
+# Layouts of the JSON files in the output directory (see `get_json_file`)
+JSON_LAYOUTS = ("flat", "hashed", "hierarchy")
+
+# Name of the directory of the files whose Study/Series UID is missing
+UNKNOWN_UID_DIR = "unknown"
+
+
+def _iter_dcm_list_file(dcm_list_file: str, logger: logging.Logger):
+    """Yield the lines of a dicom list file one at a time."""
+    is_error_file = dcm_list_file.endswith(ERROR_FILE_EXTENSION)
+    with open(dcm_list_file, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            if not is_error_file:
+                yield line.rstrip("\r\n")
+            elif line.strip():
+                try:
+                    yield json.loads(line)["path"]
+                except (ValueError, TypeError, KeyError) as e:
+                    # e.g. a record partially written by an interrupted run
+                    logger.warning(
+                        f"Skipping invalid record at line {line_number} "
+                        f"of {dcm_list_file}: {e!r}"
+                    )
+
+
+def read_dcm_list_file(
+    dcm_list_file: str,
+    lazy: bool = False,
+    logger: logging.Logger = create_logger("INFO"),
+):
     """Load dicom list file.
 
     Args:
-        dcm_list_file (str): Path to dicom list file.
+        dcm_list_file (str): Path to dicom list file. It can also be an NDJSON error
+                             file of a previous run (with the '.errors.ndjson' extension)
+                             to retry the files that could not be processed. Its blank
+                             lines and the records without "path" are skipped.
+        lazy (bool): If True, return a generator that reads the paths one at a time
+                     so that the memory used does not depend on the size of the list.
+                     Defaults to False.
+        logger (logging.Logger): Logger instance, which reports the skipped records
+                                 of an error file.
 
     Returns:
-        list: List of dicom files to process.
+        list or generator: List of dicom files to process.
     """
+    if lazy or dcm_list_file.endswith(ERROR_FILE_EXTENSION):
+        dcm_list = _iter_dcm_list_file(dcm_list_file, logger)
+        return dcm_list if lazy else list(dcm_list)
     with open(dcm_list_file, "r") as f:
         dcm_list = f.read().splitlines()
     return dcm_list
 
 
+def count_lines(file: str):
+    """Count the lines of a text file without decoding it.
+
+    Args:
+        file (str): Path to text file.
+
+    Returns:
+        int: Number of lines (including a last line without line break).
+    """
+    n_lines = 0
+    last_block = b""
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(COUNT_LINES_BLOCK_SIZE), b""):
+            n_lines += block.count(b"\n")
+            last_block = block
+    if last_block and not last_block.endswith(b"\n"):
+        n_lines += 1
+    return n_lines
+
+
+def get_json_file(
+    output_dir: str,
+    sop_instance_uid: str,
+    layout: str = "flat",
+    study_instance_uid: str = None,
+    series_instance_uid: str = None,
+):
+    """Get the path of the JSON file of a dicom instance in the output directory.
+
+    Args:
+        output_dir (str): Path to output directory.
+        sop_instance_uid (str): SOPInstanceUID of the instance, used as file name.
+        layout (str): Layout of the JSON files. Can be either:
+                      * 'flat': all files in `output_dir` (``<SOPInstanceUID>.json``).
+                      * 'hashed': two levels of directories named after the first
+                        characters of the SHA-1 hash of the SOPInstanceUID
+                        (``ab/cd/<SOPInstanceUID>.json``), which spreads the files
+                        evenly over 65536 directories.
+                      * 'hierarchy': a directory per study and per series
+                        (``<StudyInstanceUID>/<SeriesInstanceUID>/<SOPInstanceUID>.json``).
+                      Defaults to 'flat'.
+        study_instance_uid (str): StudyInstanceUID of the instance ('hierarchy' layout).
+        series_instance_uid (str): SeriesInstanceUID of the instance ('hierarchy' layout).
+
+    Returns:
+        str: Path to JSON file.
+
+    Raises:
+        ValueError: If `layout` is not one of `JSON_LAYOUTS`.
+    """
+    file_name = sop_instance_uid + ".json"
+    if layout == "flat":
+        return os.path.join(output_dir, file_name)
+    if layout == "hashed":
+        digest = hashlib.sha1(sop_instance_uid.encode()).hexdigest()
+        return os.path.join(output_dir, digest[:2], digest[2:4], file_name)
+    if layout == "hierarchy":
+        return os.path.join(
+            output_dir,
+            study_instance_uid or UNKNOWN_UID_DIR,
+            series_instance_uid or UNKNOWN_UID_DIR,
+            file_name,
+        )
+    raise ValueError(f"Invalid JSON layout: {layout} (expected one of {JSON_LAYOUTS})")
+
+
 def write_json_file(
     json_file: str,
     json_dict: dict,
@@ -55,16 +166,26 @@ def write_json_file(
 
     Returns:
         str: Path of output JSON file.
+
+    Note:
+        The parent directory of the JSON file is created if it does not exist
+        (e.g. with the 'hashed' and 'hierarchy' layouts of `get_json_file`).
     """
-    with open(json_file, "w") as f:
+    try:
+        f = open(json_file, "w")
+    except FileNotFoundError:
+        # Create the directory only when it is missing to save a system call per file
+        os.makedirs(os.path.dirname(json_file), exist_ok=True)
+        f = open(json_file, "w")
+    with f:
         json.dump(json_dict, f, indent=4)
 
     if not os.path.exists(json_file):
         logger.warning(f"JSON file {json_file} not found")
-        time.sleep(sleep_time_ms)
+        time.sleep(sleep_time_ms / 1000.0)  # takes seconds as argument
         return None
 
-    time.sleep(sleep_time_ms)
+    time.sleep(sleep_time_ms / 1000.0)  # takes seconds as argument
     return json_file
 
 
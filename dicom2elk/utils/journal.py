@@ -0,0 +1,189 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module for the journal of the batches completed by a run.
+
+The journal is an append-only text file in which each line records a batch
+whose files have all been saved (JSON files written or documents uploaded)::
+
+    <batch index>\t<batch size>\t<number of files>
+
+A run started with `--resume` skips the batches recorded in the journal of
+a previous run with the same batch size. A line that was only partially written
+(e.g. if the process was killed) is ignored, and is removed before a resumed run
+appends its batches so that it cannot be merged with them.
+"""
+
+import logging
+import os
+import time
+
+from dicom2elk.utils.logging import create_logger
+
+
+# Minimum time in seconds between two synchronizations of the journal to disk
+JOURNAL_FSYNC_INTERVAL = 5.0
+
+
+def get_journal_file(output_dir: str, input_dcm_list: str):
+    """Get the path of the journal of a dicom list file (named as its log file).
+
+    Args:
+        output_dir (str): Path to output directory.
+        input_dcm_list (str): Path to dicom list file.
+
+    Returns:
+        str: Path to journal file.
+    """
+    return os.path.join(
+        output_dir,
+        ".".join([os.path.splitext(os.path.basename(input_dcm_list))[0], "journal"]),
+    )
+
+
+def read_journal(
+    journal_file: str, batch_size: int, logger: logging.Logger = create_logger("INFO")
+):
+    """Read the batches recorded in a journal.
+
+    Args:
+        journal_file (str): Path to journal file.
+        batch_size (int): Batch size of the run. The batches recorded with another
+                          batch size are ignored.
+        logger (logging.Logger): Logger instance.
+
+    Returns:
+        dict: Number of files of each completed batch indexed by batch index
+              (empty if the journal does not exist). The malformed lines (e.g. partially
+              written) are ignored, so their batches are processed again.
+    """
+    completed_batches = {}
+    if not os.path.exists(journal_file):
+        return completed_batches
+    n_ignored, n_malformed = 0, 0
+    with open(journal_file, "r") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            try:
+                if not line.endswith("\n") or len(fields) != 3:
+                    # Partially written line
+                    raise ValueError(f"Malformed line {line!r}")
+                batch_index, journal_batch_size, n_files = (int(field) for field in fields)
+            except ValueError:
+                n_malformed += 1
+                continue
+            if journal_batch_size != batch_size:
+                n_ignored += 1
+                continue
+            completed_batches[batch_index] = n_files
+    if n_ignored:
+        logger.warning(
+            f"{n_ignored} batches of {journal_file} were recorded "
+            f"with another batch size and are processed again"
+        )
+    if n_malformed:
+        logger.warning(f"{n_malformed} malformed lines of {journal_file} are ignored")
+    return completed_batches
+
+
+def truncate_partial_line(journal_file: str):
+    """Remove the last line of a journal if it was only partially written.
+
+    Args:
+        journal_file (str): Path to journal file.
+
+    Returns:
+        int: Number of bytes removed.
+    """
+    if not os.path.exists(journal_file):
+        return 0
+    with open(journal_file, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        # Read the end of the file backward until the end of the last complete line
+        end = size
+        while end > 0:
+            block_start = max(0, end - 4096)
+            f.seek(block_start)
+            block = f.read(end - block_start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                end = block_start + newline + 1
+                break
+            end = block_start
+        if end != size:
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+        return size - end
+
+
+class JournalWriter:
+    """Append the completed batches to a journal.
+
+    Each batch is written and flushed at once, but the journal is synchronized
+    to disk (fsync) at most every `fsync_interval` seconds and when it is closed.
+
+    Args:
+        journal_file (str): Path to journal file.
+        batch_size (int): Batch size of the run.
+        append (bool): If True, the batches are appended to an existing journal
+                       (when the run is resumed) after its last complete line
+                       (see `truncate_partial_line`). Otherwise, the journal is truncated.
+        fsync_interval (float): Minimum time in seconds between two synchronizations.
+                                Defaults to `JOURNAL_FSYNC_INTERVAL`.
+    """
+
+    def __init__(
+        self,
+        journal_file: str,
+        batch_size: int,
+        append: bool = False,
+        fsync_interval: float = JOURNAL_FSYNC_INTERVAL,
+    ):
+        self.journal_file = journal_file
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        if append:
+            truncate_partial_line(journal_file)
+        self._file = open(journal_file, "a" if append else "w")
+        self._last_fsync = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _fsync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+
+    def record(self, batch_index: int, n_files: int):
+        """Record a completed batch.
+
+        Args:
+            batch_index (int): Index of the batch in the run.
+            n_files (int): Number of files in the batch.
+        """
+        self._file.write(f"{batch_index}\t{self.batch_size}\t{n_files}\n")
+        self._file.flush()
+        if time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._fsync()
+
+    def close(self):
+        """Synchronize the journal to disk and close it."""
+        if not self._file.closed:
+            self._fsync()
+            self._file.close()
@@ -12,10 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Module for logger."""
+"""Module for logger.
+
+The root logger of the main process owns the stream and file handlers. Worker
+processes send their records through a queue (`init_worker_logging`) to a single
+listener thread of the main process (`start_log_listener`), so that the lines
+of the workers are not interleaved and the log files are opened only once.
+"""
 
 import os
 import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
 
 
 class CustomFormatter(logging.Formatter):
@@ -72,13 +80,81 @@ def create_logger(
     if not len(_logger.handlers):
         _logger.addHandler(_handler)
     if output_dir is not None:
-        _log_file = os.path.join(output_dir, log_basename)
-        _handler = logging.FileHandler(_log_file)
-        _handler.setFormatter(CustomFormatter())
-        _logger.addHandler(_handler)
+        _log_file = os.path.abspath(os.path.join(output_dir, log_basename))
+        # Do not open the same log file twice (e.g. by several runs of `file2json`)
+        if not any(
+            getattr(_h, "baseFilename", None) == _log_file for _h in _logger.handlers
+        ):
+            _handler = logging.FileHandler(_log_file)
+            _handler.setFormatter(CustomFormatter())
+            _logger.addHandler(_handler)
     return _logger
 
 
+def remove_file_handler(logger: logging.Logger, log_file: str):
+    """Close and remove the handler of a log file added by `create_logger`.
+
+    Args:
+        logger (logging.Logger): Logger.
+        log_file (str): Path to the log file.
+    """
+    log_file = os.path.abspath(log_file)
+    for handler in list(logger.handlers):
+        if getattr(handler, "baseFilename", None) == log_file:
+            logger.removeHandler(handler)
+            handler.close()
+
+
+class _ForwardHandler(logging.Handler):
+    """Handler that passes the records of the workers to the loggers of the main process."""
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def start_log_listener():
+    """Start the listener of the records sent by worker processes.
+
+    The records are handled by the loggers of the main process with the handlers
+    they have when the records are received.
+
+    Returns:
+        tuple: Tuple containing:
+                   * the queue to pass to `init_worker_logging` in each worker.
+                   * the `QueueListener` to stop with `stop_log_listener`.
+    """
+    log_queue = multiprocessing.Queue(-1)
+    listener = QueueListener(log_queue, _ForwardHandler())
+    listener.start()
+    return log_queue, listener
+
+
+def stop_log_listener(listener: QueueListener):
+    """Handle the remaining records and stop the listener.
+
+    Args:
+        listener (logging.handlers.QueueListener): Listener returned by `start_log_listener`.
+    """
+    if listener is not None:
+        listener.stop()
+
+
+def init_worker_logging(log_queue, level: int = logging.INFO):
+    """Send the records of a worker process to the listener of the main process.
+
+    The handlers inherited from the main process are removed from the root logger.
+
+    Args:
+        log_queue (multiprocessing.Queue): Queue returned by `start_log_listener`.
+        level (int): Logging level of the worker.
+    """
+    _logger = logging.getLogger()
+    for _handler in list(_logger.handlers):
+        _logger.removeHandler(_handler)
+    _logger.addHandler(QueueHandler(log_queue))
+    _logger.setLevel(level)
+
+
 def get_logger_basefilename(logger):
     """Finds the logger base filename.
 
@@ -0,0 +1,92 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module for the manifests of the JSON files written by a run.
+
+In 'json' mode, the parent process appends the JSON files written by each batch
+to a manifest named after the dicom list file, so that the files can be found
+whatever the layout of the output directory (see `dicom2elk.utils.io.get_json_file`)
+without listing it. Each line maps a SOPInstanceUID to the path of its JSON file
+relative to the output directory::
+
+    <SOPInstanceUID>\\t<relative path>
+"""
+
+import os
+
+
+# Extension of the manifest files
+MANIFEST_FILE_EXTENSION = ".manifest.tsv"
+
+
+def get_manifest_file(output_dir: str, input_dcm_list: str):
+    """Get the path of the manifest of a dicom list file (named as its log file).
+
+    Args:
+        output_dir (str): Path to output directory.
+        input_dcm_list (str): Path to dicom list file.
+
+    Returns:
+        str: Path to manifest file.
+    """
+    return os.path.join(
+        output_dir,
+        os.path.splitext(os.path.basename(input_dcm_list))[0] + MANIFEST_FILE_EXTENSION,
+    )
+
+
+def append_manifest_entries(manifest_file: str, output_dir: str, json_files: list):
+    """Append the JSON files of a batch to a manifest in a single write.
+
+    Args:
+        manifest_file (str): Path to manifest file.
+        output_dir (str): Path to output directory to which the paths are relative.
+        json_files (list): Paths to the JSON files, named after the SOPInstanceUID
+                           of their dicom file.
+    """
+    if not json_files:
+        return
+    lines = "".join(
+        f"{os.path.splitext(os.path.basename(json_file))[0]}\t"
+        f"{os.path.relpath(json_file, output_dir)}\n"
+        for json_file in json_files
+    )
+    with open(manifest_file, "a") as f:
+        f.write(lines)
+
+
+def read_manifest(manifest_file: str, output_dir: str = None):
+    """Read a manifest.
+
+    Args:
+        manifest_file (str): Path to manifest file.
+        output_dir (str): Path to output directory. If given, the paths are
+                          joined to it. Otherwise, they are relative.
+
+    Returns:
+        dict: Paths to the JSON files indexed by SOPInstanceUID. If an instance was
+              written several times, the last path is kept.
+    """
+    json_files = {}
+    with open(manifest_file, "r") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if not line.endswith("\n") or len(fields) != 2:
+                # Partially written line
+                continue
+            sop_instance_uid, json_file = fields
+            if output_dir is not None:
+                json_file = os.path.join(output_dir, json_file)
+            json_files[sop_instance_uid] = json_file
+    return json_files
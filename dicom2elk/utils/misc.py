@@ -14,17 +14,51 @@
 
 """Module for miscellaneous functions."""
 
+from itertools import islice
 
-def prepare_file_list_batches(file_list: list, batch_size: int):
+
+# Maximum number of files sent at once to a worker process
+MAX_CHUNKSIZE = 64
+
+
+def _iter_file_list_batches(file_list, batch_size: int):
+    """Yield batches of files taken one at a time from an iterable."""
+    file_iterator = iter(file_list)
+    while True:
+        batch = list(islice(file_iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_n_batches(n_files: int, batch_size: int):
+    """Get the number of batches prepared by `prepare_file_list_batches`.
+
+    Args:
+        n_files (int): Number of files to process.
+        batch_size (int): Batch size.
+
+    Returns:
+        int: Number of batches.
+    """
+    return -(-n_files // max(batch_size, 1))
+
+
+def prepare_file_list_batches(file_list, batch_size: int, lazy: bool = False):
     """Prepare batches of dicom files to process.
 
     Args:
-        file_list (list): List of files to process.
+        file_list (list or iterable): List of files to process. It can be any
+                                      iterable (e.g. a generator) if `lazy` is True.
         batch_size (int): Batch size.
+        lazy (bool): If True, return a generator that builds each batch when it is
+                     needed so that only one batch is held in memory. Defaults to False.
 
     Returns:
-        list: List of batches of files to process.
+        list or generator: List of batches of files to process.
     """
+    if lazy:
+        return _iter_file_list_batches(file_list, batch_size)
     file_list_batches = []
     if len(file_list) == 0:
         return file_list_batches
@@ -33,3 +67,22 @@ def prepare_file_list_batches(file_list: list, batch_size: int):
     for i in range(0, len(file_list), batch_size):
         file_list_batches.append(file_list[i : i + batch_size])
     return file_list_batches
+
+
+def get_chunksize(n_tasks: int, n_workers: int, max_chunksize: int = MAX_CHUNKSIZE):
+    """Get the number of tasks sent at once to a worker process.
+
+    Each worker receives about 4 chunks so that the load stays balanced when
+    some tasks are slower, and chunks are capped to limit the results held back
+    by a straggling worker.
+
+    Args:
+        n_tasks (int): Number of tasks to dispatch.
+        n_workers (int): Number of worker processes.
+        max_chunksize (int): Maximum chunk size. Defaults to `MAX_CHUNKSIZE`.
+
+    Returns:
+        int: Chunk size (at least 1).
+    """
+    chunksize = -(-n_tasks // (4 * max(n_workers, 1)))
+    return max(1, min(chunksize, max_chunksize))
@@ -14,10 +14,43 @@
 
 """Module for defining profiling related functions."""
 
+import csv
 import os
 import time
 
 
+# Columns of the profile files, in order
+PROFILER_COLUMNS = [
+    "timestamp",
+    "n_threads",
+    "batch_size",
+    "process_handler",
+    "max_memory_usage",
+    "total_dcm_processed",
+    "total_dcm_skipped",
+    "total_time",
+    # "total_time_extraction",
+    # "total_time_save",
+    "total_bulk_data_bytes_skipped",
+    "auto_tune",
+]
+
+
+def _read_header(tsv_file: str):
+    """Read the column names of the first line of a TSV file."""
+    with open(tsv_file, "r", newline="") as f:
+        return next(csv.reader(f, delimiter="\t"), [])
+
+
+def _rotate_file(file: str):
+    """Rename a file to the first free name among '<file>.1', '<file>.2', ..."""
+    n = 1
+    while os.path.exists(f"{file}.{n}"):
+        n += 1
+    os.rename(file, f"{file}.{n}")
+    return f"{file}.{n}"
+
+
 def append_profiler_results(
     tsv_file: str,
     n_threads: int,
@@ -29,16 +62,22 @@ def append_profiler_results(
     total_time: float,
     # total_time_extraction: float,
     # total_time_save: float,
+    total_bulk_data_bytes_skipped: int = 0,
+    auto_tune: bool = False,
 ):
     """Append profiler results to profile file.
 
+    The results are written by column name. If the profile file was written with
+    other columns (e.g. by an older version), it is renamed to '<tsv_file>.<n>' and
+    a new profile file is created, so that the rows are never misaligned with the header.
+
     Args:
         tsv_file (str): Path to output TSV file that will contain profiler results.
         n_threads (int): Number of threads used for parallel processing.
         batch_size (int): Batch size for extracting and saving/uploading
                           metadata tags from dicom files.
         process_handler (str): Process handler used for parallel/asynchronous processing.
-                               Can be either 'multiprocessing' or 'asyncio'.
+                               Can be either 'multiprocessing', 'asyncio' or 'threads'.
         max_memory_usage (float): Maximum memory usage.
         total_dcm_processed (int): Total number of dicom files processed.
         total_dcm_skipped (int): Total number of dicom files skipped.
@@ -47,48 +86,40 @@ def append_profiler_results(
         #                                from dicom files (seconds).
         # total_time_save (float): Total time spent for saving/uploading tags
         #                          to JSON/Elasticsearch (seconds).
+        total_bulk_data_bytes_skipped (int): Total number of bytes of bulk data elements
+                                             that were replaced by a stub.
+        auto_tune (bool): True if `n_threads` and `batch_size` were chosen by the
+                          auto-tuning of the run (see `dicom2elk.core.autotune`).
+
+    Returns:
+        str: Path to which the previous profile file was renamed because of its
+             other columns, or None.
     """
-    if os.path.exists(tsv_file):
-        mode = "a"
-    else:
-        mode = "w"
+    rotated_file = None
+    if os.path.exists(tsv_file) and _read_header(tsv_file) != PROFILER_COLUMNS:
+        rotated_file = _rotate_file(tsv_file)
+    mode = "a" if os.path.exists(tsv_file) else "w"
 
     timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime())
 
-    with open(tsv_file, mode) as f:
+    with open(tsv_file, mode, newline="") as f:
+        writer = csv.DictWriter(f, PROFILER_COLUMNS, delimiter="\t", lineterminator="\n")
         if mode == "w":  # write header at creation
-            f.write(
-                "\t".join(
-                    [
-                        "timestamp",
-                        "n_threads",
-                        "batch_size",
-                        "process_handler",
-                        "max_memory_usage",
-                        "total_dcm_processed",
-                        "total_dcm_skipped",
-                        "total_time",
-                        # "total_time_extraction",
-                        # "total_time_save",
-                    ]
-                )
-                + "\n"
-            )
-        f.write(
-            "\t".join(
-                [
-                    timestamp,
-                    str(n_threads),
-                    str(batch_size),
-                    process_handler,
-                    str(max_memory_usage),
-                    str(total_dcm_processed),
-                    str(total_dcm_skipped),
-                    str(total_time),
-                    # str(total_time_extraction),
-                    # str(total_time_save),
-                ]
-            )
-            + "\n"
+            writer.writeheader()
+        writer.writerow(
+            {
+                "timestamp": timestamp,
+                "n_threads": n_threads,
+                "batch_size": batch_size,
+                "process_handler": process_handler,
+                "max_memory_usage": max_memory_usage,
+                "total_dcm_processed": total_dcm_processed,
+                "total_dcm_skipped": total_dcm_skipped,
+                "total_time": total_time,
+                # "total_time_extraction": total_time_extraction,
+                # "total_time_save": total_time_save,
+                "total_bulk_data_bytes_skipped": total_bulk_data_bytes_skipped,
+                "auto_tune": auto_tune,
+            }
         )
-
+    return rotated_file
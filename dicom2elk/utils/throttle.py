@@ -0,0 +1,260 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module that provides a throttle shared by all workers of a run.
+
+The throttle limits the number of files and bytes read from the storage per
+second and the number of documents sent to Elasticsearch per second with token
+buckets. The state of each bucket (available tokens and time of the last refill)
+is held in shared memory, so that the limits apply to the whole run whatever the
+number of worker processes and threads. The throttle is passed to the worker
+processes when they are created (see `dicom2elk.core.process.create_worker_pool`).
+
+The rates can be scaled down during some hours of the day with a schedule
+such as ``"07:00-19:00=0.2"`` (20% of the rates during clinical hours and
+full speed otherwise). Several windows can be separated by commas, and a window
+can span midnight (e.g. ``"22:00-06:00=0.5"``).
+"""
+
+import multiprocessing
+import os
+import time
+
+
+def _parse_time_of_day(value: str):
+    """Convert a time of day in HH:MM format to a number of minutes since midnight."""
+    hours, minutes = value.strip().split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours <= 24 and 0 <= minutes < 60) or hours * 60 + minutes > 24 * 60:
+        raise ValueError(f"Invalid time of day: {value}")
+    return hours * 60 + minutes
+
+
+def parse_throttle_schedule(schedule: str):
+    """Parse a throttle schedule.
+
+    Args:
+        schedule (str): Comma-separated windows in ``HH:MM-HH:MM=factor`` format,
+                        where factor (> 0) is the fraction of the rates applied
+                        during the window (e.g. ``"07:00-19:00=0.2"``).
+
+    Returns:
+        list: Tuples containing the start and end of each window in minutes since
+              midnight and its factor (empty if `schedule` is None or empty).
+
+    Raises:
+        ValueError: If the schedule is not valid.
+    """
+    windows = []
+    if not schedule:
+        return windows
+    for window in schedule.split(","):
+        try:
+            hours, factor = window.split("=")
+            start, end = hours.split("-")
+            start, end, factor = (
+                _parse_time_of_day(start),
+                _parse_time_of_day(end),
+                float(factor),
+            )
+        except ValueError:
+            raise ValueError(
+                f"Invalid throttle schedule window '{window}' "
+                f"(expected format: HH:MM-HH:MM=factor)"
+            )
+        if factor <= 0:
+            raise ValueError(
+                f"The factor of the throttle schedule window '{window}' must be greater than 0"
+            )
+        windows.append((start, end, factor))
+    return windows
+
+
+def get_schedule_factor(schedule: list, now: float = None):
+    """Get the factor of the rates at a given time.
+
+    Args:
+        schedule (list): Windows returned by `parse_throttle_schedule`.
+        now (float): Timestamp in seconds since the epoch. Defaults to the current time.
+
+    Returns:
+        float: Factor of the first window containing the local time of day,
+               or 1.0 if no window contains it.
+    """
+    if not schedule:
+        return 1.0
+    local_time = time.localtime(now)
+    minutes = local_time.tm_hour * 60 + local_time.tm_min
+    for start, end, factor in schedule:
+        if start <= end:
+            in_window = start <= minutes < end
+        else:
+            # Window spanning midnight
+            in_window = minutes >= start or minutes < end
+        if in_window:
+            return factor
+    return 1.0
+
+
+class TokenBucket:
+    """Token bucket whose state is shared between processes.
+
+    The bucket is refilled at `rate` tokens per second up to `burst` tokens.
+    A request for more tokens than available is granted at once, but the deficit
+    delays the next requests, so that the average rate never exceeds `rate`
+    even for requests larger than `burst` (e.g. the bytes of a large file).
+
+    Args:
+        rate (float): Number of tokens added per second.
+        burst (float): Maximum number of tokens in the bucket. Defaults to `rate`
+                       (one second of tokens).
+        schedule (list): Windows returned by `parse_throttle_schedule`
+                         that scale `rate` during some hours of the day.
+    """
+
+    def __init__(self, rate: float, burst: float = None, schedule: list = None):
+        if rate <= 0:
+            raise ValueError("The rate of a token bucket must be greater than 0.")
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.schedule = schedule or []
+        self._lock = multiprocessing.Lock()
+        # Available tokens and monotonic time of the last refill
+        # (the monotonic clock is shared by all processes of the system)
+        self._state = multiprocessing.RawArray("d", [self.burst, time.monotonic()])
+
+    def reserve(self, n_tokens: float = 1.0):
+        """Take tokens from the bucket.
+
+        Args:
+            n_tokens (float): Number of tokens to take.
+
+        Returns:
+            float: Time in seconds to wait before using the tokens (0 if they were available).
+        """
+        rate = self.rate * get_schedule_factor(self.schedule)
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.burst, self._state[0] + (now - self._state[1]) * rate)
+            tokens -= n_tokens
+            self._state[0], self._state[1] = tokens, now
+        return max(0.0, -tokens / rate)
+
+
+class Throttle:
+    """Limits of the files and bytes read and of the documents sent per second by a run.
+
+    Args:
+        files_per_sec (float): Maximum number of files read per second. If None, not limited.
+        bytes_per_sec (float): Maximum number of bytes read per second. If None, not limited.
+        documents_per_sec (float): Maximum number of documents sent to Elasticsearch
+                                   per second. If None, not limited.
+        schedule (str): Schedule that scales the rates during some hours of the day
+                        (see `parse_throttle_schedule`).
+    """
+
+    def __init__(
+        self,
+        files_per_sec: float = None,
+        bytes_per_sec: float = None,
+        documents_per_sec: float = None,
+        schedule: str = None,
+    ):
+        windows = parse_throttle_schedule(schedule)
+        self.files_per_sec = files_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.documents_per_sec = documents_per_sec
+        self.schedule = schedule
+        self._files = TokenBucket(files_per_sec, schedule=windows) if files_per_sec else None
+        self._bytes = TokenBucket(bytes_per_sec, schedule=windows) if bytes_per_sec else None
+        self._documents = (
+            TokenBucket(documents_per_sec, schedule=windows) if documents_per_sec else None
+        )
+
+    def __repr__(self):
+        return (
+            f"Throttle(files_per_sec={self.files_per_sec}, "
+            f"bytes_per_sec={self.bytes_per_sec}, "
+            f"documents_per_sec={self.documents_per_sec}, "
+            f"schedule={self.schedule!r})"
+        )
+
+    def reserve_file(self, n_bytes: int = 0):
+        """Reserve the read of a file.
+
+        Args:
+            n_bytes (int): Size of the file in bytes.
+
+        Returns:
+            float: Time in seconds to wait before reading the file.
+        """
+        delay = 0.0
+        if self._files is not None:
+            delay = self._files.reserve(1)
+        if self._bytes is not None and n_bytes:
+            delay = max(delay, self._bytes.reserve(n_bytes))
+        return delay
+
+    def wait_file(self, n_bytes: int = 0):
+        """Wait until a file of `n_bytes` bytes can be read (see `reserve_file`)."""
+        delay = self.reserve_file(n_bytes)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def reserve_documents(self, n_documents: int):
+        """Reserve the upload of documents.
+
+        Args:
+            n_documents (int): Number of documents to send.
+
+        Returns:
+            float: Time in seconds to wait before sending the documents.
+        """
+        if self._documents is None or not n_documents:
+            return 0.0
+        return self._documents.reserve(n_documents)
+
+    def wait_documents(self, n_documents: int):
+        """Wait until `n_documents` documents can be sent (see `reserve_documents`)."""
+        delay = self.reserve_documents(n_documents)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+def get_file_size(file_path: str):
+    """Get the size of a file in bytes (0 if it cannot be accessed)."""
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def create_throttle(
+    files_per_sec: float = None,
+    bytes_per_sec: float = None,
+    documents_per_sec: float = None,
+    schedule: str = None,
+):
+    """Create the throttle of a run if at least one limit is given.
+
+    See `Throttle` for the description of the arguments.
+
+    Returns:
+        Throttle: Throttle to share between the workers, or None if no limit is given.
+    """
+    if not (files_per_sec or bytes_per_sec or documents_per_sec):
+        return None
+    return Throttle(files_per_sec, bytes_per_sec, documents_per_sec, schedule)
@@ -0,0 +1,83 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of the DICOM JSON serializer against pydicom's `to_json_dict`.
+
+Run it with::
+
+    pytest -s profiling/test_profiling_serializer.py
+"""
+
+import os
+import glob
+import time
+import warnings
+
+from pydicom import dcmread
+from pydicom.data.data_manager import DATA_ROOT
+
+from dicom2elk.core.dicom.serializer import to_json_dict
+
+
+N_REPEATS = 20
+
+
+def get_datasets():
+    datasets = []
+    dcm_files = glob.glob(os.path.join(DATA_ROOT, "test_files", "*.dcm"))
+    for dcm_file in sorted(dcm_files):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                dcmread(dcm_file, stop_before_pixels=True).to_json_dict()
+        except Exception:
+            continue
+        datasets.append(dcm_file)
+    return datasets
+
+
+def read_datasets(dcm_files):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return [dcmread(dcm_file, stop_before_pixels=True) for dcm_file in dcm_files]
+
+
+def time_serialization(serialize, dcm_files):
+    """Time the serialization of the files, without their reading, over `N_REPEATS`."""
+    elapsed_time = 0.0
+    for _ in range(N_REPEATS):
+        # The datasets are read again at each repeat (outside of the timer) as
+        # the conversion of the raw elements by pydicom is cached in the dataset
+        dcm_datasets = read_datasets(dcm_files)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            tic = time.perf_counter()
+            for dcm_dataset in dcm_datasets:
+                serialize(dcm_dataset)
+            elapsed_time += time.perf_counter() - tic
+    return elapsed_time / (N_REPEATS * len(dcm_files))
+
+
+def test_profiling_serializer():
+    dcm_files = get_datasets()
+    pydicom_time = time_serialization(
+        lambda dcm_dataset: dcm_dataset.to_json_dict(), dcm_files
+    )
+    dicom2elk_time = time_serialization(to_json_dict, dcm_files)
+    print(
+        f"\n{len(dcm_files)} files x {N_REPEATS} repeats (serialization only): "
+        f"pydicom {1000 * pydicom_time:.3f} ms/file, "
+        f"dicom2elk {1000 * dicom2elk_time:.3f} ms/file, "
+        f"speedup x{pydicom_time / dicom2elk_time:.2f}"
+    )
@@ -14,6 +14,7 @@
 
 """Tests for dicom2elk CLI."""
 
+import logging
 import os
 import pytest
 
@@ -73,3 +74,26 @@ def test_dryrun_dicom2elk_no_output_dir(script_runner, tmpdir, test_dcm_files):
         ).returncode
         == 2
     )
+
+
+def test_process_failure_closes_log_file(tmpdir, test_dcm_files, monkeypatch, make_args):
+    from dicom2elk.cli import dicom2elk
+
+    dcm_list_file = str(tmpdir.join("dcm_list.txt"))
+    with open(dcm_list_file, "w") as f:
+        f.write("\n".join(test_dcm_files) + "\n")
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("batch")
+
+    monkeypatch.setattr(dicom2elk, "process_batches", fail)
+    args = make_args(input_dcm_list=dcm_list_file, output_dir=str(tmpdir))
+    # Test if the log file of the list is closed even if the run fails
+    with pytest.raises(RuntimeError):
+        dicom2elk.process(args)
+    log_file = os.path.join(str(tmpdir), "dcm_list.log")
+    assert os.path.exists(log_file)
+    assert not any(
+        getattr(handler, "baseFilename", None) == log_file
+        for handler in logging.getLogger().handlers
+    )
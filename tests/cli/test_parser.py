@@ -14,7 +14,13 @@
 
 """Tests for dicom2elk.cli.parser module."""
 
-from dicom2elk.cli.parser import get_dicom2elk_parser, get_file2list_parser
+import pytest
+
+from dicom2elk.cli.parser import (
+    get_dicom2elk_parser,
+    get_file2list_parser,
+    validate_args,
+)
 
 
 def test_get_dicom2elk_parser():
@@ -25,3 +31,23 @@ def test_get_dicom2elk_parser():
 def test_get_file2list_parser():
     # Test if get_file2list_parser returns a parser
     assert get_file2list_parser() is not None
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["--io-threads", "0"],
+        ["--max-files-per-sec", "0"],
+        ["--auto-tune", "--resume"],
+        ["--bulk-max-retries", "-1"],
+        ["--mode", "parquet", "--incremental"],
+    ],
+)
+def test_validate_args(argv):
+    parser = get_dicom2elk_parser()
+    required_argv = ["-i", "dcm_list.txt", "-o", "output"]
+    # Test if valid arguments are accepted
+    validate_args(parser, parser.parse_args(required_argv))
+    # Test if invalid arguments exit with a usage message
+    with pytest.raises(SystemExit):
+        validate_args(parser, parser.parse_args(required_argv + argv))
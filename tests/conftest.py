@@ -13,12 +13,15 @@
 # limitations under the License.
 
 import os
+import glob
+import json
 import shutil
 import sqlite3 as sq
 
 import pytest
 
-from pydicom.data import get_testdata_files
+from pydicom.data import get_testdata_file, get_testdata_files
+from pydicom.data.data_manager import DATA_ROOT
 
 
 @pytest.fixture(scope="session")
@@ -35,6 +38,24 @@ def test_gz_file():
     return test_file
 
 
+@pytest.fixture(scope="session")
+def test_overlay_file():
+    # Get a test DICOM file from pydicom with private OB, overlay
+    # and icon image (nested in a sequence) elements
+    test_file = get_testdata_file("examples_overlay.dcm")
+    return test_file
+
+
+@pytest.fixture(scope="session")
+def test_corpus_files():
+    # Get the list of all DICOM files shipped with pydicom
+    # (without downloading the external ones)
+    test_files = sorted(
+        glob.glob(os.path.join(DATA_ROOT, "test_files", "**", "*.dcm"), recursive=True)
+    )
+    return test_files
+
+
 @pytest.fixture(scope="session")
 def io_path():
     # Set the path to the input/output directory for test that lies
@@ -83,3 +104,108 @@ def db_connection(io_path):
     # Create a new database
     conn = sq.connect(db_file)
     return conn
+
+
+@pytest.fixture
+def make_args(tmpdir):
+    """Build the arguments of a dicom2elk run with the defaults of its parser."""
+    from dicom2elk.cli.parser import get_dicom2elk_parser
+
+    def _make_args(**options):
+        args = get_dicom2elk_parser().parse_args(
+            ["-i", str(tmpdir.join("dcm_list.txt")), "-o", str(tmpdir)]
+        )
+        vars(args).update(options)
+        return args
+
+    return _make_args
+
+
+@pytest.fixture
+def es_config_file(tmpdir):
+    """Create a config file of a (fake) Elasticsearch instance."""
+    config_file = str(tmpdir.join("es_config.json"))
+    with open(config_file, "w") as f:
+        json.dump(
+            {"url": "localhost", "port": 9200, "index": "dicom", "user": "u", "pwd": "p"},
+            f,
+        )
+    return config_file
+
+
+class FakeIndicesClient:
+    """Indices API of `FakeElasticsearch` that records the calls."""
+
+    def __init__(self, calls: list):
+        self.calls = calls
+        self.settings = {"number_of_replicas": "1"}
+        self.existing = False
+        self.meta = {}
+        # Indices of each alias
+        self.aliases = {}
+
+    def put_index_template(self, **kwargs):
+        self.calls.append(("put_index_template", kwargs))
+
+    def exists(self, index):
+        return self.existing
+
+    def create(self, index, **kwargs):
+        self.calls.append(("create", index))
+        self.existing = True
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return {
+            index: {"aliases": {name: {"is_write_index": is_write_index}}}
+            for index, is_write_index in self.aliases[name].items()
+        }
+
+    def get_mapping(self, index):
+        mappings = {"_meta": dict(self.meta)} if self.meta else {}
+        return {index: {"mappings": mappings}}
+
+    def put_mapping(self, index, meta):
+        self.calls.append(("put_mapping", meta))
+        self.meta = meta
+
+    def get_settings(self, index):
+        return {index: {"settings": {"index": dict(self.settings)}}}
+
+    def put_settings(self, index, settings):
+        self.calls.append(("put_settings", settings["index"]))
+        for name, value in settings["index"].items():
+            if value is None:
+                self.settings.pop(name, None)
+            else:
+                self.settings[name] = value
+
+    def refresh(self, index):
+        self.calls.append(("refresh", index))
+
+
+class FakeElasticsearch:
+    """Elasticsearch client that records the calls of the indices API."""
+
+    def __init__(self):
+        self.calls = []
+        self.indices = FakeIndicesClient(self.calls)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_es_client(monkeypatch):
+    """Replace the shared Elasticsearch clients by a fake one."""
+    from dicom2elk.core.elasticsearch import client
+
+    es = FakeElasticsearch()
+    monkeypatch.setattr(
+        client, "create_elasticsearch_client", lambda config, connections_per_node: es
+    )
+    yield es
+    client.close_elasticsearch_clients()
@@ -0,0 +1,51 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.dicom.bulkdata module."""
+
+from pydicom import dcmread
+
+from dicom2elk.core.dicom.bulkdata import dataset_to_json_dict, get_bulk_data_uri
+
+
+def test_get_bulk_data_uri():
+    uri = get_bulk_data_uri("/data/file.dcm", 0x00291010, 1234)
+    assert uri == "file:///data/file.dcm#tag=00291010&length=1234"
+
+
+def test_dataset_to_json_dict_no_threshold(test_overlay_file):
+    # Test if the output is the one of `to_json_dict` when no threshold is given
+    dcm_dataset = dcmread(test_overlay_file, stop_before_pixels=True)
+    json_dict, bulk_data_bytes = dataset_to_json_dict(dcm_dataset, test_overlay_file)
+    assert json_dict == dcm_dataset.to_json_dict()
+    assert bulk_data_bytes == 0
+
+
+def test_dataset_to_json_dict_threshold(test_overlay_file):
+    dcm_dataset = dcmread(test_overlay_file, stop_before_pixels=True, defer_size=1024)
+    json_dict, bulk_data_bytes = dataset_to_json_dict(
+        dcm_dataset, test_overlay_file, bulk_data_threshold=1024
+    )
+    # Test if the top-level private OB and overlay OW elements are replaced by stubs
+    assert json_dict["60003000"] == {
+        "vr": "OW",
+        "BulkDataURI": get_bulk_data_uri(test_overlay_file, 0x60003000, 18150),
+    }
+    assert "InlineBinary" not in json_dict["00291110"]
+    # Test if the pixel data of the nested icon image is replaced by a stub
+    icon_json_dict = json_dict["00880200"]["Value"][0]
+    assert "BulkDataURI" in icon_json_dict["7FE00010"]
+    # Test if the keys are still sorted
+    assert list(json_dict.keys()) == sorted(json_dict.keys())
+    assert bulk_data_bytes > 18150 + 5342
@@ -5,10 +5,14 @@
 
 import os
 
+from pydicom.data import get_testdata_file
+
 from dicom2elk.core.dicom.metadata import (
     extract_metadata_from_dcm,
     extract_metadata_from_dcm_list,
+    get_worker_options,
 )
+from dicom2elk.core.dicom.tags import get_tag_selection
 
 
 def test_extract_metadata_from_dcm_list_asyncio(test_dcm_files, io_path):
@@ -74,3 +78,150 @@ def test_extract_metadata_from_dcm(test_dcm_files, io_path):
         assert os.path.exists(
             extract_metadata_from_dcm(dcm_file, mode="json", output_dir=str(io_path))
         )
+
+
+def test_extract_metadata_from_dcm_json_layout(test_dcm_files, tmpdir):
+    output_dir = str(tmpdir.mkdir("output"))
+    # Test if the JSON file is written in the directories of its study and series
+    json_file = extract_metadata_from_dcm(
+        test_dcm_files[0], mode="json", output_dir=output_dir, json_layout="hierarchy"
+    )
+    assert os.path.exists(json_file)
+    assert len(os.path.relpath(json_file, output_dir).split(os.sep)) == 3
+
+
+def test_extract_metadata_from_dcm_specific_tags(test_dcm_files, io_path):
+    # Test if only the selected tags are extracted
+    include_tags, exclude_tags = get_tag_selection(
+        {"tags": {"include": ["patient"], "exclude": ["PatientWeight"]}}
+    )
+    json_dict = extract_metadata_from_dcm(
+        test_dcm_files[1],
+        mode="elasticsearch",
+        kwargs={"specific_tags": include_tags},
+        exclude_tags=exclude_tags,
+    )
+    assert "00100020" in json_dict  # PatientID
+    assert "00080018" in json_dict  # SOPInstanceUID
+    assert "00101030" not in json_dict  # PatientWeight
+    assert "00080060" not in json_dict  # Modality
+
+
+def test_extract_metadata_from_dcm_bulk_data_threshold(test_overlay_file):
+    # Test if the number of bytes of bulk data that are skipped is returned
+    json_dict, stats = extract_metadata_from_dcm(
+        test_overlay_file,
+        mode="elasticsearch",
+        bulk_data_threshold=1024,
+        return_stats=True,
+    )
+    assert "BulkDataURI" in json_dict["60003000"]
+    assert stats["bulk_data_bytes_skipped"] > 0
+
+
+def test_extract_metadata_from_dcm_raw_engine(test_dcm_files):
+    json_dict = extract_metadata_from_dcm(test_dcm_files[0], mode="elasticsearch")
+    raw_json_dict, stats = extract_metadata_from_dcm(
+        test_dcm_files[0], mode="elasticsearch", engine="raw", return_stats=True
+    )
+    assert raw_json_dict == json_dict
+    assert stats["raw_engine_fallbacks"] == 0
+
+
+def test_extract_metadata_from_dcm_raw_engine_fallback():
+    # Test if the file encoded with implicit VR is read by pydicom
+    dcm_file = get_testdata_file("MR_small_implicit.dcm")
+    json_dict, stats = extract_metadata_from_dcm(
+        dcm_file, mode="elasticsearch", engine="raw", return_stats=True
+    )
+    assert json_dict == extract_metadata_from_dcm(dcm_file, mode="elasticsearch")
+    assert stats["raw_engine_fallbacks"] == 1
+
+
+def test_extract_metadata_from_dcm_list_threads(test_dcm_files, io_path):
+    # Test the pool of threads of the main process
+    dcm_json_files_list = extract_metadata_from_dcm_list(
+        test_dcm_files,
+        n_threads=1,
+        process_handler="threads",
+        io_threads=4,
+        mode="json",
+        output_dir=str(io_path),
+    )
+    assert len(dcm_json_files_list) == len(test_dcm_files)
+    output_json_file = os.path.join(
+        io_path, "1.3.6.1.4.1.5962.1.1.4.1.1.20040826185059.5457.json"
+    )
+    assert os.path.exists(output_json_file)
+    os.remove(output_json_file)
+
+
+def test_extract_metadata_from_dcm_list_threads_multiproc(test_dcm_files, io_path):
+    # Test the pools of threads of 2 worker processes
+    stats = {}
+    dcm_json_files_list = extract_metadata_from_dcm_list(
+        test_dcm_files,
+        n_threads=2,
+        process_handler="threads",
+        io_threads=3,
+        mode="json",
+        output_dir=str(io_path),
+        stats=stats,
+    )
+    assert len(dcm_json_files_list) == len(test_dcm_files)
+    assert stats["bulk_data_bytes_skipped"] == 0
+    output_json_file = os.path.join(
+        io_path, "1.3.6.1.4.1.5962.1.1.4.1.1.20040826185059.5457.json"
+    )
+    assert os.path.exists(output_json_file)
+    os.remove(output_json_file)
+
+
+def test_extract_metadata_from_dcm_bytes(test_dcm_files):
+    # Test if the content of a file that has already been read gives the same output
+    with open(test_dcm_files[0], "rb") as f:
+        dcm_bytes = f.read()
+    json_dict = extract_metadata_from_dcm(test_dcm_files[0], mode="elasticsearch")
+    for engine in ["pydicom", "raw"]:
+        assert (
+            extract_metadata_from_dcm(
+                test_dcm_files[0],
+                mode="elasticsearch",
+                engine=engine,
+                dcm_bytes=dcm_bytes,
+            )
+            == json_dict
+        )
+
+
+def test_extract_metadata_from_dcm_list_asyncio_singleproc(test_dcm_files, io_path):
+    stats = {}
+    dcm_json_files_list = extract_metadata_from_dcm_list(
+        test_dcm_files,
+        n_threads=1,
+        process_handler="asyncio",
+        mode="json",
+        output_dir=str(io_path),
+        stats=stats,
+    )
+    assert len(dcm_json_files_list) == len(test_dcm_files)
+    assert stats["bulk_data_bytes_skipped"] == 0
+    output_json_file = os.path.join(
+        io_path, "1.3.6.1.4.1.5962.1.1.4.1.1.20040826185059.5457.json"
+    )
+    assert os.path.exists(output_json_file)
+    os.remove(output_json_file)
+
+
+def test_extract_metadata_from_dcm_list_worker_options(test_dcm_files, tmpdir):
+    output_dir = str(tmpdir.mkdir("output"))
+    # Test if the options built once for the run are used for all files
+    worker_options = get_worker_options(
+        mode="json", output_dir=output_dir, json_layout="hierarchy"
+    )
+    dcm_json_files_list = extract_metadata_from_dcm_list(
+        test_dcm_files, worker_options=worker_options
+    )
+    assert len(dcm_json_files_list) == len(test_dcm_files)
+    for json_file in dcm_json_files_list:
+        assert len(os.path.relpath(json_file, output_dir).split(os.sep)) == 3
@@ -0,0 +1,90 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.dicom.raw module."""
+
+import warnings
+
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+
+from dicom2elk.core.dicom.raw import read_raw_dataset
+from dicom2elk.core.dicom.serializer import to_json_dict
+from dicom2elk.core.dicom.tags import resolve_tags
+
+
+def test_read_raw_dataset_equivalence(test_corpus_files):
+    # Test if the supported files give the same output as pydicom
+    n_compared = 0
+    for dcm_file in test_corpus_files:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                expected = dcmread(dcm_file, stop_before_pixels=True).to_json_dict()
+        except Exception:
+            continue
+        try:
+            dcm_dataset = read_raw_dataset(dcm_file)
+        except ValueError:
+            # Unsupported file that is read by pydicom
+            continue
+        assert to_json_dict(dcm_dataset) == expected, dcm_file
+        n_compared += 1
+    assert n_compared > 0
+
+
+def test_read_raw_dataset_specific_tags(test_dcm_files):
+    tags = resolve_tags(["series", "SOPInstanceUID"])
+    expected = dcmread(
+        test_dcm_files[0], stop_before_pixels=True, specific_tags=tags
+    ).to_json_dict()
+    json_dict = to_json_dict(read_raw_dataset(test_dcm_files[0], specific_tags=tags))
+    assert json_dict == expected
+    assert "00080018" in json_dict
+    assert "00100010" not in json_dict
+
+
+def test_read_raw_dataset_stop_tag():
+    dcm_file = get_testdata_file("MR_small.dcm")
+    dcm_dataset = read_raw_dataset(dcm_file, stop_tag=0x00100000)
+    assert dcm_dataset
+    assert all(tag < 0x00100000 for tag in dcm_dataset.keys())
+
+    # Test if the pixel data is read when no stop tag is given
+    dcm_dataset = read_raw_dataset(dcm_file, stop_tag=None)
+    assert 0x7FE00010 in dcm_dataset
+
+
+def test_read_raw_dataset_defer_size(test_overlay_file):
+    dcm_dataset = read_raw_dataset(test_overlay_file, defer_size=1024)
+    # Test if the large binary elements are left deferred
+    assert dcm_dataset.get_item(0x60003000, keep_deferred=True).value is None
+    assert dcm_dataset.get_item(0x00291110, keep_deferred=True).value is None
+    assert dcm_dataset.get_item(0x00080018, keep_deferred=True).value is not None
+
+
+@pytest.mark.parametrize(
+    "dcm_file",
+    [
+        "MR_small_implicit.dcm",
+        "MR_small_bigendian.dcm",
+        "image_dfl.dcm",
+        "no_meta.dcm",
+        "MR_truncated.dcm",
+    ],
+)
+def test_read_raw_dataset_unsupported(dcm_file):
+    with pytest.raises(ValueError):
+        read_raw_dataset(get_testdata_file(dcm_file), stop_tag=None)
@@ -0,0 +1,85 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.dicom.serializer module."""
+
+import warnings
+
+import pytest
+from pydicom import config, dcmread
+
+from dicom2elk.core.dicom.serializer import get_json_key, to_json_dict, use_fast_conversion
+
+
+def read_dcm_file(dcm_file, **kwargs):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return dcmread(dcm_file, **kwargs)
+
+
+def test_get_json_key():
+    assert get_json_key(0x00100010) == "00100010"
+    assert get_json_key(0x7FE00010) == "7FE00010"
+
+
+def test_use_fast_conversion():
+    assert use_fast_conversion()
+    config.datetime_conversion = True
+    try:
+        assert not use_fast_conversion()
+    finally:
+        config.datetime_conversion = False
+
+
+@pytest.mark.parametrize("stop_before_pixels", [True, False])
+def test_to_json_dict_equivalence(test_corpus_files, stop_before_pixels):
+    # Test if the output is identical to the one of pydicom on its test files
+    n_compared = 0
+    for dcm_file in test_corpus_files:
+        try:
+            expected = read_dcm_file(
+                dcm_file, stop_before_pixels=stop_before_pixels
+            ).to_json_dict()
+        except Exception:
+            # Skip the invalid files that pydicom cannot convert either
+            continue
+        dcm_dataset = read_dcm_file(dcm_file, stop_before_pixels=stop_before_pixels)
+        json_dict = to_json_dict(dcm_dataset)
+        assert json_dict == expected, dcm_file
+        assert list(json_dict) == list(expected), dcm_file
+        n_compared += 1
+    assert n_compared > 0
+
+
+def test_to_json_dict_bulk_data_handler(test_overlay_file):
+    def bulk_data_element_handler(elem):
+        return f"bulk:{elem.tag:08X}"
+
+    expected = read_dcm_file(test_overlay_file).to_json_dict(
+        bulk_data_threshold=100, bulk_data_element_handler=bulk_data_element_handler
+    )
+    json_dict = to_json_dict(
+        read_dcm_file(test_overlay_file),
+        bulk_data_threshold=100,
+        bulk_data_element_handler=bulk_data_element_handler,
+    )
+    assert json_dict == expected
+    assert json_dict["60003000"] == {"vr": "OW", "BulkDataURI": "bulk:60003000"}
+
+
+def test_to_json_dict_fallback(test_dcm_files):
+    # Test if the conversion of pydicom is used when the fast conversion is disabled
+    dcm_dataset = read_dcm_file(test_dcm_files[0], stop_before_pixels=True)
+    expected = read_dcm_file(test_dcm_files[0], stop_before_pixels=True).to_json_dict()
+    assert to_json_dict(dcm_dataset, fast_conversion=False) == expected
@@ -0,0 +1,69 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.dicom.tags module."""
+
+import pytest
+
+from pydicom import dcmread
+
+from dicom2elk.core.dicom.tags import (
+    PRIVATE_TAGS,
+    TAG_PRESETS,
+    get_tag_selection,
+    parse_tag,
+    remove_excluded_tags,
+    resolve_tags,
+)
+
+
+def test_parse_tag():
+    # Test if keywords and all hexadecimal notations give the same tag
+    for tag in ["PatientID", "00100020", "0x00100020", "0010,0020", "(0010,0020)"]:
+        assert parse_tag(tag) == 0x00100020
+
+    # Test if an unknown keyword raises a ValueError
+    with pytest.raises(ValueError):
+        parse_tag("NotADicomKeyword")
+
+
+def test_resolve_tags():
+    # Test if presets are expanded and duplicates removed
+    tags = resolve_tags(["study", "StudyInstanceUID"])
+    assert len(tags) == len(TAG_PRESETS["study"])
+    assert tags == sorted(tags)
+
+    # Test if "private" is only allowed in excluded tags
+    with pytest.raises(ValueError):
+        resolve_tags([PRIVATE_TAGS])
+    assert resolve_tags([PRIVATE_TAGS], allow_private=True) == [PRIVATE_TAGS]
+
+
+def test_get_tag_selection():
+    # Test if all tags are extracted when no selection is given
+    assert get_tag_selection({}) == (None, [])
+
+    # Test if the required SOPInstanceUID tag is always included
+    include_tags, exclude_tags = get_tag_selection(
+        {"tags": {"include": ["PatientID"], "exclude": ["private"]}}
+    )
+    assert include_tags == [0x00080018, 0x00100020]
+    assert exclude_tags == [PRIVATE_TAGS]
+
+
+def test_remove_excluded_tags(test_dcm_files):
+    dcm_dataset = dcmread(test_dcm_files[0], stop_before_pixels=True)
+    remove_excluded_tags(dcm_dataset, resolve_tags(["patient"]))
+    assert "PatientID" not in dcm_dataset
+    assert "SOPInstanceUID" in dcm_dataset
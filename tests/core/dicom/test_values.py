@@ -0,0 +1,51 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.dicom.values module."""
+
+import datetime
+
+from dicom2elk.core.dicom.values import parse_date, parse_datetime, parse_time
+
+
+def test_parse_date():
+    assert parse_date("20040826") == datetime.date(2004, 8, 26)
+    assert parse_date("2004.08.26") == datetime.date(2004, 8, 26)
+    assert parse_date("20041326") is None
+    assert parse_date("") is None
+
+
+def test_parse_time():
+    assert parse_time("185059.5") == datetime.time(18, 50, 59, 500000)
+    assert parse_time("1850") == datetime.time(18, 50)
+    assert parse_time("18:50:59") == datetime.time(18, 50, 59)
+    assert parse_time("185") is None
+    assert parse_time("256000") is None
+
+
+def test_parse_datetime():
+    assert parse_datetime("2004") == datetime.datetime(2004, 1, 1)
+    assert parse_datetime("20040826185059.5") == datetime.datetime(
+        2004, 8, 26, 18, 50, 59, 500000
+    )
+    assert parse_datetime("200408261850-0130") == datetime.datetime(
+        2004,
+        8,
+        26,
+        18,
+        50,
+        tzinfo=datetime.timezone(-datetime.timedelta(hours=1, minutes=30)),
+    )
+    assert parse_datetime("20040826+01") is None
+    assert parse_datetime("200413") is None
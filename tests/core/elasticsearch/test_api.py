@@ -0,0 +1,347 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.elasticsearch.api module."""
+
+import asyncio
+import hashlib
+import json
+
+import pytest
+
+from dicom2elk.core.elasticsearch import api
+from dicom2elk.core.elasticsearch.api import (
+    get_document_hash,
+    get_document_id,
+    index_documents,
+    send_bulk_to_elasticsearch,
+    send_bulk_to_elasticsearch_async,
+)
+
+
+def make_document(sop_instance_uid, patient_name="Doe^John"):
+    return {
+        "00080018": {"vr": "UI", "Value": [sop_instance_uid]},
+        "00100010": {"vr": "PN", "Value": [{"Alphabetic": patient_name}]},
+        "filepath": f"/data/{sop_instance_uid}.dcm",
+    }
+
+
+def test_get_document_id():
+    assert get_document_id(make_document("1.2.3")) == "1.2.3"
+    # Test if a document without SOPInstanceUID is identified by its path
+    document = {"filepath": "/data/file.dcm"}
+    assert (
+        get_document_id(document)
+        == hashlib.sha1("/data/file.dcm".encode()).hexdigest()
+    )
+
+
+def test_get_document_id_scheme():
+    document = make_document("1.2.3")
+    copy = dict(document, filepath="/copy/1.2.3.dcm")
+    # Test if the copies of an instance are different documents with the file path
+    assert get_document_id(copy) == get_document_id(document)
+    document_id = get_document_id(document, "sop-instance-uid-filepath")
+    assert document_id == hashlib.sha1("1.2.3\0/data/1.2.3.dcm".encode()).hexdigest()
+    assert get_document_id(copy, "sop-instance-uid-filepath") != document_id
+    with pytest.raises(ValueError):
+        get_document_id(document, "uuid")
+
+
+def test_get_document_hash():
+    document = make_document("1.2.3")
+    # Test if the hash does not depend on the order of the keys
+    assert get_document_hash(document) == get_document_hash(
+        dict(reversed(list(document.items())))
+    )
+    assert get_document_hash(document) != get_document_hash(
+        make_document("1.2.3", "Doe^Jane")
+    )
+
+
+def test_send_bulk_to_elasticsearch_skip_unchanged(
+    tmpdir, es_config_file, fake_es_client, monkeypatch
+):
+    sent_ids = []
+
+    def send_bulk(documents, config, logger, document_format="dicom-json", **bulk_options):
+        sent_ids.extend(document_id for document_id, _, _ in documents)
+        return documents, [], {"es_documents_indexed": len(documents)}
+
+    monkeypatch.setattr(api, "_send_bulk_to_elasticsearch", send_bulk)
+    hash_db = str(tmpdir.join("cache.db"))
+    documents = [make_document(f"1.2.{i}") for i in range(3)]
+
+    stats = send_bulk_to_elasticsearch(documents, es_config_file, hash_db=hash_db)
+    assert sent_ids == ["1.2.0", "1.2.1", "1.2.2"]
+    assert stats == {
+        "es_documents_unchanged": 0,
+        "es_documents_indexed": 3,
+        "failed_files": [],
+    }
+
+    # Test if only the changed document is sent again
+    sent_ids.clear()
+    documents[1] = make_document("1.2.1", "Doe^Jane")
+    stats = send_bulk_to_elasticsearch(documents, es_config_file, hash_db=hash_db)
+    assert sent_ids == ["1.2.1"]
+    assert stats["es_documents_unchanged"] == 2
+
+    # Test if all documents are sent without cache
+    sent_ids.clear()
+    send_bulk_to_elasticsearch(documents, es_config_file)
+    assert len(sent_ids) == 3
+
+
+def test_send_bulk_to_elasticsearch_skip_unchanged_new_index(
+    tmpdir, es_config_file, fake_es_client, monkeypatch
+):
+    sent_ids = []
+
+    def send_bulk(documents, config, logger, document_format="dicom-json", **bulk_options):
+        sent_ids.extend(document_id for document_id, _, _ in documents)
+        return documents, [], {"es_documents_indexed": len(documents)}
+
+    monkeypatch.setattr(api, "_send_bulk_to_elasticsearch", send_bulk)
+    hash_db = str(tmpdir.join("cache.db"))
+    documents = [make_document(f"1.2.{i}") for i in range(3)]
+    send_bulk_to_elasticsearch(documents, es_config_file, hash_db=hash_db)
+
+    # Test if the documents are sent again to another index with the same cache
+    new_config_file = str(tmpdir.join("new_es_config.json"))
+    with open(es_config_file) as f:
+        config = json.load(f)
+    with open(new_config_file, "w") as f:
+        json.dump(dict(config, index="dicom-new"), f)
+    sent_ids.clear()
+    stats = send_bulk_to_elasticsearch(documents, new_config_file, hash_db=hash_db)
+    assert sent_ids == ["1.2.0", "1.2.1", "1.2.2"]
+    assert stats["es_documents_unchanged"] == 0
+
+    # Test if the documents are still unchanged for the first index
+    sent_ids.clear()
+    stats = send_bulk_to_elasticsearch(documents, es_config_file, hash_db=hash_db)
+    assert sent_ids == []
+    assert stats["es_documents_unchanged"] == 3
+
+
+def test_send_bulk_to_elasticsearch_flattened(monkeypatch):
+    sent_documents = []
+
+    def send_bulk(documents, config, logger, document_format="dicom-json", **bulk_options):
+        sent_documents.extend(documents)
+        return documents, [], {}
+
+    monkeypatch.setattr(api, "_send_bulk_to_elasticsearch", send_bulk)
+    send_bulk_to_elasticsearch(
+        [make_document("1.2.3")], "config.json", document_format="flattened"
+    )
+    # Test if the documents are identified by their SOPInstanceUID in the flattened format
+    assert sent_documents == [
+        (
+            "1.2.3",
+            None,
+            {
+                "SOPInstanceUID": "1.2.3",
+                "PatientName": "Doe^John",
+                "filepath": "/data/1.2.3.dcm",
+            },
+        )
+    ]
+
+
+def make_streaming_bulk(statuses, requests):
+    """Make a fake streaming bulk that returns the given statuses of each document id."""
+
+    def streaming_bulk(es, actions, **kwargs):
+        actions = list(actions)
+        requests.append(([action["_id"] for action in actions], kwargs))
+        for action in actions:
+            status = statuses[action["_id"]].pop(0)
+            item = {action["_op_type"]: {"_id": action["_id"], "status": status}}
+            if status >= 300:
+                item[action["_op_type"]]["error"] = {"type": "error"}
+            yield status < 300, item
+
+    return streaming_bulk
+
+
+def test_index_documents_retries(monkeypatch):
+    requests = []
+    statuses = {"1.2.0": [201], "1.2.1": [429, 503, 201], "1.2.2": [400]}
+    monkeypatch.setattr(
+        api.helpers, "streaming_bulk", make_streaming_bulk(statuses, requests)
+    )
+    documents = [(f"1.2.{i}", None, make_document(f"1.2.{i}")) for i in range(3)]
+
+    indexed_documents, failed_documents, stats = index_documents(
+        None, documents, "dicom", chunk_size=2, max_chunk_bytes=1024, initial_backoff=0
+    )
+    # Test if only the documents rejected with 429/503 are sent again
+    assert [ids for ids, _ in requests] == [["1.2.0", "1.2.1", "1.2.2"], ["1.2.1"], ["1.2.1"]]
+    assert requests[0][1]["chunk_size"] == 2
+    assert requests[0][1]["max_chunk_bytes"] == 1024
+    assert [document[0] for document in indexed_documents] == ["1.2.0", "1.2.1"]
+    assert [document[0] for document in failed_documents] == ["1.2.2"]
+    assert stats == {
+        "es_documents_indexed": 2,
+        "es_documents_retried": 2,
+        "es_documents_failed": 1,
+        "es_documents_existing": 0,
+    }
+
+
+def test_index_documents_max_retries(monkeypatch):
+    requests = []
+    statuses = {"1.2.0": [429, 429, 429]}
+    monkeypatch.setattr(
+        api.helpers, "streaming_bulk", make_streaming_bulk(statuses, requests)
+    )
+    documents = [("1.2.0", None, make_document("1.2.0"))]
+
+    indexed_documents, failed_documents, stats = index_documents(
+        None, documents, "dicom", max_retries=1, initial_backoff=0
+    )
+    # Test if a document still rejected after the last retry is failed
+    assert len(requests) == 2
+    assert indexed_documents == []
+    assert failed_documents == documents
+    assert stats == {
+        "es_documents_indexed": 0,
+        "es_documents_retried": 1,
+        "es_documents_failed": 1,
+        "es_documents_existing": 0,
+    }
+
+
+def test_send_bulk_to_elasticsearch_async_retries(monkeypatch):
+    requests = []
+    streaming_bulk = make_streaming_bulk({"1.2.0": [201], "1.2.1": [429, 201]}, requests)
+
+    async def async_streaming_bulk(es, actions, **kwargs):
+        for result in streaming_bulk(es, actions, **kwargs):
+            yield result
+
+    monkeypatch.setattr(api.helpers, "async_streaming_bulk", async_streaming_bulk)
+    stats = asyncio.run(
+        send_bulk_to_elasticsearch_async(
+            None,
+            [make_document("1.2.0"), make_document("1.2.1")],
+            "dicom",
+            initial_backoff=0,
+        )
+    )
+    assert [ids for ids, _ in requests] == [["1.2.0", "1.2.1"], ["1.2.1"]]
+    assert stats == {
+        "es_documents_unchanged": 0,
+        "es_documents_indexed": 2,
+        "es_documents_retried": 1,
+        "es_documents_failed": 0,
+        "es_documents_existing": 0,
+        "failed_files": [],
+    }
+
+
+def test_send_bulk_to_elasticsearch_async_skip_unchanged(tmpdir, monkeypatch):
+    requests = []
+    statuses = {"1.2.0": [201, 200], "1.2.1": [201], "1.2.2": [400]}
+    streaming_bulk = make_streaming_bulk(statuses, requests)
+
+    async def async_streaming_bulk(es, actions, **kwargs):
+        for result in streaming_bulk(es, actions, **kwargs):
+            yield result
+
+    monkeypatch.setattr(api.helpers, "async_streaming_bulk", async_streaming_bulk)
+    hash_db = str(tmpdir.join("cache.db"))
+    documents = [make_document(f"1.2.{i}") for i in range(3)]
+
+    stats = asyncio.run(
+        send_bulk_to_elasticsearch_async(None, documents, "dicom", hash_db=hash_db)
+    )
+    assert stats["es_documents_unchanged"] == 0
+    assert stats["failed_files"] == ["/data/1.2.2.dcm"]
+
+    # Test if only the changed document and the failed one are sent again
+    documents[0] = make_document("1.2.0", "Doe^Jane")
+    statuses["1.2.2"].append(201)
+    stats = asyncio.run(
+        send_bulk_to_elasticsearch_async(None, documents, "dicom", hash_db=hash_db)
+    )
+    assert requests[-1][0] == ["1.2.0", "1.2.2"]
+    assert stats["es_documents_unchanged"] == 1
+    assert stats["es_documents_indexed"] == 2
+
+    # Test if all the documents are sent to another index
+    for status in statuses.values():
+        status.append(201)
+    stats = asyncio.run(
+        send_bulk_to_elasticsearch_async(None, documents, "dicom-new", hash_db=hash_db)
+    )
+    assert requests[-1][0] == ["1.2.0", "1.2.1", "1.2.2"]
+    assert stats["es_documents_unchanged"] == 0
+
+
+def test_send_bulk_to_elasticsearch_shared_client(
+    es_config_file, fake_es_client, monkeypatch
+):
+    requests = []
+    statuses = {f"1.2.{i}": [201] for i in range(4)}
+    monkeypatch.setattr(
+        api.helpers, "streaming_bulk", make_streaming_bulk(statuses, requests)
+    )
+    for i in range(0, 4, 2):
+        stats = send_bulk_to_elasticsearch(
+            [make_document(f"1.2.{i}"), make_document(f"1.2.{i + 1}")], es_config_file
+        )
+        assert stats["es_documents_indexed"] == 2
+    # Test if the batches reuse the client and the index is checked once
+    assert len(requests) == 2
+    assert fake_es_client.calls == [("create", "dicom")]
+    assert not fake_es_client.closed
+
+
+def test_index_documents_op_type(monkeypatch):
+    requests = []
+    actions = []
+    statuses = {"1.2.0": [201], "1.2.1": [409]}
+    streaming_bulk = make_streaming_bulk(statuses, requests)
+
+    def record_actions(es, bulk_actions, **kwargs):
+        bulk_actions = list(bulk_actions)
+        actions.extend(bulk_actions)
+        return streaming_bulk(es, bulk_actions, **kwargs)
+
+    monkeypatch.setattr(api.helpers, "streaming_bulk", record_actions)
+    documents = [(f"1.2.{i}", None, make_document(f"1.2.{i}")) for i in range(2)]
+
+    # Test if the existing documents are skipped with the 'create' operation
+    indexed_documents, _, stats = index_documents(
+        None, documents, "dicom", op_type="create"
+    )
+    assert [action["_op_type"] for action in actions] == ["create", "create"]
+    assert [document[0] for document in indexed_documents] == ["1.2.0"]
+    assert stats["es_documents_existing"] == 1
+    assert stats["es_documents_failed"] == 0
+
+    # Test if the documents are upserted with the 'update' operation
+    actions.clear()
+    statuses.update({"1.2.0": [200], "1.2.1": [200]})
+    index_documents(None, documents, "dicom", op_type="update")
+    assert actions[0]["doc"] == documents[0][2]
+    assert actions[0]["doc_as_upsert"]
+    assert "_source" not in actions[0]
+
+    with pytest.raises(ValueError):
+        index_documents(None, documents, "dicom", op_type="delete")
@@ -0,0 +1,72 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.elasticsearch.client module."""
+
+from dicom2elk.core.elasticsearch import client
+from dicom2elk.core.elasticsearch.client import (
+    ES_CONNECTIONS_PER_NODE,
+    close_elasticsearch_clients,
+    ensure_index,
+    get_client_options,
+    get_elasticsearch_client,
+)
+
+
+def test_get_client_options():
+    config = {"url": "localhost", "port": 9200, "user": "u", "pwd": "p"}
+    options = get_client_options(config)
+    assert options["hosts"] == [{"host": "localhost", "port": 9200, "scheme": "https"}]
+    assert options["basic_auth"] == ("u", "p")
+    assert options["connections_per_node"] == ES_CONNECTIONS_PER_NODE
+    assert get_client_options(config, 32)["connections_per_node"] == 32
+
+
+def test_get_elasticsearch_client(es_config_file, fake_es_client, monkeypatch):
+    read_configs = []
+    get_config = client.get_config
+
+    def read_config(config_file):
+        read_configs.append(config_file)
+        return get_config(config_file)
+
+    monkeypatch.setattr(client, "get_config", read_config)
+
+    # Test if the config is read and the client is created once per process
+    es, config = get_elasticsearch_client(es_config_file)
+    assert es is fake_es_client
+    assert config["index"] == "dicom"
+    assert get_elasticsearch_client(es_config_file) == (es, config)
+    assert read_configs == [es_config_file]
+
+    # Test if the clients are closed and created again after
+    close_elasticsearch_clients()
+    assert fake_es_client.closed
+    get_elasticsearch_client(es_config_file)
+    assert len(read_configs) == 2
+
+
+def test_ensure_index(es_config_file, fake_es_client):
+    es, _ = get_elasticsearch_client(es_config_file)
+    # Test if the index is created once per client
+    ensure_index(es, "dicom")
+    ensure_index(es, "dicom")
+    assert fake_es_client.calls == [("create", "dicom")]
+
+    # Test if the index is checked again by a new client
+    close_elasticsearch_clients()
+    fake_es_client.indices.existing = False
+    es, _ = get_elasticsearch_client(es_config_file)
+    ensure_index(es, "dicom")
+    assert fake_es_client.calls == [("create", "dicom"), ("create", "dicom")]
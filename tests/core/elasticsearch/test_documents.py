@@ -0,0 +1,85 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.elasticsearch.documents module."""
+
+import pytest
+
+from dicom2elk.core.dicom.metadata import extract_metadata_from_dcm
+from dicom2elk.core.elasticsearch.documents import (
+    flatten_dicom_json,
+    get_document_source,
+    get_field_name,
+    get_index_mappings,
+)
+
+
+def test_get_field_name():
+    assert get_field_name("00100010") == "PatientName"
+    # Test if the tags without keyword are kept as is
+    assert get_field_name("00291010") == "00291010"
+    assert get_field_name("filepath") == "filepath"
+
+
+def test_flatten_dicom_json():
+    json_dict = {
+        "00080008": {"vr": "CS", "Value": ["ORIGINAL", "PRIMARY"]},
+        "00080020": {"vr": "DA", "Value": ["20040826"]},
+        "00080030": {"vr": "TM", "Value": ["185059.5"]},
+        "0008002A": {"vr": "DT", "Value": ["20040826185059.123456+0100"]},
+        "00100010": {"vr": "PN", "Value": [{"Alphabetic": "Doe^John"}]},
+        "00101010": {"vr": "AS"},
+        "00200013": {"vr": "IS", "Value": ["3"]},
+        "00280030": {"vr": "DS", "Value": [0.5, "1"]},
+        "00280011": {"vr": "US", "Value": [256]},
+        "7FE00010": {"vr": "OW", "InlineBinary": "AAAA"},
+        "00081140": {
+            "vr": "SQ",
+            "Value": [{"00081155": {"vr": "UI", "Value": ["1.2.3"]}}],
+        },
+        "00080021": {"vr": "DA", "Value": ["2004"]},
+        "00291010": {"vr": "OB", "InlineBinary": "AAAA"},
+        "00291020": {"vr": "LO", "Value": ["private"]},
+        "filepath": "/data/1.dcm",
+    }
+    assert flatten_dicom_json(json_dict) == {
+        "ImageType": ["ORIGINAL", "PRIMARY"],
+        "StudyDate": "2004-08-26",
+        "StudyTime": "18:50:59.500",
+        "AcquisitionDateTime": "2004-08-26T18:50:59.123+01:00",
+        "PatientName": "Doe^John",
+        "InstanceNumber": 3,
+        "PixelSpacing": [0.5, 1.0],
+        "Columns": 256,
+        "ReferencedImageSequence": {"ReferencedSOPInstanceUID": "1.2.3"},
+        "filepath": "/data/1.dcm",
+        # Test if the private tags are gathered in an object
+        "PrivateTags": {"00291020": "private"},
+    }
+
+
+def test_get_document_source(test_dcm_files):
+    json_dict = extract_metadata_from_dcm(test_dcm_files[0], mode="elasticsearch")
+    assert get_document_source(json_dict) is json_dict
+    document = get_document_source(json_dict, "flattened")
+    assert document["SOPInstanceUID"] == json_dict["00080018"]["Value"][0]
+    # Test if the flattened document only contains keywords and plain values
+    assert not any(isinstance(value, dict) and "vr" in value for value in document.values())
+    with pytest.raises(ValueError):
+        get_document_source(json_dict, "xml")
+
+
+def test_get_index_mappings():
+    assert get_index_mappings("dicom-json") is None
+    assert "dynamic_date_formats" in get_index_mappings("flattened")
@@ -0,0 +1,142 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.elasticsearch.index module."""
+
+import pytest
+
+from dicom2elk.core.dicom.tags import resolve_tags
+from dicom2elk.core.elasticsearch import index
+from dicom2elk.core.elasticsearch.index import (
+    BULK_LOAD_META_KEY,
+    BULK_LOAD_SETTINGS,
+    bulk_load_index,
+    get_template_mappings,
+    resolve_index,
+)
+
+
+def test_get_template_mappings():
+    tags = resolve_tags(["StudyDate", "SeriesNumber", "PatientName", "PixelData"])
+    mappings = get_template_mappings(tags)
+    properties = mappings["properties"]
+    assert properties["00080020"]["properties"]["Value"]["type"] == "date"
+    assert properties["00200011"]["properties"]["Value"]["type"] == "long"
+    assert "Alphabetic" in properties["00100010"]["properties"]["Value"]["properties"]
+    # Test if the binary values are not mapped explicitly
+    assert "7FE00010" not in properties
+    # Test if the fields of the private tags are not mapped
+    private_tags_template = mappings["dynamic_templates"][0]["private_tags"]
+    assert private_tags_template["mapping"]["dynamic"] is False
+
+    mappings = get_template_mappings(tags, "flattened")
+    properties = mappings["properties"]
+    assert properties["StudyDate"] == {"type": "date", "format": "strict_date"}
+    assert properties["PatientName"]["type"] == "text"
+    assert mappings["dynamic_templates"][0]["private_tags"]["match"] == "PrivateTags"
+    # Test if the tags of all presets are mapped by default
+    assert "StudyInstanceUID" in get_template_mappings(None, "flattened")["properties"]
+
+
+def test_bulk_load_index(es_config_file, fake_es_client):
+    with bulk_load_index(es_config_file):
+        assert fake_es_client.indices.settings == {
+            "number_of_replicas": 0,
+            "refresh_interval": "-1",
+        }
+    assert [call[0] for call in fake_es_client.calls] == [
+        "put_index_template",
+        "create",
+        "put_mapping",
+        "put_settings",
+        "put_settings",
+        "put_mapping",
+        "refresh",
+    ]
+    # Test if the original settings are saved in the index before they are changed
+    assert fake_es_client.calls[2][1][BULK_LOAD_META_KEY]["original_settings"] == {
+        "refresh_interval": None,
+        "number_of_replicas": "1",
+    }
+    # Test if the original settings are restored (the unset ones are reset)
+    assert fake_es_client.calls[4][1] == {
+        "refresh_interval": None,
+        "number_of_replicas": "1",
+    }
+    assert fake_es_client.indices.settings == {"number_of_replicas": "1"}
+    assert fake_es_client.indices.meta == {}
+    # Test if the shared client is left open for the uploads
+    assert not fake_es_client.closed
+
+
+def test_bulk_load_index_failure(es_config_file, fake_es_client):
+    # Test if the settings are restored even if the run fails
+    with pytest.raises(RuntimeError):
+        with bulk_load_index(es_config_file, index_template=False):
+            raise RuntimeError("Upload failed")
+    assert fake_es_client.indices.settings == {"number_of_replicas": "1"}
+    assert fake_es_client.calls[-1] == ("refresh", "dicom")
+
+    # Test if the index is not changed when both steps are disabled
+    fake_es_client.calls.clear()
+    with bulk_load_index(es_config_file, index_template=False, bulk_load_settings=False):
+        pass
+    assert fake_es_client.calls == []
+    assert set(BULK_LOAD_SETTINGS) == {"refresh_interval", "number_of_replicas"}
+
+
+def test_bulk_load_index_killed_run(es_config_file, fake_es_client, monkeypatch):
+    # A run killed during the load leaves the bulk load settings and the saved settings
+    with bulk_load_index(es_config_file, index_template=False):
+        monkeypatch.setattr(index, "restore_index_settings", lambda *args: None)
+    monkeypatch.undo()
+    runs = fake_es_client.indices.meta[BULK_LOAD_META_KEY]["runs"]
+    for run in runs.values():
+        run["pid"] = -1
+
+    # Test if the next run restores the saved settings instead of the bulk load ones
+    with bulk_load_index(es_config_file, index_template=False):
+        assert len(fake_es_client.indices.meta[BULK_LOAD_META_KEY]["runs"]) == 1
+    assert fake_es_client.indices.settings == {"number_of_replicas": "1"}
+    assert fake_es_client.indices.meta == {}
+
+
+def test_bulk_load_index_bulk_load_values(es_config_file, fake_es_client):
+    # Test if the values of the bulk load settings are not taken as original settings
+    fake_es_client.indices.settings = {"number_of_replicas": "0", "refresh_interval": "-1"}
+    with bulk_load_index(es_config_file, index_template=False):
+        pass
+    assert fake_es_client.indices.settings == {}
+
+
+def test_bulk_load_index_concurrent_runs(es_config_file, fake_es_client):
+    # Test if the settings are only restored by the last run
+    with bulk_load_index(es_config_file, index_template=False):
+        with bulk_load_index(es_config_file, index_template=False):
+            pass
+        assert fake_es_client.indices.settings["refresh_interval"] == "-1"
+        assert len(fake_es_client.indices.meta[BULK_LOAD_META_KEY]["runs"]) == 1
+    assert fake_es_client.indices.settings == {"number_of_replicas": "1"}
+
+
+def test_resolve_index(fake_es_client):
+    indices = fake_es_client.indices
+    assert resolve_index(fake_es_client, "dicom") == "dicom"
+    indices.aliases = {"dicom": {"dicom-1": False}}
+    assert resolve_index(fake_es_client, "dicom") == "dicom-1"
+    indices.aliases = {"dicom": {"dicom-1": False, "dicom-2": True}}
+    assert resolve_index(fake_es_client, "dicom") == "dicom-2"
+    indices.aliases = {"dicom": {"dicom-1": False, "dicom-2": False}}
+    with pytest.raises(ValueError):
+        resolve_index(fake_es_client, "dicom")
@@ -0,0 +1,156 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.aio module."""
+
+import asyncio
+
+import pytest
+
+from dicom2elk.core import aio
+from dicom2elk.core.aio import AsyncEngine, extract_metadata_from_dcm_list_async
+from dicom2elk.core.dicom.metadata import (
+    extract_metadata_from_dcm,
+    extract_metadata_from_dcm_worker,
+    get_worker_options,
+)
+from dicom2elk.core.process import close_worker_pool, create_worker_pool
+
+
+def parse_function(dcm_file):
+    return (
+        dcm_file,
+        *extract_metadata_from_dcm(dcm_file, mode="elasticsearch", return_stats=True),
+    )
+
+
+def test_extract_metadata_from_dcm_list_async_threads(test_dcm_files):
+    results = asyncio.run(
+        extract_metadata_from_dcm_list_async(
+            test_dcm_files, parse_function, io_threads=2
+        )
+    )
+    assert len(results) == len(test_dcm_files)
+    for dcm_file, json_dict, stats in results:
+        assert json_dict["filepath"] == dcm_file
+        assert json_dict["00080018"]["Value"][0].startswith("1.3.6.1.4.1.5962")
+        assert stats["bulk_data_bytes_skipped"] == 0
+
+
+def test_extract_metadata_from_dcm_list_async_pool(test_dcm_files):
+    pool = create_worker_pool(
+        2, worker_options=get_worker_options(mode="elasticsearch")
+    )
+    try:
+        results = asyncio.run(
+            extract_metadata_from_dcm_list_async(
+                test_dcm_files + ["/missing/file.dcm"],
+                extract_metadata_from_dcm_worker,
+                pool=pool,
+                io_threads=2,
+            )
+        )
+    finally:
+        close_worker_pool(pool)
+    assert len(results) == len(test_dcm_files) + 1
+    # The missing file is reported as skipped
+    assert sum(json_dict is None for _, json_dict, _ in results) == 1
+
+
+def test_extract_metadata_from_dcm_list_async_upload(
+    test_dcm_files, monkeypatch, es_config_file, fake_es_client
+):
+    uploaded_chunks = []
+
+    class AsyncClient:
+        closed = False
+
+        async def close(self):
+            self.closed = True
+
+    clients = []
+
+    def create_client(config):
+        clients.append(AsyncClient())
+        return clients[-1]
+
+    async def send_bulk(
+        es, dcm_tags_list, index, logger, document_format="dicom-json", **bulk_options
+    ):
+        uploaded_chunks.append((es, index, len(dcm_tags_list), bulk_options))
+        return {"es_documents_indexed": len(dcm_tags_list)}
+
+    monkeypatch.setattr(aio, "create_async_elasticsearch_client", create_client)
+    monkeypatch.setattr(aio, "send_bulk_to_elasticsearch_async", send_bulk)
+
+    stats = {}
+    with AsyncEngine(io_threads=2, config=es_config_file) as engine:
+        # Test if the lists of a run share the event loop and the client
+        for _ in range(2):
+            engine.run(
+                extract_metadata_from_dcm_list_async(
+                    test_dcm_files,
+                    parse_function,
+                    es=engine.es,
+                    index=engine.index,
+                    target=engine.target,
+                    bulk_chunk_size=3,
+                    bulk_options={"max_retries": 2},
+                    stats=stats,
+                )
+            )
+        assert not clients[0].closed
+    assert len(clients) == 1
+    assert all(es is clients[0] for es, _, _, _ in uploaded_chunks)
+    # Test if the index is checked once
+    assert fake_es_client.calls == [("create", "dicom")]
+    # Test if the documents are uploaded in chunks of at most 3 documents
+    assert sum(n for _, _, n, _ in uploaded_chunks) == 2 * len(test_dcm_files)
+    assert all(index == "dicom" and n <= 3 for _, index, n, _ in uploaded_chunks)
+    assert engine.target == "localhost:9200/dicom"
+    assert all(
+        options == {"hash_target": engine.target, "max_retries": 2}
+        for _, _, _, options in uploaded_chunks
+    )
+    # Test if the counters of the uploads are summed
+    assert stats == {"es_documents_indexed": 2 * len(test_dcm_files)}
+    # Test if the client and the event loop are closed with the engine
+    assert clients[0].closed
+    assert engine.loop.is_closed()
+
+
+def test_extract_metadata_from_dcm_list_async_upload_error(test_dcm_files, monkeypatch):
+    cancelled = []
+
+    async def send_bulk(
+        es, dcm_tags_list, index, logger, document_format="dicom-json", **bulk_options
+    ):
+        if not cancelled:
+            cancelled.append(False)
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled[0] = True
+                raise
+        raise ConnectionError("Connection refused")
+
+    monkeypatch.setattr(aio, "send_bulk_to_elasticsearch_async", send_bulk)
+    # Test if the other uploads are cancelled once an upload fails
+    with pytest.raises(ConnectionError):
+        asyncio.run(
+            extract_metadata_from_dcm_list_async(
+                test_dcm_files, parse_function, es=object(), index="dicom", bulk_chunk_size=1
+            )
+        )
+    assert cancelled == [True]
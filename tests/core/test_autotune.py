@@ -0,0 +1,107 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.autotune module."""
+
+
+import pytest
+
+from dicom2elk.core.autotune import AutoTuner, get_memory_usage
+from dicom2elk.core.process import process_batches
+
+
+def _simulate(tuner, throughput, memory=None, n_batches=30):
+    # Update the tuner with the throughput of each configuration
+    for _ in range(n_batches):
+        config = (tuner.n_threads, tuner.batch_size)
+        tuner.update(1000, 1000 / throughput(*config), memory and memory(*config))
+
+
+def test_auto_tuner_converges():
+    # Throughput that increases with the workers up to 4 and with the batch size
+    def throughput(n_threads, batch_size):
+        return min(n_threads, 4) * (1 + min(batch_size, 400) / 100)
+
+    tuner = AutoTuner(max_n_threads=16, max_batch_size=10000, start_batch_size=100)
+    assert (tuner.n_threads, tuner.batch_size) == (1, 100)
+    _simulate(tuner, throughput)
+    # Test if the tuner converges on the smallest configuration with the best throughput
+    assert tuner.converged
+    assert tuner.n_threads == 4
+    assert tuner.batch_size == 400
+
+
+def test_auto_tuner_limits():
+    def throughput(n_threads, batch_size):
+        return n_threads * batch_size
+
+    # Test if the configuration does not exceed the limits given by the user
+    tuner = AutoTuner(max_n_threads=3, max_batch_size=250, start_batch_size=100)
+    _simulate(tuner, throughput)
+    assert (tuner.n_threads, tuner.batch_size) == (3, 250)
+
+    # Test if the memory limit lowers the limit of the parameter that exceeded it
+    tuner = AutoTuner(
+        max_n_threads=16, max_batch_size=10000, max_memory=1000, start_batch_size=100
+    )
+    _simulate(tuner, throughput, memory=lambda n_threads, batch_size: n_threads * 100)
+    assert tuner.n_threads == 8
+    assert tuner.batch_size == 10000
+
+
+def test_auto_tuner_hysteresis():
+    # Test if a gain below the hysteresis margin does not change the configuration
+    def throughput(n_threads, batch_size):
+        return 100 * (1 + 0.05 * n_threads)
+
+    tuner = AutoTuner(max_n_threads=16, max_batch_size=100, start_batch_size=100)
+    _simulate(tuner, throughput)
+    assert tuner.converged
+    assert tuner.n_threads == 1
+
+
+def test_iter_batches():
+    tuner = AutoTuner(max_n_threads=1, max_batch_size=10, start_batch_size=2)
+    batches = tuner.iter_batches(iter(range(7)))
+    assert next(batches) == [0, 1]
+    # Test if the size of the next batches follows the batch size of the tuner
+    tuner.config["batch_size"] = 4
+    assert list(batches) == [[2, 3, 4, 5], [6]]
+
+
+def test_get_memory_usage():
+    assert get_memory_usage() > 0
+
+
+def test_process_batches_auto_tune(test_dcm_files, io_path, make_args):
+    args = make_args(
+        **{
+            "n_threads": 2,
+            "process_handler": "multiprocessing",
+            "batch_size": 4,
+            "sleep_time_ms": 0,
+            "output_dir": str(io_path),
+            "mode": "json",
+        }
+    )
+    tuner = AutoTuner(args.n_threads, args.batch_size, start_batch_size=1)
+    # Test if the batches and the pool follow the configuration of the tuner
+    nb_dcm_processed, nb_dcm_skipped = process_batches(
+        tuner.iter_batches(test_dcm_files), args=args, tuner=tuner
+    )
+    assert nb_dcm_processed == len(test_dcm_files)
+    assert tuner.best_config is not None
+    # Test if a shared pool cannot be auto-tuned
+    with pytest.raises(ValueError):
+        process_batches([test_dcm_files], args=args, pool=object(), tuner=tuner)
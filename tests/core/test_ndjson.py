@@ -0,0 +1,83 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.ndjson module."""
+
+import gzip
+import json
+import os
+
+import pytest
+
+from dicom2elk.core.ndjson import NDJSONShardWriter
+
+
+def _read_shard(shard_file):
+    if shard_file.endswith(".gz"):
+        with gzip.open(shard_file, "rt") as f:
+            return [json.loads(line) for line in f]
+    if shard_file.endswith(".zst"):
+        import zstandard
+
+        with open(shard_file, "rb") as f:
+            content = zstandard.ZstdDecompressor().stream_reader(f).read().decode()
+        return [json.loads(line) for line in content.splitlines()]
+    with open(shard_file, "r") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_ndjson_shard_writer(tmpdir):
+    output_dir = str(tmpdir.mkdir("output"))
+    documents = [{"00080018": {"vr": "UI", "Value": [f"1.2.{i}"]}} for i in range(5)]
+    writer = NDJSONShardWriter(output_dir, "list", max_shard_documents=2)
+    # Test if the shards are rolled over once they contain 2 documents
+    assert writer.write(documents) == {"ndjson_shards": 2}
+    assert writer.get_n_published_documents() == 4
+    # Test if the open shard is hidden until it is closed
+    assert len(os.listdir(output_dir)) == 3
+    assert sum(name.startswith(".") for name in os.listdir(output_dir)) == 1
+    assert writer.close() == {"ndjson_shards": 1}
+    assert writer.close() == {"ndjson_shards": 0}
+    assert writer.get_n_published_documents() == 5
+    assert sorted(os.listdir(output_dir)) == sorted(
+        os.path.basename(shard_file) for shard_file in writer.shard_files
+    )
+    # Test if the documents are written as compact lines
+    assert [
+        document for shard in writer.shard_files for document in _read_shard(shard)
+    ] == documents
+    with open(writer.shard_files[0]) as f:
+        assert " " not in f.read()
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_ndjson_shard_writer_compression(tmpdir, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    output_dir = str(tmpdir.mkdir("output"))
+    documents = [{"filepath": f"/data/{i}.dcm"} for i in range(100)]
+    with NDJSONShardWriter(
+        output_dir, "list", compression=compression, max_shard_bytes=1000
+    ) as writer:
+        writer.write(documents)
+    # Test if the shards are limited by their size before compression
+    assert len(writer.shard_files) > 1
+    assert [
+        document for shard in writer.shard_files for document in _read_shard(shard)
+    ] == documents
+
+
+def test_ndjson_shard_writer_invalid_compression(tmpdir):
+    with pytest.raises(ValueError):
+        NDJSONShardWriter(str(tmpdir), "list", compression="bz2")
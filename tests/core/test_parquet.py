@@ -0,0 +1,109 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.parquet module."""
+
+import datetime
+import os
+
+import pytest
+
+from dicom2elk.core.dicom.tags import resolve_tags
+from dicom2elk.core.parquet import (
+    ParquetBatchWriter,
+    flatten_document,
+    get_parquet_columns,
+)
+
+
+def _get_document(i):
+    return {
+        "00080008": {"vr": "CS", "Value": ["ORIGINAL", "PRIMARY"]},
+        "00080018": {"vr": "UI", "Value": [f"1.2.{i}"]},
+        "00080020": {"vr": "DA", "Value": ["20040826"]},
+        "00080030": {"vr": "TM", "Value": ["185059.5"]},
+        "00100010": {"vr": "PN", "Value": [{"Alphabetic": "Doe^John"}]},
+        "00200013": {"vr": "IS", "Value": [i]},
+        "filepath": f"/data/{i}.dcm",
+    }
+
+
+def test_get_parquet_columns():
+    columns = get_parquet_columns(
+        resolve_tags(["StudyDate", "ImageType", "PixelData", "ReferencedImageSequence"])
+    )
+    # Test if the sequences and binary values are not exported
+    assert columns == [
+        ("00080008", "ImageType", "string", True),
+        ("00080020", "StudyDate", "date", False),
+    ]
+    # Test if the tags of all presets are exported by default
+    assert ("00200011", "SeriesNumber", "int", False) in get_parquet_columns()
+
+
+def test_flatten_document():
+    columns = get_parquet_columns(
+        resolve_tags(
+            [
+                "ImageType",
+                "SOPInstanceUID",
+                "StudyDate",
+                "StudyTime",
+                "PatientName",
+                "InstanceNumber",
+                "PatientWeight",
+            ]
+        )
+    )
+    row = flatten_document(_get_document(3), columns)
+    assert row == {
+        "ImageType": ["ORIGINAL", "PRIMARY"],
+        "SOPInstanceUID": "1.2.3",
+        "StudyDate": datetime.date(2004, 8, 26),
+        "StudyTime": datetime.time(18, 50, 59, 500000),
+        "PatientName": "Doe^John",
+        "InstanceNumber": 3,
+        "PatientWeight": None,
+        "filepath": "/data/3.dcm",
+    }
+    # Test if the invalid values are replaced by None
+    row = flatten_document(
+        {"00080020": {"vr": "DA", "Value": ["2004"]}, "00080030": {"vr": "TM"}}, columns
+    )
+    assert row["StudyDate"] is None and row["StudyTime"] is None
+
+
+def test_parquet_batch_writer(tmpdir):
+    pq = pytest.importorskip("pyarrow.parquet")
+    output_dir = str(tmpdir.mkdir("output"))
+    tags = resolve_tags(["SOPInstanceUID", "StudyDate", "InstanceNumber"])
+    with ParquetBatchWriter(output_dir, "list", tags=tags) as writer:
+        writer.write([_get_document(i) for i in range(3)])
+        assert writer.write_row_group() == {"parquet_row_groups": 1}
+        assert writer.write_row_group() == {"parquet_row_groups": 0}
+        writer.write([_get_document(i) for i in range(3, 5)])
+        # Test if the file is hidden until it is closed
+        assert all(name.startswith(".") for name in os.listdir(output_dir))
+    assert os.listdir(output_dir) == [os.path.basename(writer.parquet_file)]
+    # Test if each batch is written as a row group
+    parquet_file = pq.ParquetFile(writer.parquet_file)
+    assert parquet_file.num_row_groups == 2
+    table = parquet_file.read(columns=["InstanceNumber", "StudyDate"])
+    assert table.column("InstanceNumber").to_pylist() == list(range(5))
+    assert str(table.schema.field("StudyDate").type) == "date32[day]"
+
+
+def test_parquet_batch_writer_invalid_compression(tmpdir):
+    with pytest.raises(ValueError):
+        ParquetBatchWriter(str(tmpdir), "list", compression="bz2")
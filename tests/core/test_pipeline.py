@@ -0,0 +1,174 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.core.pipeline module."""
+
+import time
+
+import pytest
+
+from dicom2elk.core.pipeline import SinkPipeline
+
+
+def test_sink_pipeline():
+    chunks = []
+    with SinkPipeline(chunks.append, n_workers=2, chunk_size=3) as sink:
+        for i in range(10):
+            sink.put(i)
+    # Test if all documents are saved in chunks of at most 3 documents
+    assert sorted(doc for chunk in chunks for doc in chunk) == list(range(10))
+    assert all(len(chunk) <= 3 for chunk in chunks)
+    assert sink.stats["sink_documents"] == 10
+
+
+def test_sink_pipeline_stats():
+    # Test if the counters returned by the sink function are summed
+    with SinkPipeline(lambda chunk: {"skipped": len(chunk) - 1}, chunk_size=2) as sink:
+        for i in range(4):
+            sink.put(i)
+    assert sink.stats["skipped"] == 2
+
+
+def test_sink_pipeline_failed_files():
+    def sink_function(chunk):
+        return {"saved": len(chunk) - 1, "failed_files": chunk[:1]}
+
+    # Test if the failed files returned by the sink function are collected
+    with SinkPipeline(sink_function, chunk_size=2) as sink:
+        for i in range(4):
+            sink.put(i)
+    assert sink.failed_files == {0, 2}
+    assert sink.stats["saved"] == 2
+    assert "failed_files" not in sink.stats
+
+
+def test_sink_pipeline_backpressure():
+    def slow_sink(chunk):
+        time.sleep(0.05)
+
+    sink = SinkPipeline(slow_sink, queue_size=1, chunk_size=1)
+    for i in range(5):
+        sink.put(i)
+    sink.close()
+    # Test if the producer waited for the sink thread when the queue was full
+    assert sink.stats["sink_wait_time"] > 0
+    assert sink.stats["sink_busy_time"] >= 0.2
+    # Closing twice does nothing
+    sink.close()
+
+
+def test_sink_pipeline_error():
+    def failing_sink(chunk):
+        raise ConnectionError("Connection refused")
+
+    sink = SinkPipeline(failing_sink, chunk_size=1)
+    sink.put(0)
+    # Test if the error of the sink thread is raised in the producer
+    with pytest.raises(RuntimeError):
+        sink.close()
+    assert sink.stats["sink_documents"] == 0
+
+
+def test_sink_pipeline_flush():
+    chunks = []
+    sink = SinkPipeline(chunks.append, chunk_size=10)
+    sink.put(0)
+    # Test if the partial chunk is queued and counted once it is saved
+    n_chunks = sink.flush()
+    assert n_chunks == 1
+    assert sink.flush() == 1
+    sink.close()
+    assert sink.n_completed_chunks == n_chunks
+    assert chunks == [[0]]
+
+
+def test_sink_pipeline_flush_function():
+    events = []
+    sink = SinkPipeline(
+        lambda chunk: events.append(list(chunk)),
+        chunk_size=2,
+        flush_function=lambda: events.append("flush") or {"flushes": 1},
+    )
+    for i in range(3):
+        sink.put(i)
+    # Test if the flush function is called after the chunk queued by flush
+    n_chunks = sink.flush()
+    sink.close()
+    assert n_chunks == 2
+    assert events == [[0, 1], [2], "flush", "flush"]
+    assert sink.stats["flushes"] == 2
+    # Test if a flush function requires a single sink thread
+    with pytest.raises(ValueError):
+        SinkPipeline(print, n_workers=2, flush_function=print)
+
+
+def test_sink_pipeline_published_function():
+    published = []
+    saved = []
+
+    def save(chunk):
+        saved.extend(chunk)
+        # Publish the documents by groups of 3
+        while len(saved) - len(published) >= 3:
+            published.extend(saved[len(published) : len(published) + 3])
+
+    sink = SinkPipeline(
+        save,
+        chunk_size=2,
+        close_function=lambda: published.extend(saved[len(published) :]),
+        published_function=lambda: len(published),
+    )
+    for i in range(3):
+        sink.put(i)
+    assert sink.flush() == 2
+    sink.put(3)
+    n_chunks = sink.flush()
+    assert n_chunks == 3
+    # Wait for the chunks to be saved and counted
+    while sink.stats["sink_documents"] < 4:
+        time.sleep(0.01)
+    with sink._lock:
+        pass
+    # Test if only the chunks whose documents are all published are completed
+    assert sink.n_completed_chunks == 2
+    sink.close()
+    assert sink.n_completed_chunks == n_chunks
+    # Test if a published function requires a single sink thread
+    with pytest.raises(ValueError):
+        SinkPipeline(print, n_workers=2, published_function=print)
+
+
+def test_sink_pipeline_close_function():
+    events = []
+    sink = SinkPipeline(
+        lambda chunk: events.append(list(chunk)),
+        close_function=lambda: events.append("close") or {"closes": 1},
+    )
+    sink.put(0)
+    sink.close()
+    # Test if the close function is called once after the last chunk
+    sink.close()
+    assert events == [[0], "close"]
+    assert sink.stats["closes"] == 1
+
+    # Test if the close function is not called after a failure
+    def fail(chunk):
+        raise OSError("disk full")
+
+    events = []
+    sink = SinkPipeline(fail, close_function=lambda: events.append("close"))
+    sink.put(0)
+    with pytest.raises(RuntimeError):
+        sink.close()
+    assert events == []
@@ -14,16 +14,31 @@
 
 """Tests for dicom2elk.core.process module."""
 
-from argparse import Namespace
+import json
 import os
+import shutil
 import sys
+import time
 
-from dicom2elk.core.process import process_batches
+import pytest
+
+from dicom2elk.core import aio, process
+from dicom2elk.core.process import (
+    RunContext,
+    close_worker_pool,
+    create_worker_pool,
+    get_cache_target,
+    get_worker_options_from_args,
+    process_batches,
+)
+from dicom2elk.utils.journal import read_journal
 from dicom2elk.utils.logging import create_logger
+from dicom2elk.utils.manifest import read_manifest
+from dicom2elk.utils.misc import prepare_file_list_batches
 
 
-def test_process_batches(test_dcm_files, io_path):
-    args = Namespace(
+def test_process_batches(test_dcm_files, io_path, make_args):
+    args = make_args(
         **{
             "n_threads": 2,
             "process_handler": "asyncio",
@@ -47,9 +62,568 @@ def test_process_batches(test_dcm_files, io_path):
     # Test if process_batches returns a list of dictionaries
     # if the number of threads is set to 2 and the method is set to asyncio
     nb_dcm_processed, nb_dcm_skipped = process_batches(
-        test_dcm_files_batches, args=args, kwargs=kwargs,
+        test_dcm_files_batches,
+        args=args,
+        worker_options=get_worker_options_from_args(args, kwargs=kwargs),
     )
 
     assert isinstance(nb_dcm_processed, int)
     assert isinstance(nb_dcm_skipped, int)
     assert nb_dcm_processed == len(test_dcm_files)
+
+
+def test_create_worker_pool():
+    assert create_worker_pool(1) is None
+    pool = create_worker_pool(2, max_tasks_per_child=1)
+    assert pool is not None
+    close_worker_pool(pool)
+    # Closing a missing pool does nothing
+    close_worker_pool(None)
+
+
+def test_process_batches_shared_pool(test_dcm_files, io_path, make_args):
+    args = make_args(
+        **{
+            "n_threads": 2,
+            "process_handler": "multiprocessing",
+            "batch_size": 2,
+            "sleep_time_ms": 0,
+            "output_dir": str(io_path),
+            "mode": "json",
+        }
+    )
+    test_dcm_files_batches = [
+        test_dcm_files[i : i + args.batch_size]
+        for i in range(0, len(test_dcm_files), args.batch_size)
+    ]
+
+    worker_options = get_worker_options_from_args(args)
+    pool = create_worker_pool(
+        args.n_threads, max_tasks_per_child=2, worker_options=worker_options
+    )
+    try:
+        # Test if the same pool can be reused by several runs
+        for _ in range(2):
+            nb_dcm_processed, nb_dcm_skipped = process_batches(
+                test_dcm_files_batches,
+                args=args,
+                worker_options=worker_options,
+                pool=pool,
+            )
+            assert nb_dcm_processed == len(test_dcm_files)
+            assert nb_dcm_skipped == 0
+    finally:
+        close_worker_pool(pool)
+
+
+def test_process_batches_throttle(test_dcm_files, io_path, make_args):
+    args = make_args(
+        **{
+            "n_threads": 2,
+            "process_handler": "multiprocessing",
+            "batch_size": 2,
+            "sleep_time_ms": 0,
+            "output_dir": str(io_path),
+            "mode": "json",
+            "max_files_per_sec": 4,
+            "throttle_schedule": "00:00-24:00=0.5",
+        }
+    )
+    test_dcm_files_batches = [
+        test_dcm_files[i : i + args.batch_size]
+        for i in range(0, len(test_dcm_files), args.batch_size)
+    ]
+
+    # Test if the throttle shared by the workers limits the files read per second
+    # (2 files/sec. with the schedule, after a burst of 4 files)
+    tic = time.perf_counter()
+    nb_dcm_processed, nb_dcm_skipped = process_batches(test_dcm_files_batches, args=args)
+    elapsed = time.perf_counter() - tic
+    assert nb_dcm_processed + nb_dcm_skipped == len(test_dcm_files)
+    assert elapsed >= (len(test_dcm_files) - 4) / 2 - 0.1
+
+
+def test_process_batches_pool_options_mismatch(test_dcm_files, io_path, make_args):
+    args = make_args(
+        **{
+            "n_threads": 2,
+            "process_handler": "multiprocessing",
+            "batch_size": 2,
+            "sleep_time_ms": 0,
+            "output_dir": str(io_path),
+            "mode": "json",
+        }
+    )
+    # Test if a pool created for other options is rejected
+    pool = create_worker_pool(args.n_threads)
+    try:
+        with pytest.raises(ValueError):
+            process_batches(
+                [test_dcm_files[:2]],
+                args=args,
+                worker_options=get_worker_options_from_args(args),
+                pool=pool,
+            )
+    finally:
+        close_worker_pool(pool)
+
+
+def test_run_context_setup_failure(tmpdir, monkeypatch, make_args):
+    args = make_args(n_threads=2, output_dir=str(tmpdir), mode="json")
+    closed = []
+    monkeypatch.setattr(process, "close_worker_pool", closed.append)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("sink")
+
+    monkeypatch.setattr(process, "create_sink_pipeline", fail)
+    # Test if the resources set up before a failure are released
+    with pytest.raises(RuntimeError):
+        RunContext(args, journal_file=str(tmpdir.join("journal.log")))
+    assert len(closed) == 1 and closed[0] is not None
+    closed[0].close()
+    closed[0].join()
+
+
+def test_process_batches_elasticsearch_sink(
+    test_dcm_files, monkeypatch, es_config_file, fake_es_client, make_args
+):
+    uploaded_chunks = []
+
+    def send_bulk(
+        dcm_tags_list,
+        config,
+        logger,
+        hash_db=None,
+        throttle=None,
+        document_format="dicom-json",
+        **bulk_options,
+    ):
+        # The refresh of the index is disabled during the upload
+        assert fake_es_client.indices.settings["refresh_interval"] == "-1"
+        assert bulk_options == {
+            "chunk_size": 100,
+            "max_chunk_bytes": 1024**2,
+            "max_retries": 5,
+            "op_type": "create",
+            "id_scheme": "sop-instance-uid",
+        }
+        uploaded_chunks.append(dcm_tags_list)
+        return {"es_documents_indexed": len(dcm_tags_list)}
+
+    monkeypatch.setattr(process, "send_bulk_to_elasticsearch", send_bulk)
+    args = make_args(
+        **{
+            "n_threads": 1,
+            "process_handler": "multiprocessing",
+            "batch_size": 2,
+            "sleep_time_ms": 0,
+            "output_dir": None,
+            "mode": "elasticsearch",
+            "config": es_config_file,
+            "bulk_chunk_size": 100,
+            "bulk_max_size": 1,
+            "es_op_type": "create",
+        }
+    )
+    test_dcm_files_batches = [
+        test_dcm_files[i : i + args.batch_size]
+        for i in range(0, len(test_dcm_files), args.batch_size)
+    ]
+    stats = {}
+    nb_dcm_processed, nb_dcm_skipped = process_batches(
+        test_dcm_files_batches, args=args, stats=stats
+    )
+    # Test if the documents of all batches are uploaded by the sink stage
+    assert nb_dcm_processed == len(test_dcm_files)
+    assert sum(len(chunk) for chunk in uploaded_chunks) == len(test_dcm_files)
+    assert stats["sink_documents"] == len(test_dcm_files)
+    assert stats["es_documents_indexed"] == len(test_dcm_files)
+    assert stats["extraction_time"] > 0
+    # Test if the settings of the index are restored once the documents are uploaded
+    assert fake_es_client.indices.settings == {"number_of_replicas": "1"}
+    assert fake_es_client.calls[-1] == ("refresh", "dicom")
+    assert fake_es_client.closed
+
+
+def test_process_batches_asyncio_elasticsearch(
+    test_dcm_files, tmpdir, monkeypatch, es_config_file, fake_es_client, make_args
+):
+    class AsyncClient:
+        closed = False
+
+        async def close(self):
+            self.closed = True
+
+    clients, uploaded_clients, hash_dbs = [], [], []
+
+    def create_client(config):
+        clients.append(AsyncClient())
+        return clients[-1]
+
+    async def send_bulk(
+        es, dcm_tags_list, index, logger, document_format="dicom-json", **bulk_options
+    ):
+        uploaded_clients.append(es)
+        hash_dbs.append(bulk_options["hash_db"])
+        return {"es_documents_indexed": len(dcm_tags_list)}
+
+    monkeypatch.setattr(aio, "create_async_elasticsearch_client", create_client)
+    monkeypatch.setattr(aio, "send_bulk_to_elasticsearch_async", send_bulk)
+    args = make_args(
+        **{
+            "n_threads": 1,
+            "process_handler": "asyncio",
+            "batch_size": 2,
+            "sleep_time_ms": 0,
+            "output_dir": None,
+            "mode": "elasticsearch",
+            "config": es_config_file,
+            "keep_index_settings": True,
+            "skip_unchanged": True,
+            "cache_db": str(tmpdir.join("cache.db")),
+        }
+    )
+    stats = {}
+    nb_dcm_processed, _ = process_batches(
+        prepare_file_list_batches(test_dcm_files, args.batch_size),
+        args=args,
+        stats=stats,
+    )
+    assert nb_dcm_processed == len(test_dcm_files)
+    assert stats["es_documents_indexed"] == len(test_dcm_files)
+    # Test if all batches are uploaded with the same client, closed at the end of the run
+    assert len(clients) == 1
+    assert all(es is clients[0] for es in uploaded_clients)
+    assert clients[0].closed
+    # Test if the index is checked once
+    assert fake_es_client.calls.count(("create", "dicom")) == 1
+    # Test if the unchanged documents are skipped by the uploads
+    assert set(hash_dbs) == {args.cache_db}
+
+
+def test_process_batches_manifest(test_dcm_files, tmpdir, make_args):
+    output_dir = str(tmpdir.mkdir("output"))
+    manifest_file = os.path.join(output_dir, "list.manifest.tsv")
+    args = make_args(
+        **{
+            "n_threads": 1,
+            "process_handler": "multiprocessing",
+            "batch_size": 3,
+            "sleep_time_ms": 0,
+            "output_dir": output_dir,
+            "mode": "json",
+            "json_layout": "hashed",
+        }
+    )
+    test_dcm_files_batches = prepare_file_list_batches(test_dcm_files, args.batch_size)
+    process_batches(test_dcm_files_batches, args=args, manifest_file=manifest_file)
+    # Test if the manifest maps the SOPInstanceUID to the path of its JSON file
+    json_files = read_manifest(manifest_file, output_dir)
+    assert len(json_files) == 1
+    for sop_instance_uid, json_file in json_files.items():
+        assert os.path.basename(json_file) == sop_instance_uid + ".json"
+        assert os.path.exists(json_file)
+    with open(manifest_file) as f:
+        assert len(f.readlines()) == len(test_dcm_files)
+
+
+def test_process_batches_ndjson(test_dcm_files, tmpdir, make_args):
+    output_dir = str(tmpdir.mkdir("output"))
+    args = make_args(
+        **{
+            "n_threads": 1,
+            "process_handler": "multiprocessing",
+            "batch_size": 3,
+            "sleep_time_ms": 0,
+            "output_dir": output_dir,
+            "mode": "ndjson",
+            "input_dcm_list": "list.txt",
+            "ndjson_compression": "gzip",
+        }
+    )
+    test_dcm_files_batches = prepare_file_list_batches(test_dcm_files, args.batch_size)
+    journal_file = str(tmpdir.join("list.journal"))
+    stats = {}
+    nb_dcm_processed, _ = process_batches(
+        test_dcm_files_batches, args=args, stats=stats, journal_file=journal_file
+    )
+    assert nb_dcm_processed == len(test_dcm_files)
+    # Test if the batches are recorded once the shard of their documents is closed
+    assert read_journal(journal_file, args.batch_size) == {
+        i: len(batch) for i, batch in enumerate(test_dcm_files_batches)
+    }
+    # Test if the shard is kept open across the batches and closed at the end of the run
+    shard_files = sorted(os.listdir(output_dir))
+    assert len(shard_files) == 1
+    assert stats["ndjson_shards"] == 1
+    assert all(
+        name.startswith("list-") and name.endswith(".ndjson.gz") for name in shard_files
+    )
+
+
+def test_process_batches_parquet(test_dcm_files, tmpdir, make_args):
+    pq = pytest.importorskip("pyarrow.parquet")
+    output_dir = str(tmpdir.mkdir("output"))
+    args = make_args(
+        **{
+            "n_threads": 1,
+            "process_handler": "multiprocessing",
+            "batch_size": 3,
+            "sleep_time_ms": 0,
+            "output_dir": output_dir,
+            "mode": "parquet",
+            "input_dcm_list": "list.txt",
+        }
+    )
+    test_dcm_files_batches = prepare_file_list_batches(test_dcm_files, args.batch_size)
+    stats = {}
+    nb_dcm_processed, _ = process_batches(test_dcm_files_batches, args=args, stats=stats)
+    assert nb_dcm_processed == len(test_dcm_files)
+    # Test if a single file is written with a row group per batch
+    (parquet_file,) = os.listdir(output_dir)
+    assert parquet_file.startswith("list-") and parquet_file.endswith(".parquet")
+    parquet_file = pq.ParquetFile(os.path.join(output_dir, parquet_file))
+    assert parquet_file.num_row_groups == len(test_dcm_files_batches)
+    assert stats["parquet_row_groups"] == len(test_dcm_files_batches)
+    assert parquet_file.metadata.num_rows == len(test_dcm_files)
+
+
+def test_process_batches_iterable(test_dcm_files, io_path, make_args):
+    args = make_args(
+        **{
+            "n_threads": 1,
+            "process_handler": "multiprocessing",
+            "batch_size": 3,
+            "sleep_time_ms": 0,
+            "output_dir": str(io_path),
+            "mode": "json",
+        }
+    )
+    # Test if the batches can be given by a generator
+    test_dcm_files_batches = prepare_file_list_batches(
+        iter(test_dcm_files), args.batch_size, lazy=True
+    )
+    nb_dcm_processed, nb_dcm_skipped = process_batches(
+        test_dcm_files_batches, args=args
+    )
+    assert nb_dcm_processed == len(test_dcm_files)
+    assert nb_dcm_skipped == 0
+
+
+def test_process_batches_resume(test_dcm_files, tmpdir, make_args):
+    output_dir = str(tmpdir.mkdir("output"))
+    journal_file = os.path.join(output_dir, "list.journal")
+    args = make_args(
+        **{
+            "n_threads": 1,
+            "process_handler": "multiprocessing",
+            "batch_size": 3,
+            "sleep_time_ms": 0,
+            "output_dir": output_dir,
+            "mode": "json",
+            "resume": False,
+        }
+    )
+    test_dcm_files_batches = prepare_file_list_batches(test_dcm_files, args.batch_size)
+
+    # Process the first batch only, as if the run was interrupted
+    process_batches(test_dcm_files_batches[:1], args=args, journal_file=journal_file)
+
+    # Test if the resumed run skips the batch recorded in the journal
+    args.resume = True
+    stats = {}
+    nb_dcm_processed, nb_dcm_skipped = process_batches(
+        test_dcm_files_batches, args=args, stats=stats, journal_file=journal_file
+    )
+    assert stats["resumed_files"] == args.batch_size
+    assert nb_dcm_processed == len(test_dcm_files) - args.batch_size
+    assert nb_dcm_skipped == 0
+
+    # Test if all batches are recorded once the run is completed
+    stats = {}
+    nb_dcm_processed, _ = process_batches(
+        test_dcm_files_batches, args=args, stats=stats, journal_file=journal_file
+    )
+    assert nb_dcm_processed == 0
+    assert stats["resumed_files"] == len(test_dcm_files)
+
+
+def test_process_batches_journal_sink(
+    test_dcm_files, tmpdir, monkeypatch, es_config_file, fake_es_client, make_args
+):
+    def send_bulk(
+        dcm_tags_list,
+        config,
+        logger,
+        hash_db=None,
+        throttle=None,
+        document_format="dicom-json",
+        **bulk_options,
+    ):
+        raise ConnectionError("Connection refused")
+
+    monkeypatch.setattr(process, "send_bulk_to_elasticsearch", send_bulk)
+    journal_file = str(tmpdir.join("list.journal"))
+    args = make_args(
+        **{
+            "n_threads": 1,
+            "process_handler": "multiprocessing",
+            "batch_size": 3,
+            "sleep_time_ms": 0,
+            "output_dir": None,
+            "mode": "elasticsearch",
+            "config": es_config_file,
+            "no_index_template": True,
+            "keep_index_settings": True,
+        }
+    )
+    # Test if the batches whose upload failed are not recorded in the journal
+    with pytest.raises(RuntimeError):
+        process_batches(
+            prepare_file_list_batches(test_dcm_files, args.batch_size),
+            args=args,
+            journal_file=journal_file,
+        )
+    assert read_journal(journal_file, args.batch_size) == {}
+
+
+def test_process_batches_journal_failed_files(
+    test_dcm_files, tmpdir, monkeypatch, es_config_file, fake_es_client, make_args
+):
+    failed_file = test_dcm_files[0]
+
+    def send_bulk(
+        dcm_tags_list,
+        config,
+        logger,
+        hash_db=None,
+        throttle=None,
+        document_format="dicom-json",
+        **bulk_options,
+    ):
+        dcm_files = [dcm_tags["filepath"] for dcm_tags in dcm_tags_list]
+        return {
+            "es_documents_indexed": len(dcm_files) - dcm_files.count(failed_file),
+            "failed_files": [failed_file] if failed_file in dcm_files else [],
+        }
+
+    monkeypatch.setattr(process, "send_bulk_to_elasticsearch", send_bulk)
+    journal_file = str(tmpdir.join("list.journal"))
+    cache_file = str(tmpdir.join("cache.db"))
+    args = make_args(
+        **{
+            "n_threads": 1,
+            "process_handler": "multiprocessing",
+            "batch_size": 3,
+            "sleep_time_ms": 0,
+            "output_dir": None,
+            "mode": "elasticsearch",
+            "config": es_config_file,
+            "no_index_template": True,
+            "keep_index_settings": True,
+        }
+    )
+    dcm_files_batches = prepare_file_list_batches(test_dcm_files, args.batch_size)
+    process_batches(
+        dcm_files_batches, args=args, journal_file=journal_file, cache_file=cache_file
+    )
+    # Test if the batch with a document that could not be indexed is not recorded
+    journal = read_journal(journal_file, args.batch_size)
+    assert 0 not in journal
+    assert len(journal) == len(dcm_files_batches) - 1
+
+    # Test if only the file that could not be indexed is processed again
+    stats = {}
+    process_batches(dcm_files_batches, args=args, stats=stats, cache_file=cache_file)
+    assert stats["cache_misses"] == 1
+    assert stats["cache_hits"] == len(test_dcm_files) - 1
+
+
+def test_process_batches_incremental(test_dcm_files, tmpdir, make_args):
+    output_dir = str(tmpdir.mkdir("output"))
+    cache_file = os.path.join(output_dir, "cache.db")
+    # Copy the files to be able to modify them
+    dcm_files = []
+    for i, test_dcm_file in enumerate(test_dcm_files):
+        dcm_file = os.path.join(str(tmpdir), f"{i}.dcm")
+        shutil.copyfile(test_dcm_file, dcm_file)
+        dcm_files.append(dcm_file)
+    args = make_args(
+        **{
+            "n_threads": 1,
+            "process_handler": "multiprocessing",
+            "batch_size": 3,
+            "sleep_time_ms": 0,
+            "output_dir": output_dir,
+            "mode": "json",
+        }
+    )
+    dcm_files_batches = prepare_file_list_batches(dcm_files, args.batch_size)
+
+    stats = {}
+    nb_dcm_processed, _ = process_batches(
+        dcm_files_batches, args=args, stats=stats, cache_file=cache_file
+    )
+    assert nb_dcm_processed == len(dcm_files)
+    assert stats["cache_misses"] == len(dcm_files)
+    assert stats["cache_hits"] == 0
+
+    # Test if only the modified file is processed again
+    os.utime(dcm_files[1], ns=(0, 0))
+    stats = {}
+    nb_dcm_processed, _ = process_batches(
+        dcm_files_batches, args=args, stats=stats, cache_file=cache_file
+    )
+    assert nb_dcm_processed == 1
+    assert stats["cache_misses"] == 1
+    assert stats["cache_hits"] == len(dcm_files) - 1
+
+    # Test if the files are processed again to another mode and output directory
+    # with the same cache
+    args.mode = "ndjson"
+    args.output_dir = str(tmpdir.mkdir("ndjson"))
+    stats = {}
+    nb_dcm_processed, _ = process_batches(
+        dcm_files_batches, args=args, stats=stats, cache_file=cache_file
+    )
+    assert nb_dcm_processed == len(dcm_files)
+    assert stats["cache_hits"] == 0
+
+
+def test_get_cache_target(es_config_file, tmpdir, make_args):
+    args = make_args(mode="json", output_dir=str(tmpdir), config=es_config_file)
+    assert get_cache_target(args) == f"json:{tmpdir}"
+    args.mode = "elasticsearch"
+    assert get_cache_target(args) == "elasticsearch:localhost:9200/dicom"
+
+
+def test_process_batches_error_file(test_dcm_files, tmpdir, make_args):
+    output_dir = str(tmpdir.mkdir("output"))
+    error_file = os.path.join(output_dir, "list.errors.ndjson")
+    args = make_args(
+        **{
+            "n_threads": 2,
+            "process_handler": "multiprocessing",
+            "batch_size": 3,
+            "sleep_time_ms": 0,
+            "output_dir": output_dir,
+            "mode": "json",
+        }
+    )
+    missing_files = ["/missing/1.dcm", "/missing/2.dcm"]
+    stats = {}
+    nb_dcm_processed, nb_dcm_skipped = process_batches(
+        prepare_file_list_batches(test_dcm_files + missing_files, args.batch_size),
+        args=args,
+        stats=stats,
+        error_file=error_file,
+    )
+    assert nb_dcm_processed == len(test_dcm_files)
+    assert nb_dcm_skipped == stats["errors"] == len(missing_files)
+
+    # Test if the errors are recorded by the parent process
+    with open(error_file) as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(record["path"] for record in records) == missing_files
+    assert all(record["exception"] == "FileNotFoundError" for record in records)
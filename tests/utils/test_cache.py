@@ -0,0 +1,149 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.utils.cache module."""
+
+import os
+import sqlite3 as sq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dicom2elk.utils.cache import (
+    LOOKUP_SIZE,
+    create_document_hash_table,
+    connect_cache,
+    create_fingerprint_table,
+    get_cached_signatures,
+    get_document_hashes,
+    get_file_signature,
+    get_file_signatures,
+    update_document_hashes,
+    update_fingerprints,
+)
+
+
+def test_get_file_signature(test_dcm_files):
+    size, mtime_ns = get_file_signature(test_dcm_files[0])
+    assert size == os.path.getsize(test_dcm_files[0])
+    assert mtime_ns == os.stat(test_dcm_files[0]).st_mtime_ns
+    # Test if a missing file has no signature
+    assert get_file_signature("/missing/file.dcm") is None
+
+
+def test_get_file_signatures(test_dcm_files):
+    file_paths = test_dcm_files + ["/missing/file.dcm"]
+    signatures = {file_path: get_file_signature(file_path) for file_path in file_paths}
+    assert get_file_signatures(file_paths) == signatures
+    # Test if the signatures are the same when they are got by threads
+    with ThreadPoolExecutor(4) as executor:
+        assert get_file_signatures(file_paths, executor) == signatures
+
+
+def test_fingerprints(tmpdir):
+    db_connection = sq.connect(str(tmpdir.join("cache.db")))
+    create_fingerprint_table(db_connection)
+    # Test if the table can be created again
+    create_fingerprint_table(db_connection)
+
+    # Store more fingerprints than the number of paths looked up at once
+    fingerprints = [
+        (f"/data/{i}.dcm", i, 1000 + i, f"1.2.3.{i}") for i in range(LOOKUP_SIZE + 10)
+    ]
+    update_fingerprints(db_connection, "json:/output", fingerprints)
+    file_paths = [fingerprint[0] for fingerprint in fingerprints] + ["/data/new.dcm"]
+    signatures = get_cached_signatures(db_connection, "json:/output", file_paths)
+    assert len(signatures) == len(fingerprints)
+    assert signatures["/data/3.dcm"] == (3, 1003)
+
+    # Test if the fingerprint of a file is replaced
+    update_fingerprints(db_connection, "json:/output", [("/data/3.dcm", 5, 2000, "1.2.3.3")])
+    assert get_cached_signatures(db_connection, "json:/output", ["/data/3.dcm"]) == {
+        "/data/3.dcm": (5, 2000)
+    }
+    # Test if the fingerprints of another destination are not returned
+    assert get_cached_signatures(db_connection, "ndjson:/output", file_paths) == {}
+    db_connection.close()
+
+
+def test_fingerprints_outdated_table(tmpdir):
+    db_connection = sq.connect(str(tmpdir.join("cache.db")))
+    db_connection.execute("CREATE TABLE dicom_fingerprints (path TEXT PRIMARY KEY);")
+    # Test if the table without destination is replaced
+    create_fingerprint_table(db_connection)
+    update_fingerprints(db_connection, "json:/output", [("/data/1.dcm", 1, 1000, "1.2.3")])
+    assert get_cached_signatures(db_connection, "json:/output", ["/data/1.dcm"]) == {
+        "/data/1.dcm": (1, 1000)
+    }
+    db_connection.close()
+
+
+def test_connect_cache_threads(tmpdir):
+    cache_db = str(tmpdir.join("cache.db"))
+    db_connection = connect_cache(cache_db)
+    assert db_connection.execute("PRAGMA journal_mode;").fetchone() == ("wal",)
+    create_fingerprint_table(db_connection)
+    create_document_hash_table(db_connection)
+
+    errors = []
+
+    def update_document_hashes_in_thread(i):
+        thread_connection = connect_cache(cache_db)
+        try:
+            for j in range(20):
+                update_document_hashes(thread_connection, "dicom", [(f"{i}.{j}", "abc")])
+        except sq.OperationalError as e:
+            errors.append(e)
+        finally:
+            thread_connection.close()
+
+    # Test if the writes of the threads and of the main thread do not fail
+    # with "database is locked"
+    threads = [
+        threading.Thread(target=update_document_hashes_in_thread, args=(i,))
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for j in range(20):
+        update_fingerprints(db_connection, "json:/output", [(f"/data/{j}.dcm", 1, j, "1")])
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert db_connection.execute("SELECT COUNT(*) FROM document_hashes;").fetchone() == (80,)
+    db_connection.close()
+
+
+def test_document_hashes(tmpdir):
+    db_connection = sq.connect(str(tmpdir.join("cache.db")))
+    create_document_hash_table(db_connection)
+    update_document_hashes(
+        db_connection, "localhost:9200/dicom", [("1.2.3", "abc"), ("1.2.4", "def")]
+    )
+    assert get_document_hashes(
+        db_connection, "localhost:9200/dicom", ["1.2.3", "1.2.5"]
+    ) == {"1.2.3": "abc"}
+    # Test if the hashes of another index are not returned
+    assert get_document_hashes(db_connection, "localhost:9200/other", ["1.2.3"]) == {}
+    db_connection.close()
+
+
+def test_document_hashes_outdated_table(tmpdir):
+    db_connection = sq.connect(str(tmpdir.join("cache.db")))
+    db_connection.execute("CREATE TABLE document_hashes (id TEXT PRIMARY KEY, hash TEXT);")
+    db_connection.execute("INSERT INTO document_hashes VALUES ('1.2.3', 'abc');")
+    # Test if the table without index is replaced
+    create_document_hash_table(db_connection)
+    assert get_document_hashes(db_connection, "localhost:9200/dicom", ["1.2.3"]) == {}
+    update_document_hashes(db_connection, "localhost:9200/dicom", [("1.2.3", "abc")])
+    db_connection.close()
@@ -0,0 +1,63 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.utils.errors module."""
+
+import json
+import os
+
+from dicom2elk.utils.errors import append_error_records, get_error_file, get_error_record
+from dicom2elk.utils.io import count_lines, read_dcm_list_file
+
+
+def test_get_error_record():
+    record = get_error_record("/data/1.dcm", FileNotFoundError("No such file"), 0.5)
+    assert record == {
+        "path": "/data/1.dcm",
+        "exception": "FileNotFoundError",
+        "message": "No such file",
+        "elapsed": 0.5,
+    }
+
+
+def test_get_error_file():
+    error_file = get_error_file("/output", "/input/list.txt")
+    assert error_file == os.path.join("/output", "list.errors.ndjson")
+    # Test if the errors of a retry do not overwrite the retried error file
+    assert get_error_file("/output", error_file) == os.path.join(
+        "/output", "list.retry.errors.ndjson"
+    )
+
+
+def test_append_error_records(tmpdir):
+    error_file = str(tmpdir.join("list.errors.ndjson"))
+    records = [
+        get_error_record(f"/data/{i}.dcm", ValueError("Invalid"), 0.1) for i in range(3)
+    ]
+    append_error_records(error_file, records[:2])
+    append_error_records(error_file, records[2:])
+    append_error_records(error_file, [])
+    with open(error_file) as f:
+        assert [json.loads(line) for line in f] == records
+
+    # Test if the error file can be used as input list to retry the files
+    dcm_list = [f"/data/{i}.dcm" for i in range(3)]
+    assert read_dcm_list_file(error_file) == dcm_list
+    assert list(read_dcm_list_file(error_file, lazy=True)) == dcm_list
+    assert count_lines(error_file) == 3
+
+    # Test if the blank lines and the invalid records are skipped
+    with open(error_file, "a") as f:
+        f.write('\n  \n{"message": "No path"}\n["/data/3.dcm"]\n{"path": "/data/4.d')
+    assert read_dcm_list_file(error_file) == dcm_list
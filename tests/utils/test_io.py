@@ -17,7 +17,15 @@
 import json
 import os
 
-from dicom2elk.utils.io import read_dcm_list_file, write_json_file, write_json_files
+import pytest
+
+from dicom2elk.utils.io import (
+    count_lines,
+    get_json_file,
+    read_dcm_list_file,
+    write_json_file,
+    write_json_files,
+)
 
 
 def test_write_json_files(tmpdir):
@@ -76,6 +84,34 @@ def test_write_json_file(tmpdir):
         assert json.loads(content) == {"name": "John Doe", "age": 30}
 
 
+def test_write_json_file_subdirectory(tmpdir):
+    output_dir = str(tmpdir.mkdir("output"))
+
+    # Test if the missing parent directories of the JSON file are created
+    json_file = os.path.join(output_dir, "ab", "cd", "sample.json")
+    assert write_json_file(json_file, {"age": 30}) == json_file
+    assert os.path.exists(json_file)
+
+
+def test_get_json_file():
+    assert get_json_file("/output", "1.2.3") == os.path.join("/output", "1.2.3.json")
+    # Test if the hashed layout uses two levels of 2-character directories
+    json_file = get_json_file("/output", "1.2.3", layout="hashed")
+    prefix, second, first = os.path.dirname(json_file).rsplit(os.sep, 2)
+    assert prefix == "/output"
+    assert len(first) == 2 and len(second) == 2
+    assert json_file == get_json_file("/output", "1.2.3", layout="hashed")
+    assert get_json_file(
+        "/output", "1.2.3", "hierarchy", study_instance_uid="1.2", series_instance_uid="1.2.4"
+    ) == os.path.join("/output", "1.2", "1.2.4", "1.2.3.json")
+    # Test if the instances without Study/Series UID are grouped
+    assert get_json_file("/output", "1.2.3", "hierarchy") == os.path.join(
+        "/output", "unknown", "unknown", "1.2.3.json"
+    )
+    with pytest.raises(ValueError):
+        get_json_file("/output", "1.2.3", layout="unknown")
+
+
 def test_read_dcm_list_file(test_dcm_files, tmpdir):
     # Write a list of DICOM files
     dcm_list_file = os.path.join(str(tmpdir.mkdir("output")), "dcm_list.txt")
@@ -87,4 +123,18 @@ def test_read_dcm_list_file(test_dcm_files, tmpdir):
     assert isinstance(read_dcm_list_file(dcm_list_file), list)
 
     # Test if read_dcm_list_file returns the correct list
-    assert read_dcm_list_file(dcm_list_file) == test_dcm_files
\ No newline at end of file
+    assert read_dcm_list_file(dcm_list_file) == test_dcm_files
+
+    # Test if the lazy mode yields the same paths
+    dcm_list = read_dcm_list_file(dcm_list_file, lazy=True)
+    assert not isinstance(dcm_list, list)
+    assert list(dcm_list) == test_dcm_files
+
+
+def test_count_lines(tmpdir):
+    text_file = str(tmpdir.join("lines.txt"))
+    for content, n_lines in [("", 0), ("a\nb\n", 2), ("a\nb", 2), ("a\n\nb\n", 3)]:
+        with open(text_file, "w") as f:
+            f.write(content)
+        assert count_lines(text_file) == n_lines
+        assert count_lines(text_file) == len(content.splitlines())
\ No newline at end of file
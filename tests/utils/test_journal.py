@@ -0,0 +1,81 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.utils.journal module."""
+
+import os
+
+from dicom2elk.utils.journal import (
+    JournalWriter,
+    get_journal_file,
+    read_journal,
+    truncate_partial_line,
+)
+
+
+def test_get_journal_file():
+    assert get_journal_file("/output", "/input/list_001.txt") == os.path.join(
+        "/output", "list_001.journal"
+    )
+
+
+def test_journal(tmpdir):
+    journal_file = str(tmpdir.join("list.journal"))
+    # Test if a missing journal has no completed batches
+    assert read_journal(journal_file, 10) == {}
+
+    with JournalWriter(journal_file, 10) as journal:
+        journal.record(0, 10)
+        journal.record(2, 10)
+    with JournalWriter(journal_file, 10, append=True) as journal:
+        journal.record(3, 4)
+    assert read_journal(journal_file, 10) == {0: 10, 2: 10, 3: 4}
+
+    # Test if the batches recorded with another batch size are ignored
+    assert read_journal(journal_file, 20) == {}
+
+    # Test if a partially written line is ignored
+    with open(journal_file, "a") as f:
+        f.write("4\t10")
+    assert read_journal(journal_file, 10) == {0: 10, 2: 10, 3: 4}
+
+    # Test if a garbled line is ignored without ignoring the next ones
+    with open(journal_file) as f:
+        content = f.read()
+    with open(journal_file, "w") as f:
+        f.write("1\t10\tx\n" + content)
+    assert read_journal(journal_file, 10) == {0: 10, 2: 10, 3: 4}
+    with open(journal_file, "w") as f:
+        f.write(content)
+
+    # Test if a partially written line is removed before a resumed run appends,
+    # so that it is not merged with the next line (e.g. "3" + "4\t10\t10")
+    with open(journal_file, "a") as f:
+        f.write("\n3")
+    assert truncate_partial_line(journal_file) == 1
+    with open(journal_file, "a") as f:
+        f.write("3")
+    with JournalWriter(journal_file, 10, append=True) as journal:
+        journal.record(4, 10)
+    assert read_journal(journal_file, 10) == {0: 10, 2: 10, 3: 4, 4: 10}
+    # Test if a journal without any complete line is emptied
+    with open(journal_file, "w") as f:
+        f.write("3")
+    assert truncate_partial_line(journal_file) == 1
+    assert os.path.getsize(journal_file) == 0
+
+    # Test if the journal is truncated when the run is not resumed
+    with JournalWriter(journal_file, 10) as journal:
+        journal.record(1, 10)
+    assert read_journal(journal_file, 10) == {1: 10}
@@ -14,9 +14,17 @@
 
 """Tests for dicom2elk.utils.logging module."""
 
+import logging
+import multiprocessing
 import os
 
-from dicom2elk.utils.logging import create_logger
+from dicom2elk.utils.logging import (
+    create_logger,
+    init_worker_logging,
+    remove_file_handler,
+    start_log_listener,
+    stop_log_listener,
+)
 
 
 def test_create_logger(tmpdir):
@@ -30,4 +38,45 @@ def test_create_logger(tmpdir):
     assert logger is not None
 
     # Test if the log file exists
-    assert os.path.exists(os.path.join(output_dir, "dicom2elk.log"))
\ No newline at end of file
+    assert os.path.exists(os.path.join(output_dir, "dicom2elk.log"))
+
+
+def test_create_logger_same_file(tmpdir):
+    output_dir = str(tmpdir.mkdir("output"))
+    logger = create_logger("INFO", output_dir, "list.log")
+    n_handlers = len(logger.handlers)
+    # Test if the same log file is not opened twice
+    logger = create_logger("INFO", output_dir, "list.log")
+    assert len(logger.handlers) == n_handlers
+
+    # Test if the handler of the log file is removed
+    remove_file_handler(logger, os.path.join(output_dir, "list.log"))
+    assert len(logger.handlers) == n_handlers - 1
+
+
+def _log_from_worker(log_queue):
+    init_worker_logging(log_queue, logging.INFO)
+    logging.getLogger().info("Message from worker")
+    logging.getLogger().debug("Debug message from worker")
+
+
+def test_log_listener():
+    records = []
+
+    class ListHandler(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+
+    logger = logging.getLogger()
+    handler = ListHandler()
+    logger.addHandler(handler)
+    try:
+        log_queue, listener = start_log_listener()
+        worker = multiprocessing.Process(target=_log_from_worker, args=(log_queue,))
+        worker.start()
+        worker.join()
+        stop_log_listener(listener)
+    finally:
+        logger.removeHandler(handler)
+    # Test if the records of the worker are handled by the main process
+    assert [record.getMessage() for record in records] == ["Message from worker"]
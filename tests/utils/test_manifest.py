@@ -0,0 +1,56 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.utils.manifest module."""
+
+import os
+
+from dicom2elk.utils.manifest import (
+    append_manifest_entries,
+    get_manifest_file,
+    read_manifest,
+)
+
+
+def test_get_manifest_file():
+    assert get_manifest_file("/output", "/lists/dcm_list.txt") == os.path.join(
+        "/output", "dcm_list.manifest.tsv"
+    )
+
+
+def test_manifest(tmpdir):
+    output_dir = str(tmpdir.mkdir("output"))
+    manifest_file = get_manifest_file(output_dir, "dcm_list.txt")
+    json_files = [
+        os.path.join(output_dir, "ab", "cd", "1.2.3.json"),
+        os.path.join(output_dir, "ef", "01", "1.2.4.json"),
+    ]
+    append_manifest_entries(manifest_file, output_dir, json_files[:1])
+    append_manifest_entries(manifest_file, output_dir, json_files[1:])
+    # Nothing is written for an empty batch
+    append_manifest_entries(manifest_file, output_dir, [])
+    # Test if the paths are relative to the output directory
+    assert read_manifest(manifest_file) == {
+        "1.2.3": os.path.join("ab", "cd", "1.2.3.json"),
+        "1.2.4": os.path.join("ef", "01", "1.2.4.json"),
+    }
+    assert read_manifest(manifest_file, output_dir) == {
+        "1.2.3": json_files[0],
+        "1.2.4": json_files[1],
+    }
+
+    # Test if a partially written line is ignored
+    with open(manifest_file, "a") as f:
+        f.write("1.2.5\tab")
+    assert len(read_manifest(manifest_file)) == 2
@@ -14,7 +14,12 @@
 
 """Tests for dicom2elk.utils.misc module."""
 
-from dicom2elk.utils.misc import prepare_file_list_batches
+from dicom2elk.utils.misc import (
+    MAX_CHUNKSIZE,
+    get_chunksize,
+    get_n_batches,
+    prepare_file_list_batches,
+)
 
 
 def test_prepare_file_list_batches(test_dcm_files):
@@ -27,3 +32,22 @@ def test_prepare_file_list_batches(test_dcm_files):
     assert dcm_list_batches[1] == test_dcm_files[2:4]
     assert dcm_list_batches[2] == test_dcm_files[4:6]
     assert dcm_list_batches[3] == test_dcm_files[6:8]
+
+
+def test_prepare_file_list_batches_lazy(test_dcm_files):
+    # Test if the batches are built lazily from any iterable
+    dcm_list_batches = prepare_file_list_batches(
+        iter(test_dcm_files), 3, lazy=True
+    )
+    assert not isinstance(dcm_list_batches, list)
+    dcm_list_batches = list(dcm_list_batches)
+    assert dcm_list_batches == prepare_file_list_batches(test_dcm_files, 3)
+    assert len(dcm_list_batches) == get_n_batches(len(test_dcm_files), 3)
+    assert list(prepare_file_list_batches([], 3, lazy=True)) == []
+
+
+def test_get_chunksize():
+    assert get_chunksize(0, 4) == 1
+    assert get_chunksize(100, 4) == 7
+    assert get_chunksize(100000, 4) == MAX_CHUNKSIZE
+    assert get_chunksize(100, 4, max_chunksize=5) == 5
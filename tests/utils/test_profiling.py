@@ -17,7 +17,7 @@
 import os
 import pandas as pd
 
-from dicom2elk.utils.profiling import append_profiler_results
+from dicom2elk.utils.profiling import PROFILER_COLUMNS, append_profiler_results
 
 
 def test_append_profiler_results(io_path):
@@ -32,6 +32,8 @@ def test_append_profiler_results(io_path):
         total_dcm_processed=10,
         total_dcm_skipped=0,
         total_time=10,
+        total_bulk_data_bytes_skipped=2048,
+        auto_tune=True,
     )
 
     # Check if the file exists
@@ -41,7 +43,7 @@ def test_append_profiler_results(io_path):
     results = pd.read_csv(tsv_file, sep="\t")
 
     # Check if the results are correct
-    assert results.shape == (1, 8)
+    assert results.shape == (1, 10)
     assert results["n_threads"].values[0] == 1
     assert results["batch_size"].values[0] == 2
     assert results["process_handler"].values[0] == "multiprocessing"
@@ -49,6 +51,34 @@ def test_append_profiler_results(io_path):
     assert results["total_dcm_processed"].values[0] == 10
     assert results["total_dcm_skipped"].values[0] == 0
     assert results["total_time"].values[0] == 10
+    assert results["total_bulk_data_bytes_skipped"].values[0] == 2048
+    assert results["auto_tune"].values[0]
 
     # Remove the file when done
     os.remove(tsv_file)
+
+
+def test_append_profiler_results_other_columns(tmpdir):
+    tsv_file = str(tmpdir.join("test.profile.tsv"))
+    # Profile file written with the columns of an older version
+    old_content = "timestamp\tn_threads\tbatch_size\n2024-01-01T00:00:00\t4\t100\n"
+    with open(tsv_file, "w") as f:
+        f.write(old_content)
+    options = dict(
+        n_threads=1,
+        batch_size=2,
+        process_handler="threads",
+        max_memory_usage=1000,
+        total_dcm_processed=10,
+        total_dcm_skipped=0,
+        total_time=10,
+    )
+    # Test if the old file is renamed instead of appending misaligned rows
+    assert append_profiler_results(tsv_file, **options) == tsv_file + ".1"
+    with open(tsv_file + ".1") as f:
+        assert f.read() == old_content
+    assert append_profiler_results(tsv_file, **options) is None
+    results = pd.read_csv(tsv_file, sep="\t")
+    assert list(results.columns) == PROFILER_COLUMNS
+    assert list(results["process_handler"]) == ["threads", "threads"]
+    assert list(results["auto_tune"]) == [False, False]
@@ -0,0 +1,101 @@
+# Copyright 2023-2024 Lausanne University and Lausanne University Hospital, Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for dicom2elk.utils.throttle module."""
+
+import multiprocessing
+import time
+
+import pytest
+
+from dicom2elk.utils.throttle import (
+    Throttle,
+    TokenBucket,
+    create_throttle,
+    get_file_size,
+    get_schedule_factor,
+    parse_throttle_schedule,
+)
+
+
+def _get_timestamp(hours: int, minutes: int):
+    # Timestamp of a time of day in local time
+    return time.mktime((2024, 1, 15, hours, minutes, 0, 0, 0, -1))
+
+
+def test_parse_throttle_schedule():
+    assert parse_throttle_schedule(None) == []
+    assert parse_throttle_schedule("07:00-19:00=0.2,22:30-06:00=0.5") == [
+        (420, 1140, 0.2),
+        (1350, 360, 0.5),
+    ]
+    # Test if invalid schedules raise a ValueError
+    for schedule in ["07:00-19:00", "7h-19h=0.2", "07:00-25:00=0.2", "07:00-19:00=0"]:
+        with pytest.raises(ValueError):
+            parse_throttle_schedule(schedule)
+
+
+def test_get_schedule_factor():
+    schedule = parse_throttle_schedule("07:00-19:00=0.2,22:00-06:00=0.5")
+    assert get_schedule_factor(schedule, _get_timestamp(12, 0)) == 0.2
+    assert get_schedule_factor(schedule, _get_timestamp(19, 0)) == 1.0
+    # Test if a window can span midnight
+    assert get_schedule_factor(schedule, _get_timestamp(23, 30)) == 0.5
+    assert get_schedule_factor(schedule, _get_timestamp(2, 0)) == 0.5
+    assert get_schedule_factor([], _get_timestamp(12, 0)) == 1.0
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10)
+    # Test if the tokens of the first second are available at once
+    assert bucket.reserve(10) == 0.0
+    # Test if the next request waits for the deficit to be refilled
+    assert bucket.reserve(5) == pytest.approx(0.5, abs=0.05)
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+def _reserve_in_worker(bucket):
+    bucket.reserve(10)
+
+
+def test_token_bucket_shared():
+    bucket = TokenBucket(rate=10)
+    # Test if the tokens taken by another process are not available anymore
+    worker = multiprocessing.Process(target=_reserve_in_worker, args=(bucket,))
+    worker.start()
+    worker.join()
+    assert bucket.reserve(5) == pytest.approx(0.5, abs=0.05)
+
+
+def test_throttle(test_dcm_files):
+    assert create_throttle() is None
+
+    throttle = create_throttle(files_per_sec=2, bytes_per_sec=1000)
+    assert isinstance(throttle, Throttle)
+    assert throttle.reserve_file(0) == 0.0
+    # Test if the delay is the largest of the delays of the files and the bytes
+    assert throttle.reserve_file(2000) == pytest.approx(1.0, abs=0.05)
+    # Test if the documents are not limited
+    assert throttle.reserve_documents(1000) == 0.0
+
+    throttle = create_throttle(documents_per_sec=100)
+    assert throttle.reserve_file(get_file_size(test_dcm_files[0])) == 0.0
+    assert throttle.wait_documents(100) == 0.0
+    assert throttle.reserve_documents(50) == pytest.approx(0.5, abs=0.05)
+
+
+def test_get_file_size(test_dcm_files, tmpdir):
+    assert get_file_size(test_dcm_files[0]) > 0
+    assert get_file_size(str(tmpdir.join("missing.dcm"))) == 0